@@ -1,14 +1,21 @@
 import streamlit as st
 import pandas as pd
-import tempfile
+import io
 import os
-from datetime import datetime
-from fiscal_report_full_script import process_sheet, format_excel_with_styles
+from datetime import datetime, timedelta
+from fiscal_report_full_script import RuleRegistry
+from formula_engine import CalculationPlan
+from input_cache import ParsedInputCache, content_digest
+from key_matching import DEFAULT_FUZZY_THRESHOLD
+from snapshot_store import SnapshotStore
+from pipeline import DEFAULT_WORKERS, PIPELINE_STAGES, InputFile, run_pipeline_job
+from job_queue import JOB_DONE, JOB_FAILED, JOB_QUEUED, FINISHED_STATES, JobQueue, JobRejected
+from job_server import JOB_SERVER_URL, JobServerClient, JobServerError
+from reconciliation import export_reconciliation, load_report, reconcile
+from log_config import RingBufferHandler, configure_logging, get_logger, level_number, route_thread_logs
+from stage_profiler import DEFAULT_PROFILE_CAPTURE, PROFILE_CPROFILE, PROFILE_TRACEMALLOC
 import json
-import matplotlib.pyplot as plt
-import numpy as np # 确保导入 numpy
 import re # Add import for regex
-from streamlit_markdown import st_markdown # Import the component
 
 # Helper function to sanitize text for Mermaid IDs
 def sanitize_for_mermaid_id(text):
@@ -25,36 +32,87 @@ def sanitize_for_mermaid_id(text):
     # Limit length to avoid overly long IDs (adjust limit as needed)
     return text[:50]
 
-# --- Matplotlib 中文显示设置 ---
-# 使用从系统中找到的字体，优先 Lantinghei SC
-plt.rcParams['font.sans-serif'] = ['Lantinghei SC', 'SimSong', 'Kaiti SC', 'Songti SC', 'sans-serif']
-plt.rcParams['axes.unicode_minus'] = False
-# --- 结束设置 ---
+# --- 日志配置：级别由 SALARY_LOG_LEVEL / SALARY_LOG_LEVELS 环境变量控制 ---
+configure_logging()
+logger = get_logger("app")
 
 # --- 初始化 Session State ---
-if 'log_messages' not in st.session_state:
-    st.session_state.log_messages = []
+if not isinstance(st.session_state.get('log_messages'), RingBufferHandler):
+    st.session_state.log_messages = RingBufferHandler() # 有容量上限的界面日志缓冲区
+# 本次运行中各处理模块的日志同时进入本会话的日志面板（界面自身的日志已由 log() 直接写入）
+route_thread_logs(st.session_state.log_messages, exclude=(logger.name,))
 if 'mapping_data' not in st.session_state:
     st.session_state.mapping_data = None
+if 'job_ids' not in st.session_state:
+    st.session_state.job_ids = [] # 本会话提交的后台任务，最新的在前
 if 'mapping_valid' not in st.session_state:
     st.session_state.mapping_valid = None # None: 未上传, True: 有效, False: 无效
+if 'rule_registry' not in st.session_state:
+    st.session_state.rule_registry = None # 由 mapping_data 构建的规则索引
 # --- 新增 Session State for Single Select --- #
 if 'single_selected_identity_column' not in st.session_state:
     st.session_state.single_selected_identity_column = None
 # --- 结束初始化 ---
 
+# --- 上传文件解析缓存：按内容 SHA-256 + 读取参数缓存，跨 rerun 复用 ---
+@st.cache_resource
+def get_parsed_input_cache():
+    return ParsedInputCache()
+
+@st.cache_resource
+def get_snapshot_store():
+    return SnapshotStore()
+
+@st.cache_resource
+def get_job_queue():
+    # 设置了 SALARY_JOB_SERVER 时处理提交到任务服务（job_server.py），界面只负责上传与显示
+    if JOB_SERVER_URL:
+        return JobServerClient(JOB_SERVER_URL)
+    # 进程内共享：任务不随会话结束而丢失，刷新页面后可通过 URL 中的任务 ID 找回
+    return JobQueue()
+
+# 页面刷新后 session_state 会重置，通过 URL 中记录的任务 ID 找回正在处理或已完成的任务
+if st.query_params.get("job") and st.query_params["job"] not in st.session_state.job_ids:
+    if get_job_queue().get(st.query_params["job"]) is not None:
+        st.session_state.job_ids.insert(0, st.query_params["job"])
+
+def get_upload_digest(uploaded_file):
+    # file_id 在同一次上传内不变，哈希只在首次见到该上传时计算
+    digests = st.session_state.setdefault('upload_digests', {})
+    file_key = getattr(uploaded_file, "file_id", None) or uploaded_file.name
+    if file_key not in digests:
+        digests[file_key] = content_digest(uploaded_file.getvalue())
+    return digests[file_key]
+
+def read_uploaded_workbook(uploaded_file, operation, **params):
+    """缓存的快照读取操作，如 read(header=2)、columns(header=2)、find_header_row(...)。"""
+    return get_parsed_input_cache().read(uploaded_file.getvalue(), operation, digest=get_upload_digest(uploaded_file), name=uploaded_file.name, **params)
+# --- 结束文件解析缓存 ---
+
 # --- 日志记录函数 ---
-def log(message, level="INFO"):
-    now = datetime.now().strftime("%H:%M:%S")
-    level_icon_map = {"INFO": "ℹ️", "WARNING": "⚠️", "ERROR": "❌", "SUCCESS": "✅"}
-    icon = level_icon_map.get(level, "▪️")
+LOG_LEVEL_ICONS = {"DEBUG": "🔹", "INFO": "ℹ️", "WARNING": "⚠️", "ERROR": "❌", "SUCCESS": "✅"}
+
+def log(message, level="INFO", *args):
+    """
+    记录一条界面日志：写入本会话有容量上限的环形缓冲区，并同时输出到 logging。
+    args 用于惰性格式化（如 preview(df)），级别低于当前显示级别时不会格式化。
+    """
+    levelno = level_number(level)
+    buffer = st.session_state.log_messages
+    if levelno < buffer.level and not logger.isEnabledFor(levelno):
+        return
+    if args:
+        message = message % args
+    buffer.add(level, message, name=logger.name)
+    logger.log(levelno, message)
+
+def format_log_entry(entry):
+    created, level, _name, message = entry
+    now = datetime.fromtimestamp(created).strftime("%H:%M:%S")
+    icon = LOG_LEVEL_ICONS.get(level, "▪️")
     log_level_class = f"log-{level.lower()}"
-
     # Wrap prefix and message in spans for styling
-    formatted_message = f"<span class='log-prefix'>{now} {icon}</span> <span class='{log_level_class}'>{message}</span>"
-
-    st.session_state.log_messages.append(formatted_message)
-    # 注意：日志在侧边栏的更新通常在整个按钮脚本执行完后发生
+    return f"<span class='log-prefix'>{now} {icon}</span> <span class='{log_level_class}'>{message}</span>"
 # --- 结束日志函数 ---
 
 st.set_page_config(layout="wide", page_title="财政工资处理系统")
@@ -148,6 +206,7 @@ button:not([kind="primary"]):hover {{
 /* --- 结束更新 --- */
 
 /* Log Message Styling */
+.log-debug {{ color: #6c757d; }} /* Grey debug */
 .log-info {{ color: #0dcaf0; }} /* Cyan info */
 .log-warning {{ color: #ffc107; }} /* Yellow warning */
 .log-error {{ color: #dc3545; font-weight: bold; }} /* Red, bold error */
@@ -220,6 +279,42 @@ def_year = datetime.today().year
 def_month = datetime.today().month
 
 salary_date = st.sidebar.date_input("工资表日期（用于标题栏）", value=datetime(def_year, def_month, 1), format="YYYY-MM-DD")
+salary_month = salary_date.strftime('%Y%m')
+
+# 输入/输出快照：按 单位名称/月份/输入哈希 保存为 Arrow 文件，重跑时直接内存映射读取
+snapshot_store = get_snapshot_store()
+use_snapshots = st.sidebar.checkbox(
+    "复用已保存的数据快照",
+    value=snapshot_store.available,
+    disabled=not snapshot_store.available,
+    help="相同内容的源文件、扣款表再次处理时直接读取快照，不再解析 Excel。" if snapshot_store.available else "未安装 pyarrow，快照功能不可用。",
+)
+active_snapshot_store = snapshot_store if use_snapshots else None
+
+processing_workers = st.sidebar.number_input(
+    "并行处理进程数",
+    min_value=1,
+    max_value=max(1, os.cpu_count() or 1),
+    value=min(max(1, DEFAULT_WORKERS), max(1, os.cpu_count() or 1)),
+    help="大于 1 时多个源文件分发到多个进程同时处理，单个文件出错不会中止其他文件。启动进程约需数秒，适合较大的文件。",
+)
+
+log_display_level = st.sidebar.selectbox(
+    "日志级别",
+    ["DEBUG", "INFO", "WARNING", "ERROR"],
+    index=1,
+    help="处理日志面板显示的最低级别。处理模块的 DEBUG 日志还需设置环境变量 SALARY_LOG_LEVEL=DEBUG。",
+)
+st.session_state.log_messages.setLevel(level_number(log_display_level))
+
+profile_options = {"仅阶段耗时": None, "函数级耗时 (cProfile)": PROFILE_CPROFILE, "内存分配 (tracemalloc)": PROFILE_TRACEMALLOC}
+profile_label = st.sidebar.selectbox(
+    "性能分析",
+    list(profile_options),
+    index=list(profile_options.values()).index(DEFAULT_PROFILE_CAPTURE) if DEFAULT_PROFILE_CAPTURE in profile_options.values() else 0,
+    help="每次处理都会记录各阶段的耗时、CPU 时间与内存；cProfile / tracemalloc 额外记录函数级耗时或内存分配，会使处理变慢。",
+)
+profile_capture = profile_options[profile_label]
 
 
 # 文件上传
@@ -253,6 +348,9 @@ if file_mapping is not None:
         # 基本结构检查 (确保顶层是对象，且包含 'field_mappings' 列表)
         if isinstance(temp_mapping_data, dict) and isinstance(temp_mapping_data.get('field_mappings'), list):
             # 只有当新上传的文件有效时才更新 session_state
+            if temp_mapping_data != st.session_state.mapping_data or st.session_state.rule_registry is None:
+                # 规则内容变化时才重建索引，避免每次 rerun 重复构建
+                st.session_state.rule_registry = RuleRegistry(temp_mapping_data['field_mappings'])
             st.session_state.mapping_data = temp_mapping_data
             st.session_state.mapping_valid = True
             mapping_validation_placeholder.success("✅ 映射文件 JSON 有效。")
@@ -310,8 +408,8 @@ st.sidebar.markdown("---")
 with st.sidebar.expander("📄 处理日志", expanded=True):
     log_container = st.container(height=300) # 固定高度可滚动容器
     with log_container:
-        for message in st.session_state.log_messages:
-            st.markdown(message, unsafe_allow_html=True) # Markdown is now expected to contain spans like <span class='log-info'>...</span>
+        for entry in st.session_state.log_messages:
+            st.markdown(format_log_entry(entry), unsafe_allow_html=True) # Markdown is now expected to contain spans like <span class='log-info'>...</span>
 # --- 结束日志显示 ---
 
 # 从 session_state 获取数据，如果无效或为 None 则用空字典
@@ -326,27 +424,18 @@ sample_source_fields = set()
 # 模板字段名预取
 if file_template:
     try:
-        file_template.seek(0)
-        template_df_header = pd.read_excel(file_template, skiprows=2, nrows=1)
-        template_fields = template_df_header.columns.tolist()
+        template_fields = read_uploaded_workbook(file_template, "columns", header=2)
     except Exception as e:
         st.warning(f"模板字段读取失败：{e}")
 
 # 源数据字段示例收集
 if source_files:
     try:
-        uploaded_source_file = source_files[0]
-        uploaded_source_file.seek(0)
-        source_preview = pd.read_excel(uploaded_source_file, nrows=10, header=None)
-        # 修复括号和逻辑：查找包含'姓名'或'人员姓名'的行
-        # --- 修改：使用默认关键字进行首次检测以填充选项 --- #
+        # 查找包含'姓名'或'人员姓名'的行 (使用默认关键字进行首次检测以填充选项)
         default_keywords_for_options = ["姓名", "人员姓名"]
-        header_row = next((i for i, row in source_preview.iterrows() if any((key_col in str(cell)) for cell in row.astype(str) for key_col in default_keywords_for_options)), None)
-        # --- 结束修改 --- #
+        header_row = read_uploaded_workbook(source_files[0], "find_header_row", keywords=default_keywords_for_options, max_scan_rows=10)
         if header_row is not None:
-            # 重置指针，读取正确的表头行
-            uploaded_source_file.seek(0)
-            df_source_cols = pd.read_excel(uploaded_source_file, skiprows=header_row, nrows=0).columns.tolist()
+            df_source_cols = read_uploaded_workbook(source_files[0], "columns", header=header_row)
             sample_source_fields = set(df_source_cols)
         else:
             st.warning("无法在第一个源文件中自动检测表头行以获取示例字段。")
@@ -361,7 +450,20 @@ with st.expander("🔑 关键列与规则匹配设置", expanded=True):
         options=sample_source_fields,
         default=pre_selected_keys,
         help="这些列将用于自动检测源文件表头，并作为合并扣款表时的依据。请至少选择一项。"
+             "选择多列（如 姓名 + 身份证号）时按组合键匹配，可区分同名人员；"
+             "精确匹配不上的行会尝试规范化与部分列匹配，并在结果中列出供核对。"
+    )
+    # 模糊匹配默认关闭：模糊匹配到的扣款金额需要人工核对
+    fuzzy_matching = st.checkbox(
+        "精确匹配不上时允许模糊匹配关键标识",
+        value=DEFAULT_FUZZY_THRESHOLD < 1,
+        help="开启后，与扣款表记录足够相似（如证件号错一位）且唯一最相似的行也会合并扣款，"
+             "这些行在处理结果的“扣款匹配核对”中列出，请核对后再发放。"
     )
+    fuzzy_threshold = st.slider(
+        "模糊匹配的最低相似度", min_value=0.80, max_value=0.99, step=0.01,
+        value=DEFAULT_FUZZY_THRESHOLD if DEFAULT_FUZZY_THRESHOLD < 1 else 0.9,
+    ) if fuzzy_matching else 1.0
     # --- 结束新增 --- #
 
     # --- 规则匹配设置 --- #
@@ -429,6 +531,7 @@ with st.expander("🔑 关键列与规则匹配设置", expanded=True):
 if st.session_state.get('mapping_valid') is True and 'mapping_data' in st.session_state and st.session_state.mapping_data:
     with st.expander("📊 映射规则可视化", expanded=True): # Default to expanded
         field_mappings = st.session_state.mapping_data.get('field_mappings', [])
+        rule_registry = RuleRegistry.ensure(st.session_state.rule_registry or field_mappings)
         identity_key = st.session_state.get('single_selected_identity_column')
 
         if not field_mappings:
@@ -438,7 +541,7 @@ if st.session_state.get('mapping_valid') is True and 'mapping_data' in st.sessio
         else:
             # Extract unique rule identifiers and sort them
             try:
-                 rule_identities = sorted(list(set(str(rule.get(identity_key, "未知规则")) for rule in field_mappings if identity_key in rule)))
+                 rule_identities = sorted(rule_registry.identity_values(identity_key))
             except Exception as e:
                  st.error(f"提取规则标识符时出错: {e}")
                  rule_identities = []
@@ -447,11 +550,10 @@ if st.session_state.get('mapping_valid') is True and 'mapping_data' in st.sessio
                  st.warning(f"无法从映射数据中找到基于 '{identity_key}' 的有效规则标识。")
             else:
                 # Create a mapping from identity value to establishment value for display
-                identity_to_bianzhi = {}
-                for rule in field_mappings:
-                    identity_val = str(rule.get(identity_key))
-                    if identity_val not in identity_to_bianzhi: # Store the first encountered '编制' for each identity
-                        identity_to_bianzhi[identity_val] = rule.get('编制', '未知')
+                identity_to_bianzhi = {
+                    identity_val: rule_registry.find_rule(identity_val, identity_key).get('编制', '未知')
+                    for identity_val in rule_identities
+                }
 
                 # Define a function to format the display options
                 format_func = lambda identity: f"{identity} (编制: {identity_to_bianzhi.get(identity, '未知')})"
@@ -469,7 +571,7 @@ if st.session_state.get('mapping_valid') is True and 'mapping_data' in st.sessio
                 )
 
                 # Find the selected rule
-                selected_rule = next((rule for rule in field_mappings if str(rule.get(identity_key)) == selected_identity), None)
+                selected_rule = rule_registry.find_rule(selected_identity, identity_key)
 
                 if selected_rule:
                     # --- Generate Mermaid String ---
@@ -538,6 +640,8 @@ if st.session_state.get('mapping_valid') is True and 'mapping_data' in st.sessio
                         # Construct the full markdown string first
                         markdown_content = f"```mermaid\n{mermaid_string}\n```"
                         # --- Use st_markdown and remove container --- #
+                        # 渲染组件只在显示规则图时导入，不计入页面首次加载
+                        from streamlit_markdown import st_markdown
                         st_markdown(markdown_content)
                     except Exception as e:
                         st.error(f"渲染 Mermaid 图表时出错: {e}")
@@ -578,9 +682,7 @@ with st.expander("✅ 数据校验与处理", expanded=True):
                 # 扣款表
                 actual_deduction_fields = set()
                 try:
-                    file_deductions.seek(0)
-                    deduction_df_headers = pd.read_excel(file_deductions, header=2, nrows=0) # 只读表头
-                    actual_deduction_fields = set(deduction_df_headers.columns)
+                    actual_deduction_fields = set(read_uploaded_workbook(file_deductions, "columns", header=2)) # 只读表头
                 except Exception as e:
                     validation_errors.append(f"读取扣款表表头失败: {e}")
 
@@ -589,9 +691,7 @@ with st.expander("✅ 数据校验与处理", expanded=True):
                 template_available = False
                 if file_template:
                     try:
-                        file_template.seek(0)
-                        template_df_header = pd.read_excel(file_template, skiprows=2, nrows=1)
-                        actual_template_fields = template_df_header.columns.tolist()
+                        actual_template_fields = read_uploaded_workbook(file_template, "columns", header=2)
                         template_available = True
                     except Exception as e:
                         validation_warnings.append(f"读取模板表表头失败: {e} (目标字段有效性将无法检查)")
@@ -602,12 +702,9 @@ with st.expander("✅ 数据校验与处理", expanded=True):
                 default_keywords_for_header = ["姓名", "人员姓名"]
                 for i, src_file in enumerate(source_files):
                     try:
-                        src_file.seek(0)
-                        preview_df = pd.read_excel(src_file, header=None, nrows=20)
-                        header_row_idx = next((idx for idx, row in preview_df.iterrows() if any((key in str(cell)) for cell in row.astype(str) for key in default_keywords_for_header)), None)
+                        header_row_idx = read_uploaded_workbook(src_file, "find_header_row", keywords=default_keywords_for_header, max_scan_rows=20)
                         if header_row_idx is not None:
-                             src_file.seek(0) # 需要重置指针以正确读取列
-                             df_cols = pd.read_excel(src_file, header=header_row_idx, nrows=0).columns.tolist()
+                             df_cols = read_uploaded_workbook(src_file, "columns", header=header_row_idx)
                              all_actual_source_fields.update(df_cols)
                         else:
                              source_read_errors.append(f"文件 '{src_file.name}' 未能自动检测到表头行 (使用默认关键字)。")
@@ -623,6 +720,7 @@ with st.expander("✅ 数据校验与处理", expanded=True):
                      validation_errors.append("无法加载 JSON 映射规则。")
                 else:
                      field_mappings = st.session_state.mapping_data.get('field_mappings', [])
+                     rule_registry = RuleRegistry.ensure(st.session_state.rule_registry or field_mappings)
 
                      # 如果前面步骤有错误，则停止进一步检查
                      if not validation_errors:
@@ -638,11 +736,19 @@ with st.expander("✅ 数据校验与处理", expanded=True):
                          invalid_target_map = []
 
                          # --- 新增：预收集所有定义的目标字段 --- #
-                         all_defined_target_fields = set()
-                         for r in field_mappings:
-                             for m in r.get("mappings", []):
-                                 if m.get("target_field"):
-                                     all_defined_target_fields.add(m["target_field"])
+                         all_defined_target_fields = rule_registry.target_fields()
+                         # 计算字段依赖图：检测循环依赖，并判断计算所需字段能否 (逐层) 得到
+                         calculation_plan = CalculationPlan.from_rules(rule_registry)
+                         if calculation_plan.cycles:
+                             validation_errors.append(f"**JSON 规则错误：以下计算字段存在循环依赖:** {calculation_plan.cycles}")
+                         simple_mapped_fields = {
+                             m["target_field"]
+                             for r in rule_registry
+                             for m in r.get("mappings", [])
+                             if m.get("target_field") and m.get("source_field") in available_fields
+                         }
+                         unresolved_calculations = calculation_plan.unresolved_sources(available_fields | simple_mapped_fields)
+                         resolvable_fields = simple_mapped_fields | (set(calculation_plan.definitions) - set(unresolved_calculations))
                          # --- 结束新增 --- #
 
                          for rule_idx, rule in enumerate(field_mappings):
@@ -662,8 +768,11 @@ with st.expander("✅ 数据校验与处理", expanded=True):
                                      tgt = mapping.get("target_field")
                                      for src in src_list:
                                          # --- 修改校验条件和警告消息 --- #
-                                         if src not in available_fields and src not in all_defined_target_fields:
-                                             invalid_source_map.append(f"规则 '{rule_id}' (计算): 源字段 '{src}' 在源文件/扣款表中未找到，且未被其他规则定义为目标字段。")
+                                         if src not in available_fields and src not in resolvable_fields:
+                                             if src in all_defined_target_fields:
+                                                 invalid_source_map.append(f"规则 '{rule_id}' (计算): 源字段 '{src}' 虽被其他规则定义为目标字段，但其依赖的字段无法得到: {unresolved_calculations.get(src, [])}")
+                                             else:
+                                                 invalid_source_map.append(f"规则 '{rule_id}' (计算): 源字段 '{src}' 在源文件/扣款表中未找到，且未被其他规则定义为目标字段。")
                                          # --- 结束修改 --- #
                                      if template_available and tgt and tgt not in actual_template_fields:
                                          invalid_target_map.append(f"规则 '{rule_id}' (计算): 目标字段 '{tgt}' 在模板文件中未找到。")
@@ -714,7 +823,7 @@ with st.expander("✅ 数据校验与处理", expanded=True):
 
     if st.button("🚀 开始处理数据", type="primary", disabled=disable_processing_button, help=button_tooltip):
         # 清空旧日志并记录开始
-        st.session_state.log_messages = []
+        st.session_state.log_messages.clear()
         log("开始处理流程...", "INFO")
 
         # 1. 输入校验
@@ -736,333 +845,193 @@ with st.expander("✅ 数据校验与处理", expanded=True):
             valid_inputs = False
 
         if valid_inputs:
-            # 2. 准备数据
-            deduction_df = None
+            # 2. 提交后台任务：处理在任务队列中进行，页面重新运行或刷新后任务继续，完成的报表仍可下载
             current_field_mappings = st.session_state.get('mapping_data', {}).get('field_mappings', [])
-            selected_deduction_fields = [] # 初始化
-
+            identity_column_to_use = st.session_state.single_selected_identity_column
+            run_in_parallel = processing_workers > 1 and len(source_files) > 1
+            input_files = [InputFile(f.getvalue(), f.name, get_upload_digest(f)) for f in source_files]
+            deduction_file = InputFile(file_deductions.getvalue(), file_deductions.name, get_upload_digest(file_deductions))
+            template_file = InputFile(file_template.getvalue(), file_template.name, get_upload_digest(file_template)) if file_template else None
             try:
-                log("读取扣款数据...", "INFO")
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as tmp_deduct:
-                    file_deductions.seek(0)
-                    tmp_deduct.write(file_deductions.getvalue())
-                    tmp_deduct_path = tmp_deduct.name
-                try:
-                    # 读取扣款表，从第三行读取表头
-                    deduction_df = pd.read_excel(tmp_deduct_path, header=2)
-                    # 记录读取到的列名和前几行数据
-                    log(f"读取到的扣款表列名: {deduction_df.columns.tolist()}", "INFO")
-                    log(f"扣款表明细 (前 5 行): \n{deduction_df.head().to_string()}", "INFO")
-                finally:
-                    os.unlink(tmp_deduct_path)
-
-                # 校验扣款表姓名列
-                key_col_found = False
-                name_columns = key_identifier_columns
-                actual_name_col = None
-                for key_col in name_columns:
-                    if key_col in deduction_df.columns:
-                        key_col_found = True
-                        actual_name_col = key_col # 记录找到的姓名列
-                        break
-                if not key_col_found:
-                    log(f"扣款表必须包含用户选择的关键标识列中的至少一个 ({name_columns})！", "ERROR")
-                    st.stop()
-                else:
-                    log(f"扣款数据读取成功，找到关键标识列: '{actual_name_col}'。", "INFO")
-
-                # 自动确定扣款字段列表
-                all_deduction_cols = deduction_df.columns.tolist()
-                selected_deduction_fields = [col for col in all_deduction_cols if col != actual_name_col]
-                log(f"自动识别用于合并的扣款字段 (共 {len(selected_deduction_fields)} 个): {selected_deduction_fields}", "INFO")
-                if not selected_deduction_fields:
-                     log("警告：扣款表中除了姓名列外未找到其他字段。", "WARNING")
-
-                # 在调用process_sheet之前添加预处理步骤
-                print("\n=== 预处理扣款数据 ===")
-                print(f"扣款数据形状: {deduction_df.shape}")
-                print(f"扣款数据列: {deduction_df.columns.tolist()}")
-                print(f"扣款数据前5行:\n{deduction_df.head().to_string()}")
-
-                # 确保所有选中的扣款字段都是数值类型
-                for field in selected_deduction_fields:
-                    if field in deduction_df.columns:
-                        deduction_df[field] = pd.to_numeric(deduction_df[field], errors='coerce').fillna(0)
-                        print(f"\n处理字段 {field}:")
-                        print(f"数据类型: {deduction_df[field].dtype}")
-                        print(f"非零值数量: {(deduction_df[field] != 0).sum()}")
-                        print(f"前5个值: {deduction_df[field].head().to_list()}")
-
-                # --- 新增：预过滤映射规则 --- #
-                log("开始预过滤映射规则...", "INFO")
-                filtered_mappings_for_processing = []
-                actual_deduction_fields = set(deduction_df.columns)
-                # 使用之前获取的 sample_source_fields
-                # 注意：sample_source_fields 可能未在所有分支初始化，需要确保它存在
-                if 'sample_source_fields' not in locals():
-                     # 如果 sample_source_fields 因某种原因未定义 (例如没有上传源文件，虽然前面有校验)
-                     # 这里可以设置为空集合，或者记录一个错误然后停止？设置为集合可能更安全
-                     log("警告：未能获取源文件样本字段用于规则过滤，将不执行过滤。", "WARNING")
-                     filtered_mappings_for_processing = current_field_mappings # 不过滤
-                else:
-                    filtered_rule_count = 0
-                    original_mapping_count = 0
-                    for rule in current_field_mappings:
-                        original_mapping_count += len(rule.get("mappings", []))
-                        filtered_rule = rule.copy()
-                        filtered_rule["mappings"] = []
-                        # --- 使用 Session State --- #
-                        rule_id_for_log = rule.get(st.session_state.single_selected_identity_column, '未知规则') # 用于日志
-                        # --- 结束使用 --- #
-
-                        for mapping in rule.get("mappings", []):
-                            if "source_field" in mapping:
-                                src = mapping["source_field"]
-                                # 条件：源字段在扣款表存在 且 在源文件样本中不存在
-                                if src in actual_deduction_fields and src not in sample_source_fields:
-                                    log(f"  - 过滤掉规则 '{rule_id_for_log}' 中的无效映射: 源 '{src}' 仅存在于扣款表。", "DEBUG")
-                                    filtered_rule_count += 1
-                                    continue # 跳过这个映射
-                                else:
-                                    filtered_rule["mappings"].append(mapping) # 保留有效映射
-                            elif "source_fields" in mapping:
-                                filtered_rule["mappings"].append(mapping) # 保留复杂映射
-                            else:
-                                # 如果映射格式未知，也保留？或者警告？暂时保留
-                                filtered_rule["mappings"].append(mapping)
-
-                        filtered_mappings_for_processing.append(filtered_rule)
-                    log(f"映射规则预过滤完成。共过滤掉 {filtered_rule_count} 个无效的简单映射。", "INFO")
-                # --- 结束预过滤 --- #
-
-                # 3. 处理每个源文件
-                all_results = []
-                has_error = False
-                # --- 使用 Session State --- #
-                identity_column_to_use = st.session_state.single_selected_identity_column
-                log(f"开始逐个处理 {len(source_files)} 个源文件... (使用 '{identity_column_to_use}' 字段匹配)", "INFO")
-                # --- 结束使用 --- #
-                with st.spinner(f"正在处理 {len(source_files)} 个源文件..."):
-                    for i, uploaded_file in enumerate(source_files):
-                        log(f"[{i+1}/{len(source_files)}] 处理文件: {uploaded_file.name}", "INFO")
-                        tmp_source_path = None
-                        try:
-                            with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as tmp_source:
-                                tmp_source.write(uploaded_file.getvalue())
-                                tmp_source_path = tmp_source.name
-
-                            # --- BEGIN: Add logging for source data before processing ---
-                            try:
-                                # Attempt to read source file to log info (need to find header)
-                                preview_df_for_header = pd.read_excel(tmp_source_path, header=None, nrows=20) # Read first 20 rows to find header
-                                # --- 修改：使用 key_identifier_columns --- #
-                                header_row_source = next((idx for idx, row in preview_df_for_header.iterrows() if any((key_col in str(cell)) for cell in row.astype(str) for key_col in key_identifier_columns)), None)
-                                # --- 结束修改 --- #
-
-                                if header_row_source is not None:
-                                    df_source_preview = pd.read_excel(tmp_source_path, header=header_row_source)
-                                    log(f"  -> 源文件 [{uploaded_file.name}] 读取成功 (使用 {key_identifier_columns} 检测到表头行: {header_row_source + 1})，准备送入 process_sheet...", "INFO") # 修改日志
-                                    log(f"     源文件列名: {df_source_preview.columns.tolist()}", "INFO")
-                                    log(f"     源文件数据 (前 5 行):\\n{df_source_preview.head().to_string()}", "INFO")
-                                else:
-                                    log(f"  -> 警告: 未能在源文件 [{uploaded_file.name}] 前 20 行找到 {key_identifier_columns} 中的任何一个作为表头，无法记录源数据详情。", "WARNING") # 修改日志
-                                    # Optionally, proceed without preview logging or stop? For now, just warn.
-                            except Exception as read_err:
-                                 log(f"  -> 警告: 尝试读取源文件 [{uploaded_file.name}] 进行日志记录时出错: {read_err}", "WARNING")
-                            # --- END: Add logging for source data before processing ---
-
-                            # --- BEGIN: Add simulated merge for diagnostics ---
-                            if 'df_source_preview' in locals() and header_row_source is not None: # Ensure preview was read
-                                try:
-                                    # --- 修改：使用 key_identifier_columns 和 actual_name_col --- #
-                                    source_key_to_use = None
-                                    if actual_name_col in df_source_preview.columns: # 优先使用扣款表找到的那个
-                                        source_key_to_use = actual_name_col
-                                    else: # 否则查找第一个在源表中的用户选择的关键列
-                                         source_key_to_use = next((col for col in key_identifier_columns if col in df_source_preview.columns), None)
-
-                                    if source_key_to_use and actual_name_col: # 确保两边都有可用的键
-                                        log(f"  -> 执行模拟合并 (源: {uploaded_file.name}, 扣款表) on: 源='{source_key_to_use}', 扣款='{actual_name_col}'...", "INFO") # 修改日志
-                                        simulated_merge = pd.merge(df_source_preview, deduction_df, left_on=source_key_to_use, right_on=actual_name_col, how='left', suffixes=('', '_扣款')) # 使用 left_on/right_on
-                                        log(f"     模拟合并结果列名: {simulated_merge.columns.tolist()}", "INFO")
-                                        log(f"     模拟合并结果数据 (前 5 行):\\n{simulated_merge.head().to_string()}", "INFO")
-                                    else:
-                                        log(f"  -> 警告: 无法执行模拟合并，源文件({key_identifier_columns})或扣款表({actual_name_col})缺少有效的公共或指定关键列。", "WARNING") # 修改日志
-                                    # --- 结束修改 --- #
-                                except Exception as merge_err:
-                                    log(f"  -> 错误: 执行模拟合并时出错: {merge_err}", "ERROR")
-                            else:
-                                 log(f"  -> 跳过模拟合并，因为未能成功读取源文件预览。", "INFO")
-                            # --- END: Add simulated merge for diagnostics ---
-
-                            # 添加调用 process_sheet 的日志
-                            log(f"  -> 调用核心处理函数 process_sheet...", "INFO")
-                            result_df = process_sheet(
-                                tmp_source_path,
-                                deduction_df,
-                                filtered_mappings_for_processing,
-                                selected_deduction_fields,
-                                # --- 使用 Session State --- #
-                                identity_column_to_use,
-                                identity_column_to_use # NOTE: Passing identity key twice? Check process_sheet definition if intended.
-                                # --- 结束使用 --- #
-                             )
-                            log(f"  <- process_sheet 返回，结果行数: {len(result_df) if result_df is not None else 'None'}", "INFO")
-
-                            # --- BEGIN: Add logging for result data after processing ---
-                            if result_df is not None and not result_df.empty:
-                                 log(f"     process_sheet 返回 [{uploaded_file.name}] 列名: {result_df.columns.tolist()}", "INFO")
-                                 log(f"     process_sheet 返回 [{uploaded_file.name}] 数据 (前 5 行):\\n{result_df.head().to_string()}", "INFO")
-                                 all_results.append(result_df)
-                                 log(f"[{i+1}/{len(source_files)}] 文件 {uploaded_file.name} 处理成功。", "SUCCESS")
-                            # --- END: Add logging for result data after processing ---
-                            else:
-                                 # Keep original warning log if result is None or empty
-                                 log(f"[{i+1}/{len(source_files)}] 文件 {uploaded_file.name} 未返回有效数据 (可能无匹配行或处理错误)。", "WARNING")
-
-                        except ValueError as ve: # 捕获 process_sheet 返回的特定错误？还是内部处理？
-                            # 假设 process_sheet 内部已打印错误，这里只记录失败
-                            log(f"[{i+1}/{len(source_files)}] 文件 {uploaded_file.name} 处理失败。", "ERROR")
-                            has_error = True
-                        except Exception as e:
-                            log(f"[{i+1}/{len(source_files)}] 处理文件 {uploaded_file.name} 时发生意外错误: {e}", "ERROR")
-                            has_error = True
-                        finally:
-                            if tmp_source_path and os.path.exists(tmp_source_path):
-                               os.unlink(tmp_source_path)
-                        if has_error:
-                             log(f"因处理文件 {uploaded_file.name} 时发生错误，处理中止。", "ERROR")
-                             break # 保持中止逻辑
-
-                # 4. 合并与格式化
-                if not has_error and all_results:
-                    log("所有文件处理完成，开始合并 {len(all_results)} 个结果...", "INFO")
-                    with st.spinner("合并结果并格式化输出..."):
-                        tmp_processed_path = None
-                        output_path = None
-                        try:
-                            combined_df = pd.concat(all_results, ignore_index=True)
-                            log("结果合并完成，总行数: {len(combined_df)}", "INFO")
-
-                            if file_template and template_fields:
-                                # 恢复为严格按模板 reindex，丢弃不在模板中的列
-                                log(f"根据模板文件的 {len(template_fields)} 个字段严格筛选和排序输出列...", "INFO")
-                                combined_df = combined_df.reindex(columns=template_fields)
-                                # 注意：如果 template_fields 包含 combined_df 中没有的列，reindex 会添加它们并填充 NaN
-                            else:
-                                 log("未提供模板文件或读取失败，按原始处理顺序输出所有列。", "INFO")
-
-                            log("保存处理结果到临时文件...", "INFO")
-                            with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as tmp_processed:
-                                combined_df.to_excel(tmp_processed.name, index=False)
-                                tmp_processed_path = tmp_processed.name
-
-                            output_filename = f"{unit_name}_{salary_date.strftime('%Y%m')}_工资发放表_已处理.xlsx"
-                            output_dir = tempfile.mkdtemp()
-                            output_path = os.path.join(output_dir, output_filename)
-
-                            log("开始格式化输出文件...", "INFO")
-                            format_excel_with_styles(tmp_processed_path, output_path, salary_date.year, salary_date.month)
-                            log("文件格式化完成。", "SUCCESS")
-
-                            # 在合并操作后添加日志
-                            log(f"合并后的DataFrame列名: {combined_df.columns.tolist()}", "INFO")
-                            log(f"合并后的DataFrame数据 (前 5 行):\n{combined_df.head().to_string()}", "INFO")
-
-                            # 在扣款明细计算前添加日志
-                            log(f"用于计算的扣款明细字段: {selected_deduction_fields}", "INFO")
-                            log(f"扣款明细字段的值 (前 5 行):\n{combined_df[selected_deduction_fields].head().to_string()}", "INFO")
-
-                            # 在扣款明细计算后添加日志
-                            # --- 修改：移除硬编码访问 --- #
-                            total_deduction_col_name = '扣发合计'
-                            if total_deduction_col_name in combined_df.columns:
-                                log(f"计算后的'{total_deduction_col_name}'和其他扣款明细字段的值 (前 5 行):\n{combined_df[[total_deduction_col_name] + selected_deduction_fields].head().to_string()}", "INFO")
-                            else:
-                                log(f"计算后的扣款明细字段的值 (未找到'{total_deduction_col_name}'列) (前 5 行):\n{combined_df[selected_deduction_fields].head().to_string()}", "INFO")
-                            # --- 结束修改 --- #
-
-                            # 在最终输出前添加日志
-                            log(f"最终输出的DataFrame列名: {combined_df.columns.tolist()}", "INFO")
-                            log(f"最终输出的DataFrame数据 (前 5 行):\n{combined_df.head().to_string()}", "INFO")
-
-                            # 验证结果
-                            print("\n=== 验证处理结果 ===")
-                            print(f"结果数据形状: {result_df.shape}")
-                            print(f"结果数据列: {result_df.columns.tolist()}")
-
-                            # 检查扣款字段
-                            for field in selected_deduction_fields:
-                                if field in result_df.columns:
-                                    print(f"\n检查字段 {field}:")
-                                    print(f"数据类型: {result_df[field].dtype}")
-                                    print(f"非零值数量: {(result_df[field] != 0).sum()}")
-                                    print(f"前5个值: {result_df[field].head().to_list()}")
-                                else:
-                                    print(f"\n警告: 字段 {field} 不在结果数据中")
-
-                            # 检查姓名列的匹配情况
-                            # --- 修改：使用 key_identifier_columns --- #
-                            common_key_for_validation = None
-                            for key_col in key_identifier_columns:
-                                if key_col in result_df.columns and key_col in deduction_df.columns:
-                                    common_key_for_validation = key_col
-                                    break
-
-                            if common_key_for_validation:
-                                print(f"\n=== 使用关键列 '{common_key_for_validation}' 检查姓名匹配情况 ===")
-                                source_names = set(result_df[common_key_for_validation].dropna().unique())
-                                deduction_names = set(deduction_df[common_key_for_validation].dropna().unique())
-                                matched_names = source_names.intersection(deduction_names)
-                                print(f"源文件中的 '{common_key_for_validation}' 数量: {len(source_names)}")
-                                print(f"扣款表中的 '{common_key_for_validation}' 数量: {len(deduction_names)}")
-                                print(f"成功匹配的 '{common_key_for_validation}' 数量: {len(matched_names)}")
-                                if len(matched_names) < len(source_names):
-                                    print(f"警告: 部分源文件中的 '{common_key_for_validation}' 未能匹配到扣款数据")
-                                    print("未匹配示例:")
-                                    unmatched = source_names - matched_names
-                                    print(list(unmatched)[:5])
-                            else:
-                                print(f"\n警告: 未能在结果表和扣款表中找到共同的关键标识列 ({key_identifier_columns}) 用于匹配验证。")
-                            # --- 结束修改 --- #
-
-                            # 5. 提供下载
-                            # st.success(f"🎉 处理完成！...") # 由 log 替代
-                            log(f"处理成功完成！最终报告已生成：{output_filename}", "SUCCESS")
-                            with open(output_path, "rb") as fp:
-                                st.download_button(
-                                    label="📥 下载最终报告",
-                                    data=fp,
-                                    file_name=output_filename,
-                                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                                    key="download_report"
-                                )
-
-                        except Exception as e:
-                            log(f"合并或格式化 Excel 文件时出错: {e}", "ERROR")
-                            has_error = True # 确保标记错误
-                        finally:
-                            if tmp_processed_path and os.path.exists(tmp_processed_path):
-                                os.unlink(tmp_processed_path)
-
-                elif not all_results and not has_error:
-                     log("未生成任何有效数据，请检查源文件内容和映射规则。", "WARNING")
-                elif has_error:
-                    log("处理因发生错误而中止。", "ERROR")
-
-            except Exception as e:
-                log(f"处理过程中发生无法恢复的严重错误: {e}", "ERROR")
-                # 确保清理可能遗留的临时文件
-                if 'tmp_deduct_path' in locals() and os.path.exists(tmp_deduct_path):
-                    os.unlink(tmp_deduct_path)
-                if 'tmp_source_path' in locals() and os.path.exists(tmp_source_path):
-                    os.unlink(tmp_source_path)
-                if 'tmp_processed_path' in locals() and os.path.exists(tmp_processed_path):
-                    os.unlink(tmp_processed_path)
-
+                job_id = get_job_queue().submit(
+                    run_pipeline_job,
+                    input_files,
+                    deduction_file,
+                    current_field_mappings,
+                    salary_date,
+                    name=f"{unit_name} {salary_month} ({len(source_files)} 个源文件)",
+                    owner=unit_name,
+                    cost=sum(len(f.data) for f in input_files + [deduction_file, template_file] if f is not None),
+                    unit_name=unit_name,
+                    template=template_file,
+                    identity_column=identity_column_to_use,
+                    key_identifier_columns=list(key_identifier_columns),
+                    fuzzy_threshold=fuzzy_threshold,
+                    snapshot_store=active_snapshot_store,
+                    workers=processing_workers,
+                    # 并行模式下单个文件出错不中止其他文件
+                    stop_on_error=not run_in_parallel,
+                    profile_capture=profile_capture,
+                )
+            except (JobRejected, JobServerError) as e:
+                log(f"提交处理任务失败: {e}", "ERROR")
+                job_id = None
+            if job_id:
+                st.session_state.job_ids.insert(0, job_id)
+                st.query_params["job"] = job_id
+                log(f"已提交处理任务 {job_id}（使用 '{identity_column_to_use}' 字段匹配），处理进度见下方任务列表。", "INFO")
         else:
             log("输入校验失败，请检查上传的文件和配置。", "ERROR")
 
+# --- 后台任务列表 ---
+def render_reconciliation(job, report_data):
+    """与上期结果（上传的报表或上月的合并结果快照）逐行对账，生成对账工作簿。"""
+    with st.expander("🔍 与上期结果对账"):
+        previous_month = (salary_date.replace(day=1) - timedelta(days=1)).strftime('%Y%m')
+        previous_upload = st.file_uploader("上期（或上一次）的处理结果报表", type=["xlsx"], key=f"recon_previous_{job.id}")
+        has_previous_snapshot = snapshot_store.available and not snapshot_store.list_snapshots(
+            unit_name=job.owner, salary_month=previous_month, kind="combined").empty
+        use_previous_snapshot = previous_upload is None and has_previous_snapshot and st.checkbox(
+            f"使用 {previous_month} 的合并结果快照", value=True, key=f"recon_snapshot_{job.id}")
+        if st.button("开始对账", key=f"recon_run_{job.id}", disabled=previous_upload is None and not use_previous_snapshot):
+            try:
+                previous = (snapshot_store.load_latest("combined", job.owner, previous_month) if use_previous_snapshot
+                            else load_report(previous_upload))
+                result = reconcile(previous, load_report(report_data), list(key_identifier_columns) or ["人员姓名"])
+                buffer = io.BytesIO()
+                export_reconciliation(result, buffer, title=f"{job.name} 对账结果")
+                st.session_state[f"recon_result_{job.id}"] = (result.to_dict(), result.summary, buffer.getvalue())
+            except ValueError as e:
+                st.error(f"对账失败：{e}")
+        if f"recon_result_{job.id}" in st.session_state:
+            stats, summary, workbook = st.session_state[f"recon_result_{job.id}"]
+            st.info(f"两期都有 {stats['matched']} 人，其中 {stats['changed']} 人有变动；新增 {stats['added']} 人，减少 {stats['removed']} 人。")
+            st.dataframe(summary, hide_index=True)
+            st.download_button(
+                label="📥 下载对账结果",
+                data=workbook,
+                file_name=f"{job.owner}_对账结果.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                key=f"download_reconciliation_{job.id}",
+            )
+
+def render_match_review(match):
+    """列出合并扣款时未匹配与非精确匹配的人员。"""
+    review, unmatched = match.get("review") or [], match.get("unmatched") or []
+    unkeyed = match.get("unkeyed") or 0
+    if not review and not unmatched and not unkeyed:
+        return
+    with st.expander(f"⚠️ 扣款匹配核对：{len(review)} 条非精确匹配，{len(unmatched)} 个未匹配", expanded=False):
+        if review:
+            st.dataframe(pd.DataFrame(review).rename(columns={
+                "key": "源数据", "record": "扣款表记录", "method": "匹配方式", "confidence": "置信度"}),
+                hide_index=True)
+        if unmatched:
+            st.caption(f"未匹配到扣款数据: {', '.join(unmatched)}")
+        if unkeyed:
+            st.caption(f"扣款表中有 {unkeyed} 行的关键列全部为空，未能合并")
+
+def render_profile(job, profile):
+    """各阶段（及各源文件各阶段）的耗时、CPU 时间与内存，可下载为 JSON。"""
+    if not profile or not profile.get("stages"):
+        return
+    with st.expander(f"⏱️ 各阶段耗时（共 {profile.get('wall_seconds') or 0:.1f} 秒）", expanded=False):
+        stages = pd.DataFrame(profile["stages"])
+        stages["file"] = stages["file"].fillna("（整体）")
+        st.dataframe(stages.drop(columns=["stage"]).rename(columns={
+            "file": "文件", "label": "阶段", "wall_seconds": "耗时(秒)", "cpu_seconds": "CPU(秒)", "rows": "行数",
+            "rss_mb": "内存(MB)", "peak_rss_mb": "内存峰值(MB)", "alloc_peak_mb": "分配峰值(MB)"}).dropna(axis=1, how="all"),
+            hide_index=True)
+        if profile.get("tracemalloc"):
+            st.caption("分配内存最多的代码行")
+            st.dataframe(pd.DataFrame(profile["tracemalloc"]).rename(columns={
+                "location": "位置", "size_mb": "大小(MB)", "count": "分配次数"}), hide_index=True)
+        if profile.get("cprofile"):
+            st.caption("函数级耗时（按累计时间排序）")
+            st.code(profile["cprofile"], language="text")
+        st.download_button(
+            label="📥 下载性能记录 (JSON)",
+            data=json.dumps(profile, ensure_ascii=False, indent=2),
+            file_name=f"{job.owner}_性能记录_{job.id}.json",
+            mime="application/json",
+            key=f"download_profile_{job.id}",
+        )
+
+def job_report(job):
+    """
+    已完成任务的 (文件名, 报表 bytes)，每个任务只读取（使用任务服务时为下载）一次，保存在会话中；
+    有任务运行时任务列表每秒刷新，不再每次重新读取全部报表。
+    """
+    reports = st.session_state.setdefault('job_reports', {})
+    if job.id not in reports:
+        report = get_job_queue().report(job.id)
+        if report is None:
+            return None
+        # 只保留本会话任务列表中的任务
+        for job_id in set(reports) - set(st.session_state.job_ids):
+            del reports[job_id]
+        reports[job.id] = report
+    return reports[job.id]
+
+def render_job(job):
+    stage_label = PIPELINE_STAGES.get(job.stage, job.stage)
+    if job.status == JOB_QUEUED:
+        st.progress(0.0, text=f"**{job.name}** · 排队中（前面还有 {get_job_queue().queued_ahead(job.id)} 个任务）")
+    elif job.status == JOB_FAILED:
+        st.error(f"**{job.name}** 处理失败：{job.error}")
+    else:
+        st.progress(job.progress, text=f"**{job.name}** · {stage_label} {job.message}")
+
+    if job.status == JOB_DONE:
+        result = job.result or {}
+        failed_files = [f["name"] for f in result.get("files", []) if f["status"] == "error"]
+        if failed_files:
+            st.warning(f"以下文件处理失败，已从结果中跳过: {failed_files}")
+        report = job_report(job) if result.get("output_path") else None
+        if report is not None:
+            file_name, data = report
+            st.success(f"处理完成：共 {result.get('rows', 0)} 行，用时 {job.finished - job.started:.1f} 秒。")
+            st.download_button(
+                label="📥 下载最终报告",
+                data=data,
+                file_name=file_name,
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                key=f"download_report_{job.id}",
+            )
+            render_match_review(result.get("match") or {})
+            render_reconciliation(job, data)
+        else:
+            st.warning("未生成任何有效数据，请检查源文件内容和映射规则。")
+        render_profile(job, result.get("profile"))
+
+    if len(job.logs):
+        with st.expander(f"任务日志 ({len(job.logs)} 条)", expanded=job.status == JOB_FAILED):
+            for entry in job.logs:
+                st.markdown(format_log_entry(entry), unsafe_allow_html=True)
+
+def render_jobs():
+    jobs = [job for job in (get_job_queue().get(job_id) for job_id in st.session_state.job_ids) if job is not None]
+    if not jobs:
+        return
+    st.subheader("📋 处理任务")
+    for job in jobs:
+        with st.container(border=True):
+            render_job(job)
+    # 有任务刚结束时整页重新运行一次，停止定时刷新
+    active = {job.id for job in jobs if job.status not in FINISHED_STATES}
+    if st.session_state.get('active_job_ids', set()) - active:
+        st.session_state.active_job_ids = active
+        st.rerun()
+    st.session_state.active_job_ids = active
+
+# 有未结束的任务时每秒刷新任务列表（只重新运行该片段，不重新执行整个页面）
+job_refresh_interval = 1.0 if any(
+    job is not None and job.status not in FINISHED_STATES
+    for job in (get_job_queue().get(job_id) for job_id in st.session_state.job_ids)
+) else None
+st.fragment(run_every=job_refresh_interval)(render_jobs)()
+# --- 结束后台任务列表 ---
+
 # 可以添加页脚等信息
 st.markdown("---")
 st.caption("© 成都高新区财政金融局")
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+命令行批处理：不经过浏览器运行与界面相同的处理流程并写出格式化报表
+
+单个单位（目录中按文件名自动识别扣款表与模板，其余为源数据表）：
+
+    python batch_run.py input/公务员-事业-参公/ \\
+        --mapping config/field_mapping/公务员-参公-事业.json \\
+        --unit 高新区财政局 --month 2025-09 -o output/
+
+显式指定文件（支持通配符）：
+
+    python batch_run.py --sources "input/区聘专项原投服/[!0]*.xlsx" \\
+        --deduction input/区聘专项原投服/0-扣款明细.xlsx \\
+        --template input/区聘专项原投服/0-区聘原投服专项--导出模板.xlsx \\
+        --mapping config/field_mapping/区聘-原投服-专项.json --month 202509
+
+多个单位一起跑（如月末夜间定时任务），用 JSON 清单描述每个任务，
+每项的键与命令行参数同名（inputs/sources/deduction/template/mapping/unit/month/...）：
+
+    python batch_run.py --jobs month_end.json -o output/
+
+超大的源数据表（如市级汇总）分块处理，内存占用不随行数增长：
+
+    python batch_run.py input/市级汇总/ --mapping ... --month 2025-09 --chunk-rows 5000
+
+关键标识默认只做精确、规范化与部分列匹配；需要模糊匹配时用 --fuzzy-threshold 0.9 开启，
+模糊匹配到的人员在汇总的 match.review 中列出，请核对后再发放。
+
+退出码：全部任务成功为 0，否则为 1。
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from fiscal_report_full_script import DEFAULT_UNIT_NAME
+from log_config import SUCCESS, configure_logging, get_logger
+from pipeline import DEFAULT_CHUNK_ROWS, DEFAULT_WORKERS, PipelineError, classify_inputs, expand_inputs, parse_salary_month, run_pipeline
+from snapshot_store import DEFAULT_SNAPSHOT_DIR, SnapshotStore
+from stage_profiler import DEFAULT_PROFILE_CAPTURE, PROFILE_CAPTURES
+
+logger = get_logger("batch_run")
+
+# 清单中每个任务可用的键及默认值（未给出时取命令行参数）
+JOB_KEYS = ("inputs", "sources", "deduction", "template", "mapping", "unit", "month",
+            "identity_column", "key_columns", "fuzzy_threshold", "output")
+
+
+def _split_columns(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.split(",")
+    columns = [col.strip() for col in value if col and col.strip()]
+    return columns or None
+
+
+def _single(paths, kind: str, job_name: str):
+    if not paths:
+        return None
+    if len(paths) > 1:
+        raise PipelineError(f"[{job_name}] 找到多个{kind}，请用参数明确指定: {paths}")
+    return paths[0]
+
+
+def resolve_job_files(job: dict, recursive: bool = True) -> dict:
+    """把任务中的目录/通配符展开为 源数据表、扣款表、模板 文件路径。"""
+    job_name = job.get("name") or job.get("unit") or "任务"
+    groups = classify_inputs(expand_inputs(job.get("inputs") or [], recursive=recursive))
+    sources = expand_inputs(job["sources"], recursive=recursive) if job.get("sources") else groups["sources"]
+    deduction = job.get("deduction") or _single(groups["deduction"], "扣款表", job_name)
+    template = job.get("template") or _single(groups["template"], "导出模板", job_name)
+    # 显式指定的扣款表/模板不再作为源数据表
+    excluded = {os.path.normpath(path) for path in (deduction, template) if path}
+    sources = [path for path in sources if os.path.normpath(path) not in excluded]
+    if not sources:
+        raise PipelineError(f"[{job_name}] 未找到源数据表。")
+    if not deduction:
+        raise PipelineError(f"[{job_name}] 未找到扣款表（文件名需包含 扣款/扣费，或使用 --deduction 指定）。")
+    return {"sources": sources, "deduction": deduction, "template": template}
+
+
+def run_job(job: dict, snapshot_store=None, stop_on_error: bool = True, recursive: bool = True,
+            workers: int = DEFAULT_WORKERS, profile_capture: str = DEFAULT_PROFILE_CAPTURE,
+            chunk_rows: int = DEFAULT_CHUNK_ROWS) -> dict:
+    """执行一个任务，返回可写入汇总 JSON 的结果。"""
+    job_name = job.get("name") or job.get("unit") or "任务"
+    start = time.perf_counter()
+    summary = {"name": job_name, "unit": job.get("unit"), "month": job.get("month")}
+    try:
+        if not job.get("mapping"):
+            raise PipelineError(f"[{job_name}] 缺少映射规则文件 (--mapping)。")
+        if not job.get("month"):
+            raise PipelineError(f"[{job_name}] 缺少工资月份 (--month)。")
+        files = resolve_job_files(job, recursive=recursive)
+        logger.info("[%s] 源数据表 %s 个，扣款表 %s，模板 %s", job_name, len(files["sources"]),
+                    os.path.basename(files["deduction"]), os.path.basename(files["template"]) if files["template"] else "无")
+        output = job.get("output") or "."
+        if not output.lower().endswith(".xlsx"):
+            os.makedirs(output, exist_ok=True)
+        result = run_pipeline(
+            files["sources"],
+            files["deduction"],
+            job["mapping"],
+            parse_salary_month(job["month"]),
+            output_path=output,
+            unit_name=job.get("unit") or DEFAULT_UNIT_NAME,
+            template=files["template"],
+            identity_column=job.get("identity_column"),
+            key_identifier_columns=_split_columns(job.get("key_columns")),
+            snapshot_store=snapshot_store,
+            stop_on_error=stop_on_error,
+            workers=workers,
+            profile_capture=profile_capture,
+            chunk_rows=chunk_rows,
+            fuzzy_threshold=job.get("fuzzy_threshold"),
+        )
+        summary.update(result.to_dict())
+    except (PipelineError, OSError, ValueError) as e:
+        logger.error("%s", e)
+        summary.update({"ok": False, "error": str(e)})
+    summary["seconds"] = round(time.perf_counter() - start, 3)
+    return summary
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="工资表批处理（与界面相同的处理流程）")
+    parser.add_argument("inputs", nargs="*", help="输入文件、目录或通配符；目录中按文件名识别扣款表与模板")
+    parser.add_argument("--sources", nargs="+", help="源数据表（文件或通配符），指定后不再从 inputs 中识别")
+    parser.add_argument("--deduction", help="扣款表")
+    parser.add_argument("--template", help="导出模板")
+    parser.add_argument("--mapping", help="字段映射规则 JSON")
+    parser.add_argument("--unit", default=DEFAULT_UNIT_NAME, help=f"单位名称（默认: {DEFAULT_UNIT_NAME}）")
+    parser.add_argument("--month", help="工资月份，如 2025-09 或 202509")
+    parser.add_argument("--identity-column", help="用于匹配转换规则的列名（默认依次尝试 人员身份、岗位类别）")
+    parser.add_argument("--key-columns", help="合并扣款表的关键标识列，逗号分隔（默认: 源文件中的 姓名/人员姓名）")
+    parser.add_argument("--fuzzy-threshold", type=float,
+                        help="扣款表关键标识模糊匹配的最低相似度，如 0.9（默认取 SALARY_FUZZY_MATCH_THRESHOLD 或 1，即不做模糊匹配）")
+    parser.add_argument("-o", "--output", default="output", help="输出目录或 .xlsx 文件路径（默认: output）")
+    parser.add_argument("--jobs", help="任务清单 JSON（任务列表，或包含 jobs 列表的对象）")
+    parser.add_argument("--no-recursive", action="store_true", help="目录输入不包含子目录")
+    parser.add_argument("--continue-on-error", action="store_true", help="某个源文件出错时跳过该文件继续处理")
+    parser.add_argument("-j", "--workers", type=int, default=DEFAULT_WORKERS,
+                        help=f"并行处理源文件的进程数（默认取 SALARY_WORKERS 或 {DEFAULT_WORKERS}）")
+    parser.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS,
+                        help="分块处理源文件的每块行数，用于超大的表（默认取 SALARY_CHUNK_ROWS，0 为不分块）")
+    parser.add_argument("--snapshots", action="store_true", help=f"读写 Arrow 数据快照（目录: {DEFAULT_SNAPSHOT_DIR}）")
+    parser.add_argument("--snapshot-dir", help="快照目录，指定时同时启用快照")
+    parser.add_argument("--summary", help="把各任务结果写入该 JSON 文件")
+    parser.add_argument("--profile", choices=PROFILE_CAPTURES, default=DEFAULT_PROFILE_CAPTURE,
+                        help="除各阶段耗时外的深入分析：cprofile（函数级耗时）或 tracemalloc（内存分配）")
+    parser.add_argument("--profile-json", help="把各任务的分阶段耗时与内存写入该 JSON 文件")
+    parser.add_argument("--log-level", help="日志级别（默认取 SALARY_LOG_LEVEL 或 INFO）")
+    return parser
+
+
+def load_jobs(args) -> list:
+    """由命令行参数或任务清单生成任务列表；清单中未给出的键取命令行参数。"""
+    defaults = {key: getattr(args, key) for key in JOB_KEYS}
+    if not args.jobs:
+        return [defaults]
+    with open(args.jobs, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    entries = manifest.get("jobs", []) if isinstance(manifest, dict) else manifest
+    base_dir = os.path.dirname(os.path.abspath(args.jobs))
+    jobs = []
+    for entry in entries:
+        job = dict(defaults, inputs=[], sources=None, deduction=None, template=None)
+        job.update(entry)
+        if isinstance(job.get("inputs"), str):
+            job["inputs"] = [job["inputs"]]
+        # 清单中的相对路径以清单所在目录为基准
+        for key in ("inputs", "sources"):
+            if job.get(key):
+                job[key] = [value if os.path.isabs(value) else os.path.join(base_dir, value) for value in job[key]]
+        for key in ("deduction", "template", "mapping"):
+            if entry.get(key) and not os.path.isabs(entry[key]):
+                job[key] = os.path.join(base_dir, entry[key])
+        jobs.append(job)
+    return jobs
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    configure_logging(level=args.log_level, force=args.log_level is not None)
+    if not args.jobs and not (args.inputs or args.sources):
+        build_parser().error("请提供输入目录/文件，或使用 --jobs 指定任务清单。")
+
+    snapshot_store = None
+    if args.snapshots or args.snapshot_dir:
+        snapshot_store = SnapshotStore(args.snapshot_dir or DEFAULT_SNAPSHOT_DIR)
+        if not snapshot_store.available:
+            logger.warning("未安装 pyarrow，快照功能不可用。")
+            snapshot_store = None
+
+    summaries = []
+    for job in load_jobs(args):
+        summaries.append(run_job(job, snapshot_store=snapshot_store, stop_on_error=not args.continue_on_error,
+                                 recursive=not args.no_recursive, workers=args.workers, profile_capture=args.profile,
+                                 chunk_rows=args.chunk_rows))
+
+    failed = [s for s in summaries if not s.get("ok")]
+    for s in summaries:
+        level = SUCCESS if s.get("ok") else logging.ERROR
+        logger.log(level, "[%s] %s，%s 行，用时 %.1f 秒 %s", s["name"], "成功" if s.get("ok") else "失败",
+                   s.get("rows", 0), s["seconds"], s.get("output_path") or s.get("error") or "")
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            json.dump(summaries, f, ensure_ascii=False, indent=2)
+    if args.profile_json:
+        with open(args.profile_json, "w", encoding="utf-8") as f:
+            json.dump([{"name": s["name"], **(s.get("profile") or {})} for s in summaries], f, ensure_ascii=False, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
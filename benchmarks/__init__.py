@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+"""性能基准：合成数据生成 (payroll_generator) 与各处理阶段的计时 (bench_pipeline)。"""
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+列宽 / 空列计算基准
+
+对比两种方式在宽报表上的耗时与结果差异：
+- 逐单元格：to_excel 后用 openpyxl 读回，对每个单元格调用 get_column_width 并逐列判断空列
+  （format_excel_with_styles 原有做法）
+- 向量化：compute_column_layout 直接由 DataFrame 计算（可选抽样）
+
+用法：
+    python benchmarks/bench_column_layout.py --rows 5000 --cols 80 --sample-rows 2000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fiscal_report_full_script import compute_column_layout, get_column_width  # noqa: E402
+
+SURNAMES = list("王李张刘陈杨黄赵吴周徐孙马朱胡郭何高林罗")
+GIVEN_NAMES = list("伟芳娜敏静丽强磊军洋勇艳杰娟涛明超秀霞平刚桂英")
+IDENTITIES = ["公务员", "参公", "事业", "专技", "区聘", "原投服"]
+
+
+def make_report(rows: int, cols: int, seed: int = 0) -> pd.DataFrame:
+    """生成与导出报表形状相近的数据：姓名、身份、编号等文本列，其余为金额列，含少量空列。"""
+    rng = np.random.default_rng(seed)
+    data = {
+        "序号": np.arange(1, rows + 1),
+        "人员姓名": [rng.choice(SURNAMES) + "".join(rng.choice(GIVEN_NAMES, rng.integers(1, 3))) for _ in range(rows)],
+        "人员身份": rng.choice(IDENTITIES, rows),
+        "身份证号": [f"5101{rng.integers(10**13, 10**14)}" for _ in range(rows)],
+    }
+    for i in range(cols - len(data)):
+        name = f"津贴补贴{i}" if i % 3 else f"扣款项目{i}"
+        if i % 17 == 5:
+            data[name] = np.nan  # 空列，应被隐藏
+        elif i % 5 == 0:
+            data[name] = np.round(rng.random(rows) * 20000, 2) + 0.1 + 0.2  # 带浮点误差的计算结果
+        else:
+            data[name] = np.round(rng.random(rows) * 20000, 2)
+    return pd.DataFrame(data)
+
+
+def cell_based_layout(df: pd.DataFrame):
+    with tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False) as tmp:
+        path = tmp.name
+    try:
+        df.to_excel(path, index=False)
+        ws = load_workbook(path).active
+        start = time.perf_counter()
+        widths = [max(get_column_width(cell) for cell in column_cells) for column_cells in ws.columns]
+        non_empty = [
+            any(v is not None and str(v).strip() != "" for v in (ws.cell(row=row, column=col).value for row in range(2, ws.max_row + 1)))
+            for col in range(1, ws.max_column + 1)
+        ]
+        return widths, non_empty, time.perf_counter() - start
+    finally:
+        os.unlink(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="列宽/空列计算基准")
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--cols", type=int, default=80)
+    parser.add_argument("--sample-rows", type=int, default=None, help="向量化计算时抽样的行数")
+    args = parser.parse_args()
+
+    df = make_report(args.rows, args.cols)
+    print(f"报表: {df.shape[0]} 行 x {df.shape[1]} 列")
+
+    reference_widths, reference_non_empty, cell_seconds = cell_based_layout(df)
+    print(f"逐单元格计算: {cell_seconds * 1000:.1f} ms")
+
+    for sample_rows in (None, args.sample_rows) if args.sample_rows else (None,):
+        start = time.perf_counter()
+        widths, non_empty = compute_column_layout(df, sample_rows=sample_rows)
+        seconds = time.perf_counter() - start
+        max_diff = max(abs(a - b) for a, b in zip(widths, reference_widths))
+        label = "全部行" if sample_rows is None else f"抽样 {sample_rows} 行"
+        print(f"向量化计算 ({label}): {seconds * 1000:.1f} ms, 加速 {cell_seconds / seconds:.1f}x, "
+              f"最大宽度差 {max_diff:.2f}, 空列一致: {non_empty == reference_non_empty}")
+
+
+if __name__ == "__main__":
+    main()
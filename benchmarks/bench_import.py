@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+界面冷启动基准
+
+每次在新的 Python 进程中计时（与容器冷启动一致，不受当前进程已导入模块的影响）：
+
+- modules       导入界面依赖的处理模块（pipeline、reconciliation、job_server 等），不含 streamlit 本身
+- first_render  用 streamlit.testing 的 AppTest 运行一次 app.py，即首次打开页面时脚本的执行时间
+                （导入 streamlit.testing 的耗时单独记录，不计入）
+
+两项都检查启动后是否加载了应按需导入的重依赖（DEFERRED_MODULES：Excel 读写样式、规则图渲染组件），
+只在读写工作簿、显示规则图时才应导入。中位数超过预算 (--budget-ms / --render-budget-ms) 或加载了这些模块时
+退出码为 1，可在 CI 中作为导入耗时的门槛。
+
+用法：
+    python benchmarks/bench_import.py
+    python benchmarks/bench_import.py --repeat 5 --budget-ms 1000 -o results/import.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.bench_pipeline import environment, git_commit  # noqa: E402
+
+# 界面启动时导入的处理模块
+APP_MODULES = (
+    "fiscal_report_full_script", "formula_engine", "input_cache", "snapshot_store", "pipeline",
+    "job_queue", "job_server", "reconciliation", "log_config", "stage_profiler",
+)
+# 启动时不应加载的模块
+DEFERRED_MODULES = ("openpyxl", "streamlit_markdown")
+DEFAULT_BUDGET_MS = 1500
+DEFAULT_RENDER_BUDGET_MS = 3000
+
+_MODULES_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {modules}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "loaded": [m for m in {deferred!r} if m in sys.modules]}}))
+"""
+
+_RENDER_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+ready = time.perf_counter()
+at = AppTest.from_file({app!r}, default_timeout=120)
+at.run()
+print(json.dumps({{"seconds": time.perf_counter() - ready, "streamlit_seconds": ready - start,
+                  "exception": [str(e.value) for e in at.exception],
+                  "loaded": [m for m in {deferred!r} if m in sys.modules]}}))
+"""
+
+
+def _run_fresh(script: str) -> dict:
+    """在新进程中执行 script，返回其最后一行输出的 JSON。"""
+    proc = subprocess.run([sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def measure(kind: str, repeat: int) -> dict:
+    """重复 repeat 次测量 modules 或 first_render，返回每次耗时、中位数与启动后已加载的重依赖。"""
+    if kind == "modules":
+        script = _MODULES_SCRIPT.format(modules=", ".join(APP_MODULES), deferred=DEFERRED_MODULES)
+    else:
+        script = _RENDER_SCRIPT.format(app=os.path.join(ROOT, "app.py"), deferred=DEFERRED_MODULES)
+    runs = [_run_fresh(script) for _ in range(repeat)]
+    seconds = [run["seconds"] for run in runs]
+    item = {
+        "stage": kind,
+        "repeat": repeat,
+        "seconds": seconds,
+        "min": min(seconds),
+        "median": statistics.median(seconds),
+        "loaded": sorted({m for run in runs for m in run["loaded"]}),
+    }
+    if kind == "first_render":
+        item["streamlit_seconds"] = statistics.median(run["streamlit_seconds"] for run in runs)
+        item["exception"] = runs[-1]["exception"]
+    return item
+
+
+def main():
+    parser = argparse.ArgumentParser(description="界面冷启动基准")
+    parser.add_argument("--repeat", type=int, default=3, help="每项的重复次数（每次一个新进程）")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS, help="导入处理模块的中位数预算 (毫秒)")
+    parser.add_argument("--render-budget-ms", type=float, default=DEFAULT_RENDER_BUDGET_MS,
+                        help="首次运行 app.py 的中位数预算 (毫秒)")
+    parser.add_argument("--no-render", action="store_true", help="不测量 first_render")
+    parser.add_argument("-o", "--output", help="结果 JSON 输出路径")
+    args = parser.parse_args()
+
+    budgets = {"modules": args.budget_ms, "first_render": args.render_budget_ms}
+    kinds = ["modules"] if args.no_render else ["modules", "first_render"]
+    results = []
+    failed = False
+    for kind in kinds:
+        item = measure(kind, args.repeat)
+        item["budget_ms"] = budgets[kind]
+        item["over_budget"] = item["median"] * 1000 > budgets[kind]
+        results.append(item)
+        notes = []
+        if item["over_budget"]:
+            notes.append(f"超出预算 {budgets[kind]:.0f} ms")
+        if item["loaded"]:
+            notes.append(f"启动时加载了 {', '.join(item['loaded'])}")
+        if item.get("exception"):
+            notes.append(f"运行出错: {item['exception'][0]}")
+        failed = failed or bool(notes)
+        print(f"{kind:<14} 中位数 {item['median'] * 1000:>8.1f} ms  最小 {item['min'] * 1000:>8.1f} ms  "
+              f"{'；'.join(notes) or '通过'}", flush=True)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"created": datetime.now().isoformat(timespec="seconds"), "commit": git_commit(),
+                       "environment": environment(), "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"结果已写出: {args.output}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""
+处理流程分阶段基准
+
+用 payroll_generator 按映射规则生成 1k/10k/100k 行的合成输入，逐阶段计时：
+
+- read              解析源数据工作簿 (WorkbookSnapshot.load)
+- detect_start_row  在原始行上检测表头行 (detect_data_start_row)
+- load_source       表头检测、构建 DataFrame、过滤合计行 (load_source_frame)
+- mapping           按身份分组应用字段映射 (apply_field_mapping_by_identity)
+- merge             建立扣款表索引并合并扣款 (DeductionIndex)
+- calculate         合并扣款 + 复杂计算 + 实发工资 (merge_and_calculate，扣款表索引预先建立)
+- build_report      紧凑化各文件结果、合并并按模板排列 (compact_frame + build_report)
+- export            单次写出格式化报表 (export_excel_with_styles)
+- format_excel      to_excel 后读回设置样式的旧做法 (format_excel_with_styles)，逐单元格处理较慢，
+                    默认只在不超过 --format-max-rows 行时运行
+- pipeline          端到端 run_pipeline（含读取与导出）
+
+每个阶段重复 --repeat 次，记录每次耗时、最小值与中位数；结果以 JSON 写出 (-o)，
+--compare 与之前保存的结果对比，中位数变慢超过 --threshold 的阶段视为退化，退出码为 1。
+
+用法：
+    python benchmarks/bench_pipeline.py --rows 1000 10000 -o results/bench.json
+    python benchmarks/bench_pipeline.py --rows 100000 --stages read mapping merge --repeat 1
+    python benchmarks/bench_pipeline.py --rows 10000 --compare results/bench.json --threshold 0.2
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime
+
+import numpy as np
+import openpyxl
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.payroll_generator import generate_dataset  # noqa: E402
+from fiscal_report_full_script import (DeductionIndex, RuleRegistry, apply_field_mapping_by_identity,  # noqa: E402
+                                       detect_data_start_row, export_excel_with_styles, format_excel_with_styles,
+                                       load_source_frame, merge_and_calculate)
+from frame_schema import compact_frame  # noqa: E402
+from log_config import LOGGER_NAMESPACE  # noqa: E402
+from pipeline import (DEDUCTION_HEADER_ROW, TEMPLATE_HEADER_ROW, InputFile, build_report, filter_mappings,  # noqa: E402
+                      load_field_mappings, prepare_deductions, run_pipeline)
+from workbook_reader import WorkbookSnapshot  # noqa: E402
+
+DEFAULT_MAPPINGS = (
+    os.path.join(ROOT, "config", "field_mapping", "公务员-参公-事业.json"),
+    os.path.join(ROOT, "config", "field_mapping", "区聘-原投服-专项.json"),
+)
+DEFAULT_ROWS = (1000, 10000, 100000)
+DEFAULT_DATA_DIR = os.path.join(ROOT, "benchmarks", "data")
+# 结果 JSON 的格式版本
+RESULT_VERSION = 1
+SALARY_DATE = date(2025, 3, 1)
+
+
+class DatasetContext:
+    """
+    一个合成数据集上各阶段的输入。每个阶段的输入由前面的阶段产生，按需计算一次（不计入耗时）。
+    """
+
+    def __init__(self, dataset, work_dir: str):
+        self.dataset = dataset
+        self.work_dir = work_dir
+        self.identity = dataset.identity_column
+        self.files = [InputFile.open(path) for path in dataset.sources]
+        self._cache = {}
+
+    def _get(self, name, compute):
+        if name not in self._cache:
+            self._cache[name] = compute()
+        return self._cache[name]
+
+    @property
+    def snapshots(self) -> list:
+        return self._get("snapshots", lambda: [f.snapshot for f in self.files])
+
+    @property
+    def raw_frames(self) -> list:
+        return self._get("raw_frames", lambda: [s.preview(nrows=len(s)) for s in self.snapshots])
+
+    @property
+    def source_frames(self) -> list:
+        return self._get("source_frames", lambda: [load_source_frame(s, self.identity) for s in self.snapshots])
+
+    @property
+    def deduction(self):
+        """(扣款表, 关键标识列, 扣款字段)"""
+        def compute():
+            deduction_df = InputFile.open(self.dataset.deduction).snapshot.read(header=DEDUCTION_HEADER_ROW)
+            return prepare_deductions(deduction_df, ["人员姓名"])
+        return self._get("deduction", compute)
+
+    @property
+    def registry(self) -> RuleRegistry:
+        def compute():
+            source_fields = set()
+            for f in self.files:
+                source_fields.update(f.header_fields())
+            rules, _ = filter_mappings(load_field_mappings(self.dataset.mapping_path), self.deduction[0].columns,
+                                       source_fields, self.identity)
+            return RuleRegistry(rules)
+        return self._get("registry", compute)
+
+    @property
+    def mapped_frames(self) -> list:
+        return self._get("mapped_frames", lambda: [
+            apply_field_mapping_by_identity(df, self.registry, self.identity, self.identity)[0] for df in self.source_frames
+        ])
+
+    @property
+    def deduction_index(self) -> DeductionIndex:
+        return self._get("deduction_index", lambda: DeductionIndex(*self.deduction))
+
+    @property
+    def results(self) -> list:
+        return self._get("results", lambda: [self.calculate(df.copy()) for df in self.mapped_frames])
+
+    @property
+    def template_fields(self) -> list:
+        return self._get("template_fields", lambda: InputFile.open(self.dataset.template).columns(header=TEMPLATE_HEADER_ROW))
+
+    @property
+    def report(self) -> pd.DataFrame:
+        return self._get("report", lambda: build_report([compact_frame(df) for df in self.results], self.template_fields))
+
+    def calculate(self, df_mapped: pd.DataFrame) -> pd.DataFrame:
+        _, _, fields = self.deduction
+        return merge_and_calculate(df_mapped, self.deduction_index, self.registry, fields, self.identity, self.identity)
+
+    def output_path(self, name: str) -> str:
+        return os.path.join(self.work_dir, name)
+
+
+def _stage_read(ctx):
+    return None, lambda _: [WorkbookSnapshot.load(f.data, name=f.name, header_keywords=(ctx.identity,)) for f in ctx.files]
+
+
+def _stage_detect_start_row(ctx):
+    return (lambda: ctx.raw_frames), lambda frames: [detect_data_start_row(df, ctx.identity) for df in frames]
+
+
+def _stage_load_source(ctx):
+    return (lambda: ctx.snapshots), lambda snapshots: [load_source_frame(s, ctx.identity) for s in snapshots]
+
+
+def _stage_mapping(ctx):
+    return (lambda: (ctx.source_frames, ctx.registry)), lambda args: [
+        apply_field_mapping_by_identity(df, args[1], ctx.identity, ctx.identity) for df in args[0]
+    ]
+
+
+def _stage_merge(ctx):
+    def run(args):
+        frames, (deduction_df, key_columns, fields) = args
+        index = DeductionIndex(deduction_df, key_columns, fields)
+        return [index.merge(df, index.source_key_columns(df.columns), fields) for df in frames]
+    return (lambda: (ctx.mapped_frames, ctx.deduction)), run
+
+
+def _stage_calculate(ctx):
+    # merge_and_calculate 原地添加列，每次在副本上运行
+    return (lambda: [df.copy() for df in ctx.mapped_frames]), lambda frames: [ctx.calculate(df) for df in frames]
+
+
+def _stage_build_report(ctx):
+    return (lambda: ctx.results), lambda results: build_report([compact_frame(df) for df in results], ctx.template_fields)
+
+
+def _stage_export(ctx):
+    path = ctx.output_path("export.xlsx")
+    return (lambda: ctx.report), lambda report: export_excel_with_styles(report, path, SALARY_DATE.year, SALARY_DATE.month)
+
+
+def _stage_format_excel(ctx):
+    raw_path, path = ctx.output_path("raw.xlsx"), ctx.output_path("formatted.xlsx")
+
+    def run(report):
+        report.to_excel(raw_path, index=False)
+        format_excel_with_styles(raw_path, path, SALARY_DATE.year, SALARY_DATE.month)
+    return (lambda: ctx.report), run
+
+
+def _stage_pipeline(ctx):
+    dataset = ctx.dataset
+    return None, lambda _: run_pipeline(dataset.sources, dataset.deduction, dataset.mapping_path, SALARY_DATE,
+                                        output_path=ctx.work_dir, template=dataset.template)
+
+
+# 阶段名 -> 构造函数：返回 (准备输入的函数或 None, 被计时的函数)
+STAGES = {
+    "read": _stage_read,
+    "detect_start_row": _stage_detect_start_row,
+    "load_source": _stage_load_source,
+    "mapping": _stage_mapping,
+    "merge": _stage_merge,
+    "calculate": _stage_calculate,
+    "build_report": _stage_build_report,
+    "export": _stage_export,
+    "format_excel": _stage_format_excel,
+    "pipeline": _stage_pipeline,
+}
+
+
+def time_stage(ctx: DatasetContext, stage: str, repeat: int) -> list:
+    """运行一个阶段 repeat 次，返回每次的耗时（秒）。输入在计时之外准备。"""
+    prepare, run = STAGES[stage](ctx)
+    seconds = []
+    for _ in range(repeat):
+        args = prepare() if prepare is not None else None
+        start = time.perf_counter()
+        run(args)
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment() -> dict:
+    return {
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "openpyxl": openpyxl.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def run_benchmarks(mappings, rows_list, stages, repeat: int = 3, data_dir: str = DEFAULT_DATA_DIR,
+                   format_max_rows: int = 10000, seed: int = 0, on_result=None) -> dict:
+    """
+    在每个 映射规则 × 行数 的合成数据集上运行各阶段，返回可写出为 JSON 的结果。
+
+    Args:
+        mappings: 映射规则 JSON 路径列表。
+        rows_list: 行数列表。
+        stages: 要运行的阶段名（STAGES 的键）。
+        repeat: 每个阶段的重复次数。
+        data_dir: 合成数据的缓存目录。
+        format_max_rows: format_excel 阶段只在行数不超过该值时运行。
+        on_result: 可选回调 on_result(结果项)，每完成一个阶段调用一次。
+    """
+    results = []
+    for mapping_path in mappings:
+        for rows in rows_list:
+            dataset = generate_dataset(mapping_path, rows, data_dir, seed=seed)
+            with tempfile.TemporaryDirectory(prefix="salary-bench-") as work_dir:
+                ctx = DatasetContext(dataset, work_dir)
+                for stage in stages:
+                    if stage == "format_excel" and rows > format_max_rows:
+                        continue
+                    seconds = time_stage(ctx, stage, repeat)
+                    median = statistics.median(seconds)
+                    item = {
+                        "dataset": dataset.name,
+                        "rows": rows,
+                        "source_files": len(dataset.sources),
+                        "stage": stage,
+                        "repeat": repeat,
+                        "seconds": [round(s, 6) for s in seconds],
+                        "min": round(min(seconds), 6),
+                        "median": round(median, 6),
+                        "rows_per_second": round(rows / median, 1) if median > 0 else None,
+                    }
+                    results.append(item)
+                    if on_result is not None:
+                        on_result(item)
+    return {
+        "version": RESULT_VERSION,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "environment": environment(),
+        "results": results,
+    }
+
+
+def compare_results(current: dict, baseline: dict, threshold: float) -> list:
+    """
+    按 (数据集, 行数, 阶段) 对比中位数耗时。
+
+    Returns:
+        [(数据集, 行数, 阶段, 基准中位数, 当前中位数, 比值, 是否退化)]，只包含两边都有的项。
+    """
+    previous = {(r["dataset"], r["rows"], r["stage"]): r for r in baseline.get("results", [])}
+    rows = []
+    for r in current["results"]:
+        base = previous.get((r["dataset"], r["rows"], r["stage"]))
+        if base is None or not base["median"]:
+            continue
+        ratio = r["median"] / base["median"]
+        rows.append((r["dataset"], r["rows"], r["stage"], base["median"], r["median"], ratio, ratio > 1 + threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="处理流程分阶段基准")
+    parser.add_argument("--rows", type=int, nargs="+", default=list(DEFAULT_ROWS), help="源数据总行数，可给出多个")
+    parser.add_argument("--mapping", nargs="+", default=list(DEFAULT_MAPPINGS), help="映射规则 JSON，可给出多个")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES), help="要运行的阶段")
+    parser.add_argument("--repeat", type=int, default=3, help="每个阶段的重复次数")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR, help="合成数据缓存目录")
+    parser.add_argument("--format-max-rows", type=int, default=10000, help="format_excel 阶段的最大行数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="结果 JSON 输出路径")
+    parser.add_argument("--compare", help="与之前保存的结果 JSON 对比")
+    parser.add_argument("--threshold", type=float, default=0.25, help="中位数变慢超过该比例视为退化")
+    args = parser.parse_args()
+
+    # 基准只关心耗时，处理过程中的提示与警告不输出
+    logging.getLogger(LOGGER_NAMESPACE).setLevel(logging.ERROR)
+
+    def report(item):
+        print(f"{item['dataset']:<16} {item['rows']:>8} {item['stage']:<18} "
+              f"中位数 {item['median'] * 1000:>10.1f} ms  最小 {item['min'] * 1000:>10.1f} ms  "
+              f"{item['rows_per_second'] or 0:>12,.0f} 行/秒", flush=True)
+
+    results = run_benchmarks(args.mapping, args.rows, args.stages, repeat=args.repeat, data_dir=args.data_dir,
+                             format_max_rows=args.format_max_rows, seed=args.seed, on_result=report)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"结果已写出: {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        comparison = compare_results(results, baseline, args.threshold)
+        print(f"\n与 {args.compare} (commit {baseline.get('commit')}) 对比:")
+        for dataset, rows, stage, before, after, ratio, regressed in comparison:
+            print(f"{dataset:<16} {rows:>8} {stage:<18} {before * 1000:>10.1f} -> {after * 1000:>10.1f} ms  "
+                  f"{ratio:>6.2f}x{'  退化' if regressed else ''}")
+        if any(row[-1] for row in comparison):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+合成工资数据生成
+
+按映射规则 (config/field_mapping/*.json) 生成与 input/ 下样例形状一致、行数任意的一组输入：
+
+- 源数据表：每个 编制 一个文件，表头在第三行（标题行、单位行之后），
+  含 序号/人员编号/人员姓名/身份列 与规则引用的源字段，人员身份按规则均匀分布，末尾有一行 合计；
+- 扣款表（文件名含 "扣款"）：前两行为空，第三行表头为 人员姓名 + 扣款字段；
+- 导出模板（文件名含 "模板"）：第三行表头为全部目标字段与扣款字段。
+
+扣款字段为规则中名称含 个人缴/所得税/补扣 且不是计算结果的源字段，其余源字段写入源数据表；
+名称含 合计/小计 的字段为同行其他金额字段之和。单元格写入数值而非公式。
+
+同样的参数生成的数据完全相同；生成结果连同参数记录在输出目录的 dataset.json 中，
+参数不变时直接复用已生成的文件。
+
+用法：
+    python benchmarks/payroll_generator.py --mapping config/field_mapping/区聘-原投服-专项.json --rows 10000 -o /tmp/payroll
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+from openpyxl import Workbook
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipeline import IDENTITY_COLUMN_CANDIDATES, load_field_mappings  # noqa: E402
+
+SURNAMES = list("王李张刘陈杨黄赵吴周徐孙马朱胡郭何高林罗")
+GIVEN_NAMES = list("伟芳娜敏静丽强磊军洋勇艳杰娟涛明超秀霞平刚桂英")
+DEPARTMENTS = ["办公室", "预算科", "国库科", "综合科", "政策法规科", "信息中心"]
+# 源数据表中的文本字段及其取值；其余字段按金额生成
+TEXT_FIELD_VALUES = {
+    "身份证": None,  # 按行生成
+    "部门": DEPARTMENTS,
+    "人员职级": ["一级主任科员", "二级主任科员", "四级调研员", "科员", "高级工"],
+    "工资统发": ["是"],
+    "财政供养": ["是"],
+    "工资级别": ["综合一级", "综合二级", "综合三级", "综合四级"],
+    "工资档次": ["一档", "二档", "三档"],
+    "备注": [None],
+}
+DEDUCTION_FIELD_KEYWORDS = ("个人缴", "所得税", "补扣")
+SUM_FIELD_KEYWORDS = ("合计", "小计")
+# 金额字段为空的比例（真实数据中补贴、补发等项目大多为空）
+SPARSE_FIELD_KEYWORDS = ("补发", "补扣", "补贴", "津贴", "奖励", "见习", "信访")
+SPARSE_RATIO = 0.8
+MANIFEST_NAME = "dataset.json"
+# 生成格式变化时递增，旧的生成结果不再复用
+GENERATOR_VERSION = 1
+
+
+class MappingLayout:
+    """
+    从映射规则推出的文件结构。
+
+    Attributes:
+        identity_key: 规则中用于匹配的键（人员身份 / 岗位类别）。
+        groups: {编制: [该编制下的身份值]}，每个编制生成一个源数据表。
+        source_fields: 源数据表中（除 序号/人员编号/人员姓名/身份列 外）的字段。
+        deduction_fields: 扣款表中的扣款字段。
+        template_fields: 导出模板的字段。
+    """
+
+    def __init__(self, field_mappings: list):
+        self.identity_key = next((key for key in IDENTITY_COLUMN_CANDIDATES if any(key in rule for rule in field_mappings)), None)
+        if self.identity_key is None:
+            raise ValueError(f"映射规则中没有 {list(IDENTITY_COLUMN_CANDIDATES)}")
+        self.groups = {}
+        simple_sources, complex_sources, targets, calculated = {}, {}, {}, set()
+        for rule in field_mappings:
+            self.groups.setdefault(rule.get("编制", "全部"), []).append(rule[self.identity_key])
+            for mapping in rule.get("mappings", []):
+                targets[mapping["target_field"]] = None
+                if "source_field" in mapping:
+                    simple_sources[mapping["source_field"]] = None
+                else:
+                    complex_sources.update(dict.fromkeys(mapping["source_fields"]))
+                    calculated.add(mapping["target_field"])
+
+        fixed = {"序号", "人员编号", "人员姓名", self.identity_key}
+        self.deduction_fields = [field for field in {**simple_sources, **complex_sources}
+                                 if field not in calculated and any(k in field for k in DEDUCTION_FIELD_KEYWORDS)]
+        self.source_fields = [field for field in {**simple_sources, **complex_sources}
+                              if field not in fixed and field not in targets and field not in self.deduction_fields]
+        # 简单映射中源字段与目标字段同名的（如 人员姓名、工资级别）
+        self.source_fields += [field for field in simple_sources
+                               if field in targets and field not in fixed and field not in self.source_fields]
+        self.template_fields = ["序号", "人员编号"] + [field for field in targets if field not in self.deduction_fields]
+        self.template_fields += [field for field in self.deduction_fields if field not in self.template_fields]
+
+
+def _person_names(start: int, count: int, rng) -> list:
+    # 姓名 + 序号保证唯一，扣款表按姓名精确匹配
+    surnames = rng.choice(SURNAMES, count)
+    given = rng.choice(GIVEN_NAMES, count)
+    return [f"{s}{g}{start + i}" for i, (s, g) in enumerate(zip(surnames, given))]
+
+
+def _money(rng, count: int, field: str) -> np.ndarray:
+    values = rng.integers(100, 6000, count).astype(float)
+    if any(keyword in field for keyword in SPARSE_FIELD_KEYWORDS):
+        values[rng.random(count) < SPARSE_RATIO] = np.nan
+    return values
+
+
+def _source_columns(layout: MappingLayout, identities: list, start: int, count: int, rng) -> dict:
+    columns = {
+        "序号": np.arange(1, count + 1),
+        "人员编号": [f"{start + i:06d}" for i in range(count)],
+        "人员姓名": _person_names(start, count, rng),
+        layout.identity_key: rng.choice(identities, count),
+    }
+    money = {}
+    for field in layout.source_fields:
+        if field in TEXT_FIELD_VALUES:
+            choices = TEXT_FIELD_VALUES[field]
+            columns[field] = ([f"5101{rng.integers(10 ** 13, 10 ** 14)}" for _ in range(count)]
+                              if choices is None else rng.choice(np.array(choices, dtype=object), count))
+        elif not any(keyword in field for keyword in SUM_FIELD_KEYWORDS):
+            money[field] = _money(rng, count, field)
+    total = np.nansum(np.column_stack(list(money.values())), axis=1) if money else np.zeros(count)
+    for field in layout.source_fields:
+        if field not in columns:
+            columns[field] = money.get(field, total)
+    return columns
+
+
+def _cell(value):
+    if isinstance(value, (np.floating, float)):
+        if np.isnan(value):
+            return None
+        return int(value) if float(value).is_integer() else float(value)
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+
+def _write_sheet(path: str, header_rows: list, header: list, columns: dict, footer_rows=()) -> None:
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    for row in header_rows:
+        ws.append(row)
+    ws.append(header)
+    data = [columns[field] for field in header]
+    for row in zip(*data):
+        ws.append([_cell(value) for value in row])
+    for row in footer_rows:
+        ws.append(row)
+    wb.save(path)
+
+
+def _title_rows(title: str, width: int) -> list:
+    unit_row = ["单位名称：合成数据单位"] + [None] * (width - 1)
+    if width > 6:
+        unit_row[6] = "单位：元"
+    return [[title] + [None] * (width - 1), unit_row]
+
+
+class SyntheticDataset:
+    """
+    一组已生成的输入文件。
+
+    Attributes:
+        name: 数据集名称（映射规则文件名）。
+        rows: 源数据总行数（不含合计行）。
+        sources: 源数据表路径列表。
+        deduction / template: 扣款表与导出模板路径。
+        mapping_path: 映射规则 JSON 路径。
+        identity_column: 规则匹配字段。
+    """
+
+    def __init__(self, name, rows, sources, deduction, template, mapping_path, identity_column, directory):
+        self.name = name
+        self.rows = rows
+        self.sources = sources
+        self.deduction = deduction
+        self.template = template
+        self.mapping_path = mapping_path
+        self.identity_column = identity_column
+        self.directory = directory
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "rows": self.rows, "sources": self.sources, "deduction": self.deduction,
+                "template": self.template, "mapping_path": self.mapping_path, "identity_column": self.identity_column}
+
+
+def generate_dataset(mapping_path: str, rows: int, out_dir: str, seed: int = 0, extra_columns: int = 0,
+                     typo_ratio: float = 0.0, reuse: bool = True) -> SyntheticDataset:
+    """
+    按映射规则生成一组输入文件，写入 out_dir/<规则名>-<行数>/。
+
+    Args:
+        mapping_path: 映射规则 JSON 路径。
+        rows: 源数据总行数，平均分配到各 编制 的源数据表。
+        out_dir: 输出根目录。
+        seed: 随机种子。
+        extra_columns: 源数据表中额外添加的、没有被规则引用的金额列数（模拟更宽的原始表）。
+        typo_ratio: 扣款表中姓名被改动一个字的比例，用于测试非精确匹配。
+        reuse: 目录中已有相同参数生成的文件时直接复用。
+    """
+    name = os.path.splitext(os.path.basename(mapping_path))[0]
+    directory = os.path.join(out_dir, f"{name}-{rows}")
+    params = {"generator": GENERATOR_VERSION, "mapping_path": os.path.abspath(mapping_path), "rows": rows, "seed": seed,
+              "extra_columns": extra_columns, "typo_ratio": typo_ratio}
+    manifest_path = os.path.join(directory, MANIFEST_NAME)
+    if reuse and os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("params") == params and all(os.path.exists(p) for p in manifest["dataset"]["sources"]):
+            return SyntheticDataset(directory=directory, **manifest["dataset"])
+
+    layout = MappingLayout(load_field_mappings(mapping_path))
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    group_rows = np.diff(np.linspace(0, rows, len(layout.groups) + 1).astype(int))
+
+    sources = []
+    names = []
+    start = 0
+    for (group, identities), count in zip(layout.groups.items(), group_rows):
+        columns = _source_columns(layout, identities, start, int(count), rng)
+        header = ["序号", "人员编号", "人员姓名", layout.identity_key] + layout.source_fields
+        for i in range(extra_columns):
+            header.append(f"其他项目{i + 1}")
+            columns[header[-1]] = _money(rng, int(count), header[-1])
+        # 末尾的合计行按身份列过滤
+        total_row = [None] * len(header)
+        total_row[header.index(layout.identity_key)] = "合计"
+        path = os.path.join(directory, f"{group}.xlsx")
+        _write_sheet(path, _title_rows("合成数据 工资发放表", len(header)), header, columns, footer_rows=[total_row])
+        sources.append(path)
+        names.extend(columns["人员姓名"])
+        start += int(count)
+
+    deduction_names = list(names)
+    if typo_ratio > 0:
+        for i in np.flatnonzero(rng.random(len(names)) < typo_ratio):
+            name_i = deduction_names[i]
+            deduction_names[i] = rng.choice(SURNAMES) + name_i[1:]
+    deductions = {"人员姓名": deduction_names}
+    for field in layout.deduction_fields:
+        values = np.round(rng.random(len(names)) * 1500, 2)
+        if "补扣" in field:
+            values[rng.random(len(names)) < SPARSE_RATIO] = np.nan
+        deductions[field] = values
+    deduction_header = ["人员姓名"] + layout.deduction_fields
+    deduction_path = os.path.join(directory, f"{name}-扣款明细.xlsx")
+    _write_sheet(deduction_path, [[], []], deduction_header, deductions)
+
+    template_path = os.path.join(directory, f"{name}-导出模板.xlsx")
+    _write_sheet(template_path, _title_rows("合成数据 工资发放表（实发）", len(layout.template_fields)),
+                 layout.template_fields, {field: [] for field in layout.template_fields})
+
+    dataset = SyntheticDataset(name, rows, sources, deduction_path, template_path, os.path.abspath(mapping_path),
+                               layout.identity_key, directory)
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump({"params": params, "dataset": dataset.to_dict()}, f, ensure_ascii=False, indent=2)
+    return dataset
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按映射规则生成合成工资数据")
+    parser.add_argument("--mapping", default="config/field_mapping/公务员-参公-事业.json", help="映射规则 JSON")
+    parser.add_argument("--rows", type=int, default=1000, help="源数据总行数")
+    parser.add_argument("-o", "--out-dir", default="benchmarks/data", help="输出根目录")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--extra-columns", type=int, default=0, help="源数据表中不被规则引用的额外金额列数")
+    parser.add_argument("--typo-ratio", type=float, default=0.0, help="扣款表中姓名带错字的比例")
+    args = parser.parse_args()
+
+    dataset = generate_dataset(args.mapping, args.rows, args.out_dir, seed=args.seed,
+                               extra_columns=args.extra_columns, typo_ratio=args.typo_ratio)
+    print(json.dumps(dataset.to_dict(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -15,483 +15,890 @@
 
 import pandas as pd
 import numpy as np
+import logging
 import re
 import os
+import json
+import threading
+from collections import OrderedDict
 from datetime import datetime
-from openpyxl import load_workbook
-from openpyxl.styles import PatternFill, Font
-from openpyxl.utils import get_column_letter
+from functools import lru_cache
+
+from font_resolver import column_char_widths
+from formula_engine import CalculationPlan
+from input_cache import combine_digests, content_digest
+from key_matching import MATCH_EXACT, KeyMatcher, composite_key, display_key, normalize_key
+from log_config import get_logger, preview
+from workbook_reader import WorkbookSnapshot, WorkbookStream, row_has_keyword
+
+logger = get_logger(__name__)
 
 # --- 1. 字段映射加载 ---
-def get_identity_mapping_rules(identity_value: str, field_mappings: list, rule_identity_key: str) -> dict:
-    """
-    根据给定的值和规则中的键，从字段映射列表中查找匹配的规则。
+# 规则中用于按人员姓名匹配的键 (对应规则里的 persons 列表)
+PERSON_IDENTITY_KEYS = ("persons", "人员姓名", "姓名")
+# 字段映射列计划的缓存条数，键为 (规则哈希, 规则标识键, 标识值, 源表头签名)
+COLUMN_PLAN_CACHE_SIZE = 1024
+_column_plans = OrderedDict()
+_column_plans_lock = threading.Lock()
 
-    Args:
-        identity_value: 从源数据中获取的用于匹配的值。
-        field_mappings: 包含所有映射规则的列表。
-        rule_identity_key: 在映射规则字典中用于匹配的键名。
 
-    Returns:
-        匹配的规则字典，如果未找到则返回空字典。
+class RuleRegistry:
     """
-    for rule in field_mappings:
-        # 使用传入的 rule_identity_key 进行匹配
-        if rule.get(rule_identity_key) == identity_value:
+    字段映射规则注册表。
+
+    从映射 JSON 的 field_mappings 列表一次性构建，按规则顶层的每个标识键
+    (编制、岗位类别、人员身份 等) 以及 persons 中的人员姓名建立哈希索引，
+    查找为 O(1)，替代对规则列表的逐条线性扫描。
+    同一标识值对应多条规则时，与原线性扫描一致，取列表中第一条。
+    """
+
+    def __init__(self, field_mappings: list):
+        self.field_mappings = list(field_mappings or [])
+        self._index = {}         # {规则标识键: {标识值(str): 规则}}
+        self._person_index = {}  # {人员姓名(str): 规则}
+        self._resolved = {}      # {(规则标识键, 标识值): lookup 返回的规则字典}
+        self._digest = None
+        for rule in self.field_mappings:
+            if not isinstance(rule, dict):
+                continue
+            for key, value in rule.items():
+                if key in ("mappings", "persons") or isinstance(value, (list, dict)) or value is None:
+                    continue
+                self._index.setdefault(key, {}).setdefault(str(value), rule)
+            for person in rule.get("persons") or []:
+                self._person_index.setdefault(str(person), rule)
+
+    @classmethod
+    def ensure(cls, field_mappings) -> "RuleRegistry":
+        """已是注册表则原样返回，否则由规则列表构建。"""
+        if isinstance(field_mappings, cls):
+            return field_mappings
+        return cls(field_mappings)
+
+    def __len__(self) -> int:
+        return len(self.field_mappings)
+
+    def __iter__(self):
+        return iter(self.field_mappings)
+
+    @property
+    def digest(self) -> str:
+        """规则内容的哈希，作为快照、缓存键的一部分（规则变化后旧结果自动失效）。"""
+        if self._digest is None:
+            text = json.dumps(self.field_mappings, ensure_ascii=False, sort_keys=True, default=str)
+            self._digest = content_digest(text.encode("utf-8"))
+        return self._digest
+
+    def identity_keys(self) -> list:
+        """返回所有可用于匹配的规则标识键。"""
+        keys = list(self._index.keys())
+        if self._person_index:
+            keys.append("persons")
+        return keys
+
+    def identity_values(self, rule_identity_key: str) -> list:
+        """返回某个规则标识键下的全部标识值 (按规则出现顺序)。"""
+        if rule_identity_key in PERSON_IDENTITY_KEYS:
+            return list(self._person_index.keys())
+        return list(self._index.get(rule_identity_key, {}).keys())
+
+    def find_rule(self, identity_value, rule_identity_key: str):
+        """返回匹配的原始规则字典，未找到时返回 None。"""
+        if rule_identity_key in PERSON_IDENTITY_KEYS and rule_identity_key not in self._index:
+            return self._person_index.get(str(identity_value))
+        return self._index.get(rule_identity_key, {}).get(str(identity_value))
+
+    def lookup(self, identity_value: str, rule_identity_key: str) -> dict:
+        """
+        按标识值查找规则，返回结构与 get_identity_mapping_rules 相同。
+
+        Args:
+            identity_value: 从源数据中获取的用于匹配的值。
+            rule_identity_key: 在映射规则字典中用于匹配的键名。
+
+        Returns:
+            匹配的规则字典，如果未找到则返回空字典。
+        """
+        cache_key = (rule_identity_key, identity_value)
+        if cache_key in self._resolved:
+            return self._resolved[cache_key]
+        rule = self.find_rule(identity_value, rule_identity_key)
+        if rule is None:
+            result = {}
+        else:
             # 确保返回的字典结构符合预期 (至少包含 mappings)
-            return {
+            result = {
                 "编制": rule.get("编制", ""), # 保留其他可能的键，提供默认值
                 "人员身份": rule.get("人员身份", ""),
                 "岗位类别": rule.get("岗位类别", ""),
-                # ... 可以添加其他可能在 rule 顶层存在的键 ...
                 rule_identity_key: identity_value, # 确保匹配上的键值对在结果中
                 "mappings": rule.get("mappings", []) # 必须有 mappings
             }
-    # print(f"DEBUG: No rule found for key '{rule_identity_key}' with value '{identity_value}'")
-    return {}
+        self._resolved[cache_key] = result
+        return result
+
+    def column_plan(self, identity_value: str, rule_identity_key: str, columns) -> "ColumnPlan":
+        """
+        按标识值查找规则并返回其对源表头 columns 的 ColumnPlan；未找到规则时返回 None。
+
+        计划按 (规则哈希, 规则标识键, 标识值, 源表头签名) 缓存在进程内，规则文件与表头不变时
+        跨源文件、跨块与多次运行都只编译一次。
+        """
+        mapping_rules = self.lookup(identity_value, rule_identity_key)
+        if not mapping_rules:
+            return None
+        key = (self.digest, rule_identity_key, identity_value, header_signature(columns))
+        with _column_plans_lock:
+            plan = _column_plans.get(key)
+            if plan is not None:
+                _column_plans.move_to_end(key)
+                return plan
+        plan = ColumnPlan(mapping_rules, columns)
+        with _column_plans_lock:
+            _column_plans[key] = plan
+            while len(_column_plans) > COLUMN_PLAN_CACHE_SIZE:
+                _column_plans.popitem(last=False)
+        return plan
+
+    def target_fields(self) -> set:
+        """返回所有规则中定义过的目标字段。"""
+        return {
+            mapping["target_field"]
+            for rule in self.field_mappings
+            for mapping in rule.get("mappings", [])
+            if mapping.get("target_field")
+        }
+
+
+def get_identity_mapping_rules(identity_value: str, field_mappings, rule_identity_key: str) -> dict:
+    """
+    根据给定的值和规则中的键，从字段映射列表中查找匹配的规则。
+
+    Args:
+        identity_value: 从源数据中获取的用于匹配的值。
+        field_mappings: 包含所有映射规则的列表，或已构建的 RuleRegistry。
+        rule_identity_key: 在映射规则字典中用于匹配的键名。
+
+    Returns:
+        匹配的规则字典，如果未找到则返回空字典。
+    """
+    # 批量查找时请直接复用 RuleRegistry，避免每次调用都重建索引
+    return RuleRegistry.ensure(field_mappings).lookup(identity_value, rule_identity_key)
 
 # --- 2. 字段转换 ---
-def apply_field_mapping(df: pd.DataFrame, mapping_rules: dict) -> pd.DataFrame:
-    # print(f"DEBUG: apply_field_mapping called...") # Reduced verbosity
-    result_df = pd.DataFrame()
-    mappings = mapping_rules.get("mappings", [])
-
-    # --- 新增：收集所有复杂计算需要的源字段 --- #
-    complex_source_fields = set()
-    for mapping in mappings:
-        if "source_fields" in mapping:
-            complex_source_fields.update(mapping["source_fields"])
-    print(f"DEBUG: apply_field_mapping - Complex source fields needed: {complex_source_fields}")
-    # --- 结束新增 --- #
-
-    for mapping in mappings:
-        target = mapping.get("target_field")
-        if target is None: continue
-
-        if "source_field" in mapping:
+def header_signature(columns) -> str:
+    """源表头（列名及顺序）的签名，作为列计划缓存键的一部分。"""
+    return combine_digests("header", tuple(columns))
+
+
+class ColumnPlan:
+    """
+    一条映射规则对某一源表头编译出的列计划，执行时只需一次列选择：
+
+    - 简单映射：源字段 → 目标字段的重命名（同一目标多次出现时保留首次的位置、以最后一次为准）；
+    - 源字段不在表头中的简单映射：目标列置为空 (NaN)；
+    - 规则中的静态字段（编制、人员身份 等）：常量列；
+    - 复杂计算需要的源字段：原样保留，供后续计算使用（扣款字段通常在合并扣款时补齐）。
+
+    输出的列、顺序与类型与逐项构建结果的做法一致。
+
+    Attributes:
+        columns: 输出列名（按输出顺序）。
+        selected: [(源表头中的位置, 输出列名)]，从源表选取的列。
+        constants: {列名: 值}，规则中的静态字段。
+        missing_sources: [(源字段, 目标字段)]，表头中没有源字段的简单映射。
+        missing_complex_sources: 表头中没有的复杂计算源字段。
+    """
+
+    def __init__(self, mapping_rules: dict, columns):
+        mappings = mapping_rules.get("mappings", [])
+        # 使用 dict 保持字段首次出现的顺序，保证输出列顺序稳定
+        complex_source_fields = {}
+        for mapping in mappings:
+            if "source_fields" in mapping:
+                complex_source_fields.update(dict.fromkeys(mapping["source_fields"]))
+
+        positions = {}
+        for position, column in enumerate(columns):
+            positions.setdefault(column, position)
+        targets = {}  # {目标字段: 源字段在表头中的位置，缺失为 None}
+        self.missing_sources = []
+        for mapping in mappings:
+            target = mapping.get("target_field")
+            if target is None or "source_field" not in mapping:
+                continue
             source = mapping["source_field"]
-            if source in df.columns:
-                 result_df[target] = df[source]
-            else:
-                 print(f"Warning: Simple mapping source field '{source}' not found in input df for target '{target}'. Setting target to NaN.")
-                 result_df[target] = np.nan # Set target to NaN if source is missing
-        elif "source_fields" in mapping:
-            # Defer calculation, but ensure target column might be created later if needed.
-            # No action needed here now, source fields will be preserved below.
-            pass
-
-    # Add static fields from the rule (e.g., '编制', '人员身份')
-    for key, value in mapping_rules.items():
-        if key not in ["mappings", "persons"] + list(complex_source_fields): # Avoid overwriting complex sources if rule has same key
-             if key not in result_df.columns:
-                  result_df[key] = value
-
-    # --- 新增：确保复杂计算需要的原始源字段被保留 --- #
-    print(f"DEBUG: apply_field_mapping - Checking preservation for {len(complex_source_fields)} complex source fields...")
-    preserved_count = 0
-    already_present_count = 0
-    missing_from_input_count = 0
-    for field_name in complex_source_fields:
-        if field_name not in result_df.columns:
-            if field_name in df.columns:
-                result_df[field_name] = df[field_name]
-                preserved_count += 1
-                # print(f"DEBUG: Preserving complex source field '{field_name}' from input df.")
+            targets[target] = positions.get(source)
+            if targets[target] is None:
+                self.missing_sources.append((source, target))
+
+        self.constants = {}
+        for key, value in mapping_rules.items():
+            # 不覆盖同名的目标字段与复杂计算源字段
+            if key not in ("mappings", "persons") and key not in complex_source_fields and key not in targets:
+                self.constants[key] = value
+
+        preserved = {}
+        self.missing_complex_sources = []
+        for field_name in complex_source_fields:
+            if field_name in targets or field_name in self.constants:
+                continue
+            if field_name in positions:
+                preserved[field_name] = positions[field_name]
             else:
-                 # This case should be rare if the source file is consistent, but good to log.
-                 print(f"Warning: Complex source field '{field_name}' needed for later calculation was NOT found in the input df columns: {df.columns.tolist()}")
-                 missing_from_input_count += 1
+                self.missing_complex_sources.append(field_name)
+
+        self.columns = list(targets) + list(self.constants) + list(preserved)
+        self.selected = [(position, target) for target, position in targets.items() if position is not None]
+        self.selected += [(position, field_name) for field_name, position in preserved.items()]
+        # 有简单映射的源字段在表头中时（即使之后被同名目标的缺失映射覆盖为空），结果才有数据行
+        self._reads_source = bool(self.selected) or len(self.missing_sources) < sum(
+            1 for mapping in mappings if mapping.get("target_field") is not None and "source_field" in mapping)
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        """对一块源数据（列与编译时的表头一致）执行计划，返回映射后的 DataFrame。"""
+        for source, target in self.missing_sources:
+            logger.warning("Simple mapping source field '%s' not found in input df for target '%s'. Setting target to NaN.", source, target)
+        if self.missing_complex_sources:
+            logger.debug("Complex source fields needed for later calculation were NOT found in the input df: %s", self.missing_complex_sources)
+        if self.selected:
+            result_df = df.iloc[:, [position for position, _ in self.selected]]
+            result_df.columns = [name for _, name in self.selected]
+            if len(self.selected) != len(self.columns):
+                result_df = result_df.reindex(columns=self.columns)
         else:
-            already_present_count += 1
-            # print(f"DEBUG: Complex source field '{field_name}' already present in result_df.")
-    print(f"DEBUG: apply_field_mapping - Preservation check complete. Preserved: {preserved_count}, Already Present: {already_present_count}, Missing from Input: {missing_from_input_count}")
-    # --- 结束新增 --- #
+            # 没有从源表取到任何列时与逐项构建一致：结果没有数据行
+            result_df = pd.DataFrame(index=df.index if self._reads_source else pd.RangeIndex(0)).reindex(columns=self.columns)
+        for key, value in self.constants.items():
+            result_df[key] = value
+        logger.debug("apply_field_mapping returning columns: %s", self.columns)
+        return result_df
 
-    print(f"DEBUG: apply_field_mapping returning columns: {result_df.columns.tolist()}")
-    return result_df
+
+def apply_field_mapping(df: pd.DataFrame, mapping_rules: dict, plan: ColumnPlan = None) -> pd.DataFrame:
+    """
+    按一条规则转换字段。
+
+    Args:
+        df: 源数据。
+        mapping_rules: 规则字典（get_identity_mapping_rules / RuleRegistry.lookup 的结果）。
+        plan: 预先编译（通常来自 RuleRegistry.column_plan 的缓存）的列计划，须与 df 的表头一致；
+            为 None 时按 df 的表头现场编译。
+    """
+    if plan is None:
+        plan = ColumnPlan(mapping_rules, df.columns)
+    return plan.apply(df)
+
+def apply_field_mapping_by_identity(df: pd.DataFrame, registry, source_identity_column: str, rule_identity_key: str):
+    """
+    按身份值分组后整体应用字段映射，替代逐行构建单行 DataFrame 再拼接的做法。
+
+    源表按 source_identity_column 的取值分组一次，每组只查找一次规则，
+    并对整组行一次性完成列选择与重命名。输出的列、行顺序以及
+    `_匹配字段`/`_匹配规则键` 追溯列与逐行处理的结果一致。
+
+    Args:
+        df: 已过滤合计行的源数据。
+        registry: RuleRegistry 或规则列表。
+        source_identity_column: 源数据中用于匹配规则的列名。
+        rule_identity_key: 映射规则中用于匹配的键名。
+
+    Returns:
+        (映射后的 DataFrame, 未找到规则的身份值集合)。无任何匹配行时返回空 DataFrame。
+    """
+    registry = RuleRegistry.ensure(registry)
+    missing_rule_ids = set()
+    if source_identity_column not in df.columns:
+        return pd.DataFrame(), missing_rule_ids
+
+    identity = df[source_identity_column]
+    valid_mask = identity.notna().to_numpy()
+    df_valid = df.iloc[valid_mask]
+    identity_values = identity.iloc[valid_mask].astype(str)
+
+    # 按身份值首次出现的顺序分组，保证拼接后的列顺序与逐行处理一致
+    group_positions = pd.Series(np.arange(len(identity_values))).groupby(identity_values.to_numpy(), sort=False).indices
+    frames = []
+    frame_positions = []
+    for identity_value, positions in group_positions.items():
+        plan = registry.column_plan(identity_value, rule_identity_key, df_valid.columns)
+        if plan is None:
+            missing_rule_ids.add(identity_value)
+            continue
+        mapping = registry.lookup(identity_value, rule_identity_key)
+        converted = apply_field_mapping(df_valid.iloc[positions], mapping, plan=plan)
+        # 添加匹配时使用的键和值到结果中，便于追溯
+        converted[f'_匹配字段 ({source_identity_column})'] = identity_value
+        converted[f'_匹配规则键 ({rule_identity_key})'] = mapping.get(rule_identity_key)
+        frames.append(converted)
+        frame_positions.append(positions)
+
+    if not frames:
+        return pd.DataFrame(), missing_rule_ids
+
+    combined = pd.concat(frames, ignore_index=True)
+    # 恢复源表中的原始行顺序
+    order = np.argsort(np.concatenate(frame_positions), kind="stable")
+    combined = combined.iloc[order].reset_index(drop=True)
+    return combined, missing_rule_ids
 
 # --- 3. 合并扣款项 ---
+# 扣款表中用于匹配人员的列，按优先级
+DEDUCTION_KEY_COLUMNS = ("人员姓名", "姓名")
+# 合并扣款后追加的追溯列：匹配方式、置信度、非精确匹配时对应的扣款表记录
+MATCH_METHOD_COLUMN = "_扣款匹配方式"
+MATCH_CONFIDENCE_COLUMN = "_扣款匹配置信度"
+MATCH_RECORD_COLUMN = "_扣款匹配记录"
+MATCH_COLUMNS = (MATCH_METHOD_COLUMN, MATCH_CONFIDENCE_COLUMN, MATCH_RECORD_COLUMN)
+
+class MergeStats:
+    """
+    一次扣款合并的匹配统计。
+
+    Attributes:
+        key_columns: 源数据中用于匹配的列。
+        rows: 源数据行数。
+        matched: 匹配到扣款数据的行数。
+        methods: 各匹配方式的行数，如 {"exact": 120, "fuzzy": 1}。
+        unmatched: 未匹配到的关键标识（原始值，去重）。
+        ambiguous: 匹配到扣款表中重复关键标识的值（只使用了第一条扣款记录）。
+    """
+
+    def __init__(self, key_columns, rows: int, matched: int, methods=None, unmatched=(), ambiguous=()):
+        self.key_columns = list(key_columns)
+        self.rows = rows
+        self.matched = matched
+        self.methods = dict(methods or {})
+        self.unmatched = list(unmatched)
+        self.ambiguous = list(ambiguous)
+
+    def to_dict(self) -> dict:
+        return {"key_columns": self.key_columns, "rows": self.rows, "matched": self.matched, "methods": self.methods,
+                "unmatched": self.unmatched, "ambiguous": self.ambiguous}
+
+class DeductionIndex:
+    """
+    按规范化关键标识预先建立索引的扣款表，一次建立，多个源文件共用。
+
+    关键标识可以是多列组合（如 姓名 + 身份证号），匹配规则见 key_matching：
+    精确匹配不上的行依次尝试宽松规范化、部分列与模糊匹配，并记录匹配方式与置信度。
+    重复的关键标识在建立索引时检出并告警，合并时只使用第一条记录，
+    不会像普通的 pd.merge 那样让源数据的行成倍增加。
+
+    Attributes:
+        key_columns: 扣款表中的关键标识列。
+        fields: 可合并的扣款字段。
+        table: 扣款字段，每个关键标识一行（第一条记录）。
+        matcher: 关键列上的 KeyMatcher，行位置与 table 一致。
+        duplicates: 扣款表中重复出现的关键标识（原始值）。
+        fuzzy_threshold: 合并时模糊匹配的最低相似度，None 为 DEFAULT_FUZZY_THRESHOLD，见 KeyMatcher.match。
+        unkeyed: 关键列全部为空、无法参与匹配的扣款记录数（不含空白行）。
+    """
+
+    def __init__(self, deduction_df: pd.DataFrame, key_columns, fields=None, fuzzy_threshold: float = None):
+        self.key_columns = [key_columns] if isinstance(key_columns, str) else list(key_columns)
+        self.fuzzy_threshold = fuzzy_threshold
+        candidates = deduction_df.columns if fields is None else fields
+        self.fields = [f for f in candidates if f not in self.key_columns and f in deduction_df.columns]
+        parts = [normalize_key(deduction_df[col]) for col in self.key_columns]
+        keys = composite_key(parts)
+        # 部分关键列为空的记录也参与匹配（KeyMatcher 按不为空的列查找），只有关键列全部为空的记录无法使用
+        usable = pd.concat(parts, axis=1).notna().any(axis=1).to_numpy()
+        valid = keys.notna().to_numpy()
+        first = usable & ~(valid & keys.duplicated().to_numpy())
+        repeated = valid & keys.duplicated(keep=False).to_numpy()
+        # 关键列为空但有扣款数据的行（不含整行为空或为 0 的空白行）无法合并，告警并计入匹配统计
+        values = deduction_df[self.fields]
+        has_data = (values.notna() & (values != 0)).any(axis=1).to_numpy()
+        self.unkeyed = int((~usable & has_data).sum())
+        if self.unkeyed:
+            logger.warning("扣款表中有 %s 行的关键列 %s 全部为空，无法匹配，未合并这些记录", self.unkeyed, self.key_columns)
+        self.duplicates = sorted({display_key(row) for row in deduction_df.loc[repeated, self.key_columns].itertuples(index=False)})
+        self._duplicate_keys = set(keys[repeated])
+        if self.duplicates:
+            logger.warning("扣款表中 %s 有 %s 个重复值，合并时只使用第一条记录: %s",
+                           self.key_columns, len(self.duplicates), self.duplicates[:10])
+        self.table = deduction_df.loc[first, self.fields].reset_index(drop=True)
+        self.matcher = KeyMatcher(deduction_df.loc[first, self.key_columns])
+        self._records = deduction_df.loc[first, self.key_columns].reset_index(drop=True)
+
+    @classmethod
+    def ensure(cls, deduction, fields=None):
+        """已是 DeductionIndex 则原样返回；否则按 DEDUCTION_KEY_COLUMNS 选择关键列建立索引，没有关键列时返回 None。"""
+        if isinstance(deduction, cls):
+            return deduction
+        key_column = next((col for col in DEDUCTION_KEY_COLUMNS if col in deduction.columns), None)
+        return cls(deduction, key_column, fields) if key_column is not None else None
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def source_key_columns(self, columns) -> list:
+        """
+        与 key_columns 一一对应的源数据列：同名列优先，姓名类关键列可以对应源数据中的另一种姓名列；
+        源数据中没有的为 None。
+        """
+        name_column = next((col for col in DEDUCTION_KEY_COLUMNS if col in columns), None)
+        return [col if col in columns else (name_column if col in DEDUCTION_KEY_COLUMNS else None)
+                for col in self.key_columns]
+
+    def merge(self, source_df: pd.DataFrame, source_key_columns, fields=None, fuzzy_threshold: float = None,
+              claimed: set = None):
+        """
+        把扣款字段合并到源数据（左连接，行数与顺序不变）。
+
+        源数据中已有的字段按扣款表的值覆盖（扣款表为空时保留源数据的值），其余字段追加在末尾；
+        所有字段在一次向量化操作中完成。最后追加匹配方式、置信度与匹配记录三个追溯列。
+
+        Args:
+            source_key_columns: 与 key_columns 一一对应的源数据列名，单列时可以是字符串；
+                为 None 的列不参与匹配。
+            fuzzy_threshold: 模糊匹配的最低相似度，默认为建立索引时指定的值，见 KeyMatcher.match。
+            claimed: 分块合并同一源文件时各块共用的已匹配记录集合，见 KeyMatcher.match。
+
+        Returns:
+            (合并后的 DataFrame, MergeStats)
+        """
+        if isinstance(source_key_columns, str):
+            source_key_columns = [source_key_columns]
+        pairs = [(key, col) for key, col in zip(self.key_columns, source_key_columns) if col is not None]
+        if len(pairs) < len(self.key_columns):
+            logger.warning("源数据中缺少关键列 %s，只按 %s 匹配扣款表",
+                           [key for key, col in zip(self.key_columns, source_key_columns) if col is None],
+                           [key for key, _ in pairs])
+        fields = self.fields if fields is None else [f for f in fields if f in self.table.columns]
+        source_keys = pd.DataFrame({key: source_df[col].to_numpy() for key, col in pairs})
+        if fuzzy_threshold is None:
+            fuzzy_threshold = self.fuzzy_threshold
+        positions, methods, confidence = self.matcher.match(source_keys, fuzzy_threshold, claimed=claimed)
+        matched = positions >= 0
+        # 位置索引上的 reindex：未匹配 (-1) 的行为缺失值，整数列与 pd.merge 一样升为浮点
+        incoming = self.table[fields].reindex(positions)
+        incoming.index = source_df.index
+
+        overlap = [f for f in fields if f in source_df.columns]
+        added = [f for f in fields if f not in source_df.columns]
+        parts = [source_df.drop(columns=overlap)]
+        if overlap:
+            parts.append(incoming[overlap].combine_first(source_df[overlap])[overlap])
+        if added:
+            parts.append(incoming[added])
+        merged = pd.concat(parts, axis=1)[list(source_df.columns) + added]
+        inexact = matched & (methods != MATCH_EXACT)
+        records = np.full(len(merged), None, dtype=object)
+        records[inexact] = [display_key(row) for row in self._records.iloc[positions[inexact]].itertuples(index=False)]
+        merged[MATCH_METHOD_COLUMN] = methods
+        merged[MATCH_CONFIDENCE_COLUMN] = confidence
+        merged[MATCH_RECORD_COLUMN] = records
+
+        source_display = [display_key(row) for row in source_df[[col for _, col in pairs]].itertuples(index=False)]
+        has_key = source_keys.notna().any(axis=1).to_numpy()
+        unmatched = pd.unique(np.asarray(source_display, dtype=object)[~matched & has_key]).tolist()
+        exact_keys = composite_key(normalize_key(source_keys[key]) for key, _ in pairs)
+        ambiguous = (sorted(set(np.asarray(source_display, dtype=object)[exact_keys.isin(self._duplicate_keys).to_numpy() & matched]))
+                     if self._duplicate_keys and len(pairs) == len(self.key_columns) else [])
+        stats = MergeStats([col for _, col in pairs], len(source_df), int(matched.sum()),
+                           pd.Series(methods[matched]).value_counts().to_dict(), unmatched, ambiguous)
+        if ambiguous:
+            logger.warning("以下关键标识在扣款表中有多条记录，只合并了第一条: %s", ambiguous[:10])
+        for row in np.flatnonzero(inexact)[:20]:
+            logger.info("扣款表%s匹配 (置信度 %.2f): %s -> %s", methods[row], confidence[row], source_display[row], records[row])
+        logger.debug("Deduction merge on %s: %s/%s rows matched %s, overlapping fields coalesced: %s",
+                     stats.key_columns, stats.matched, stats.rows, stats.methods, overlap)
+        return merged, stats
+
 def merge_deductions(source_df: pd.DataFrame, deduction_df: pd.DataFrame, deduction_fields: list) -> pd.DataFrame:
-    print("DEBUG: merge_deductions called.")
-    print(f"DEBUG: Source DataFrame columns: {source_df.columns.tolist()}")
-    print(f"DEBUG: Source DataFrame first 5 rows:\n{source_df.head().to_string()}")
-    print(f"DEBUG: Deduction DataFrame columns: {deduction_df.columns.tolist()}")
-    print(f"DEBUG: Deduction DataFrame first 5 rows:\n{deduction_df.head().to_string()}")
-    
-    merged_df = source_df.copy()
-    # --- 动态确定合并列名 (查找在两个表中都存在的列) --- #
+    """
+    按 姓名/人员姓名 把扣款字段合并到源数据：扣款表中的值优先，为空时保留源数据的值。
+    扣款表中没有的扣款字段以空列补齐。
+    """
     possible_key_columns = ["姓名", "人员姓名"] # 优先尝试 '姓名'
-    merge_on_column = None
-    for col in possible_key_columns:
-        # Check if column exists in BOTH dataframes
-        if col in merged_df.columns and col in deduction_df.columns:
-            merge_on_column = col
-            print(f"DEBUG: Found common merge key in both dataframes: '{col}'")
-            print(f"DEBUG: Unique values in source '{col}': {merged_df[col].unique().tolist()}")
-            print(f"DEBUG: Unique values in deduction '{col}': {deduction_df[col].unique().tolist()}")
-            break # Found the best key
-
+    merge_on_column = next((col for col in possible_key_columns if col in source_df.columns and col in deduction_df.columns), None)
     if merge_on_column is None:
-        # Check if key exists in one but not the other
-        source_keys = [k for k in possible_key_columns if k in merged_df.columns]
+        source_keys = [k for k in possible_key_columns if k in source_df.columns]
         deduction_keys = [k for k in possible_key_columns if k in deduction_df.columns]
-        print(f"ERROR: Cannot find a common merge key column. Keys in source: {source_keys}, Keys in deduction: {deduction_keys}. Skipping merge.")
-        return merged_df
-    # --- 结束动态确定 --- #
+        logger.error("Cannot find a common merge key column. Keys in source: %s, Keys in deduction: %s. Skipping merge.", source_keys, deduction_keys)
+        return source_df.copy()
 
     # 确保源 DataFrame 包含所有需要合并的扣款字段，不存在则添加并填充 NaN
-    for field in deduction_fields:
-        if field not in merged_df.columns:
-            print(f"DEBUG: Adding NaN column '{field}' to merged_df before merge.")
-            merged_df[field] = np.nan
-
-    # 只从扣款表中选择 merge_on_column 和指定的扣款字段进行合并
-    columns_to_merge = [merge_on_column] + [field for field in deduction_fields if field in deduction_df.columns]
-    print(f"DEBUG: Columns selected from deduction_df for merge: {columns_to_merge}")
-
-    print(f"DEBUG: Performing merge on '{merge_on_column}'")
-    merged_df = pd.merge(
-        merged_df,
-        deduction_df[columns_to_merge],
-        on=merge_on_column, # <--- 使用动态确定的列名
-        how="left",
-        suffixes=("", "_扣款表")
-    )
-    print(f"DEBUG: Shape after merge: {merged_df.shape}")
-    print(f"DEBUG: Merged DataFrame first 5 rows:\n{merged_df.head().to_string()}")
-
-    # 使用扣款表中的值填充源表中的 NaN 值
-    print("DEBUG: Applying np.where to prioritize deduction values...")
-    for field in deduction_fields:
-         deduction_col_suffixed = f"{field}_扣款表"
-         if deduction_col_suffixed in merged_df.columns:
-             print(f"DEBUG: Processing field '{field}'...")
-             original_col = merged_df[field]
-             deduction_col = merged_df[deduction_col_suffixed]
-             
-             print(f"DEBUG: Original column '{field}' values (first 5):\n{original_col.head().to_string()}")
-             print(f"DEBUG: Deduction column '{field}' values (first 5):\n{deduction_col.head().to_string()}")
-
-             result_col = np.where(
-                 deduction_col.notna(),
-                 deduction_col,
-                 original_col
-             )
-             merged_df[field] = result_col
-             
-             print(f"DEBUG: Result column '{field}' values after merge (first 5):\n{merged_df[field].head().to_string()}")
-             merged_df.drop(columns=[deduction_col_suffixed], inplace=True)
-
-    print(f"DEBUG: merge_deductions returning shape: {merged_df.shape}")
-    print(f"DEBUG: Final DataFrame columns: {merged_df.columns.tolist()}")
-    print(f"DEBUG: Final DataFrame first 5 rows:\n{merged_df.head().to_string()}")
+    missing = [field for field in deduction_fields if field not in source_df.columns]
+    source_df = source_df.assign(**{field: np.nan for field in missing}) if missing else source_df
+    merged_df, _ = DeductionIndex(deduction_df, merge_on_column, deduction_fields).merge(source_df, merge_on_column)
+    logger.debug("merge_deductions returning shape: %s", merged_df.shape)
     return merged_df
 
 # --- 4. 起始行检测与合计过滤 ---
 def detect_data_start_row(df: pd.DataFrame, keyword: str = "人员姓名", max_scan_rows: int = 10) -> int:
-    for i in range(max_scan_rows):
-        row = df.iloc[i].astype(str).tolist()
-        if any(keyword in str(cell) for cell in row):
+    # 关键字匹配逻辑与 WorkbookSnapshot 读取时的表头检测共用
+    for i in range(min(max_scan_rows, len(df))):
+        if row_has_keyword(df.iloc[i].dropna().tolist(), keyword):
             return i
     raise ValueError(f"未找到字段 '{keyword}' 所在行")
 
-# --- 5. 批量处理函数 ---
-def process_sheet(file_path: str, deduction_df: pd.DataFrame, field_mappings: list, selected_deduction_fields: list, source_identity_column: str, rule_identity_key: str) -> pd.DataFrame:
-    print(f"DEBUG: process_sheet called for file: {os.path.basename(file_path)}")
-    print(f"DEBUG: Using source identity column: '{source_identity_column}', rule identity key: '{rule_identity_key}'")
-    try:
-        preview = pd.read_excel(file_path, nrows=10, header=None)
-        header_row = detect_data_start_row(preview, keyword=source_identity_column)
-        print(f"DEBUG: Detected header row: {header_row}")
-        df = pd.read_excel(file_path, skiprows=header_row + 1, header=None)
-        df.columns = preview.iloc[header_row].tolist()
-        print(f"DEBUG: Read source data, shape: {df.shape}")
-
-        # 过滤掉合计/汇总行 (使用 source_identity_column 检查可能更可靠？取决于该列是否包含这些词)
-        # 暂时保留对 人员身份 的检查，如果 source_identity_column 不同，可能需要调整
-        filter_col = source_identity_column if source_identity_column in df.columns else "人员身份" # 回退到 人员身份
-        if filter_col in df.columns:
-            rows_before_filter = len(df)
-            df = df[~df[filter_col].astype(str).str.contains("合计|汇总|总计|备注|说明", na=False)]
-            print(f"DEBUG: Filtered rows based on '{filter_col}'. Shape before: {rows_before_filter}, after: {len(df)}")
-        else:
-            print(f"Warning: Cannot apply filter row logic as column '{filter_col}' not found.")
+def source_frame_key(source_digest: str, source_identity_column: str) -> str:
+    """源数据快照的键：表头检测依赖于标识列，因此与文件内容哈希一起组成键。"""
+    return combine_digests("source", source_digest, source_identity_column)
+
+def _digest_source(source) -> str:
+    if isinstance(source, (bytes, bytearray)) or hasattr(source, "getvalue"):
+        return content_digest(source)
+    with open(source, "rb") as f:
+        return content_digest(f.read())
+
+def filter_summary_rows(df: pd.DataFrame, source_identity_column: str) -> pd.DataFrame:
+    """过滤掉合计/汇总/备注等非人员行。"""
+    # 过滤掉合计/汇总行 (使用 source_identity_column 检查可能更可靠？取决于该列是否包含这些词)
+    # 暂时保留对 人员身份 的检查，如果 source_identity_column 不同，可能需要调整
+    filter_col = source_identity_column if source_identity_column in df.columns else "人员身份" # 回退到 人员身份
+    if filter_col in df.columns:
+        rows_before_filter = len(df)
+        df = df[~df[filter_col].astype(str).str.contains("合计|汇总|总计|备注|说明", na=False)]
+        logger.debug("Filtered rows based on '%s'. Shape before: %s, after: %s", filter_col, rows_before_filter, len(df))
+    else:
+        logger.warning("Cannot apply filter row logic as column '%s' not found.", filter_col)
+    return df
+
+def load_source_frame(source, source_identity_column: str, snapshot_store=None,
+                      unit_name: str = "", salary_month: str = "", source_digest: str = None) -> pd.DataFrame:
+    """
+    读取源工资表：检测表头行、过滤合计/汇总行。
 
-        results = []
-        processed_ids = set()
-        missing_rule_ids = set()
+    Args:
+        source: 文件路径、bytes、上传文件对象或已读取的 WorkbookSnapshot。
+        source_identity_column: 用于检测表头行与过滤合计行的标识列。
+        snapshot_store: SnapshotStore，提供时先尝试读取已保存的快照，未命中时解析后保存。
+        unit_name / salary_month: 快照的单位名称与工资月份 (YYYYMM)。
+        source_digest: 已知的源文件内容哈希；source 为 WorkbookSnapshot 时必须提供才能使用快照。
 
-        print(f"DEBUG: Starting row-by-row processing using '{source_identity_column}' for identity...")
-        for index, row in df.iterrows():
-            identity_value = row.get(source_identity_column)
-            if pd.isna(identity_value):
-                continue
-            identity_value = str(identity_value)
-            # print(f"DEBUG: Processing row index {index}, identity_value: '{identity_value}'") # Commented out
+    Returns:
+        过滤后的源数据。
+    """
+    snapshot_key = None
+    if snapshot_store is not None and snapshot_store.available:
+        if source_digest is None and not isinstance(source, WorkbookSnapshot):
+            source_digest = _digest_source(source)
+        if source_digest is not None:
+            snapshot_key = source_frame_key(source_digest, source_identity_column)
+            df = snapshot_store.load("source", unit_name, salary_month, snapshot_key)
+            if df is not None:
+                logger.debug("Loaded source frame from snapshot, shape: %s", df.shape)
+                return df
+
+    # 工作簿只解析一次：表头检测与数据读取都基于同一快照
+    snapshot = WorkbookSnapshot.ensure(source, header_keywords=(source_identity_column,), max_scan_rows=10)
+    header_row = snapshot.detect_header_row(source_identity_column, max_scan_rows=10)
+    logger.debug("Detected header row: %s", header_row)
+    df = snapshot.data_frame(header_row)
+    logger.debug("Read source data, shape: %s", df.shape)
+
+    df = filter_summary_rows(df, source_identity_column)
+
+    if snapshot_key is not None:
+        snapshot_store.save(df, "source", unit_name, salary_month, snapshot_key,
+                            extra={"file_name": snapshot.name, "header_row": header_row})
+    return df
 
-            processed_ids.add(identity_value)
-            mapping = get_identity_mapping_rules(identity_value, field_mappings, rule_identity_key)
-            if not mapping:
-                missing_rule_ids.add(identity_value)
-                continue
-            # print(f"DEBUG: Found mapping rule for '{identity_value}'")
+# --- 5. 批量处理函数 ---
+def mapped_frame_key(source_digest: str, source_identity_column: str, rule_identity_key: str, registry) -> str:
+    """字段映射结果（合并扣款之前）的键：源文件内容 + 标识列 + 规则内容。与扣款表无关。"""
+    return combine_digests("mapped", source_digest, source_identity_column, rule_identity_key, registry.digest)
 
-            single_df = pd.DataFrame([row])
-            converted = apply_field_mapping(single_df, mapping)
-            # 添加匹配时使用的键和值到结果中，便于追溯
-            converted[f'_匹配字段 ({source_identity_column})'] = identity_value
-            converted[f'_匹配规则键 ({rule_identity_key})'] = mapping.get(rule_identity_key)
-            results.append(converted)
+def load_mapped_frame(file_path, registry, source_identity_column: str, rule_identity_key: str,
+                      snapshot_store=None, unit_name: str = "", salary_month: str = "", source_digest: str = None,
+                      cache=None, on_stage=None) -> pd.DataFrame:
+    """
+    读取源工资表并按身份应用字段映射，返回合并扣款之前的结果。
 
-        if missing_rule_ids:
-             print(f"Warning: No mapping rules found for {rule_identity_key} values: {sorted(list(missing_rule_ids))}")
-
-        if not results:
-            print(f"Warning: No rows processed successfully for file {os.path.basename(file_path)}.")
-            return pd.DataFrame()
-
-        print(f"DEBUG: Concatenating {len(results)} processed rows...")
-        df_combined = pd.concat(results, ignore_index=True)
-        print(f"DEBUG: df_combined shape after concat: {df_combined.shape}")
-
-        # --- 合并扣款数据 ---
-        print("DEBUG: Starting deduction merge...")
-        print(f"DEBUG: Selected deduction fields: {selected_deduction_fields}")
-        print(f"DEBUG: Deduction DataFrame columns: {deduction_df.columns.tolist()}")
-        # print(f"DEBUG: Deduction DataFrame first 5 rows:\\n{deduction_df.head().to_string()}") # Reduce log verbosity
-
-        # 动态查找姓名列
-        possible_name_cols = ["人员姓名", "姓名"]
-        source_name_col = next((col for col in possible_name_cols if col in df_combined.columns), None)
-        deduction_name_col = next((col for col in possible_name_cols if col in deduction_df.columns), None)
-
-        if source_name_col and deduction_name_col:
-            print(f"DEBUG: Found name column in source: '{source_name_col}'")
-            print(f"DEBUG: Found name column in deduction: '{deduction_name_col}'")
-
-            # 准备用于合并的扣款数据副本
-            cols_to_merge = [deduction_name_col] + selected_deduction_fields
-            missing_deduction_fields = [f for f in selected_deduction_fields if f not in deduction_df.columns]
-            if missing_deduction_fields:
-                 print(f"WARNING: The following selected deduction fields are missing from the deduction table: {missing_deduction_fields}")
-                 cols_to_merge = [f for f in cols_to_merge if f in deduction_df.columns] # Only use existing columns
-
-            deduction_df_to_merge = deduction_df[cols_to_merge].copy()
-
-            # 如果姓名列名称不一致，重命名扣款表的列以匹配源表
-            merge_key = source_name_col
-            if source_name_col != deduction_name_col:
-                print(f"DEBUG: Renaming deduction key column '{deduction_name_col}' to '{source_name_col}' for merge.")
-                deduction_df_to_merge.rename(columns={deduction_name_col: source_name_col}, inplace=True)
-
-            print(f"DEBUG: Merging on key: '{merge_key}'")
-            # print(f"DEBUG: Source name values (first 5):\\n{df_combined[source_name_col].head().to_string()}")
-            # print(f"DEBUG: Deduction (to merge) name values (first 5):\\n{deduction_df_to_merge[merge_key].head().to_string()}")
-
-            # 执行合并
-            df_combined = pd.merge(
-                df_combined,
-                deduction_df_to_merge,
-                on=merge_key,
-                how="left"
-                # Consider adding suffixes if other column names might collide, e.g., suffixes=('', '_deduction')
-            )
-            print(f"DEBUG: Shape after merge: {df_combined.shape}")
-            # print(f"DEBUG: Merged DataFrame columns: {df_combined.columns.tolist()}") # Reduce log verbosity
-            # print(f"DEBUG: Merged DataFrame first 5 rows:\\n{df_combined.head().to_string()}") # Reduce log verbosity
-
-            # 检查合并后是否有NaN（如果需要）
-            nan_check_cols = [f for f in selected_deduction_fields if f in df_combined.columns] # Check only merged fields
-            if nan_check_cols:
-                 nan_counts = df_combined[nan_check_cols].isnull().sum()
-                 total_nans = nan_counts.sum()
-                 if total_nans > 0:
-                     print(f"DEBUG: NaN values found after merge (field: count): {nan_counts[nan_counts > 0].to_dict()}")
-                 else:
-                     print(f"DEBUG: No NaN values found in merged deduction columns.")
+    该结果只依赖源文件与映射规则：提供 source_digest 时先查内存缓存 cache（ParsedInputCache），
+    再查 snapshot_store 中的 mapped 快照，都未命中才解析并映射，然后写回两者。
+    修正扣款表后重跑时各源文件直接从这里取结果，只需重新合并与计算。
 
+    Returns:
+        映射后的数据；没有成功映射的行时返回空 DataFrame。
+    """
+    def stage_done(stage, rows):
+        if on_stage is not None:
+            on_stage(stage, rows)
+
+    file_name = getattr(file_path, "name", None) or os.path.basename(file_path)
+    key = mapped_frame_key(source_digest, source_identity_column, rule_identity_key, registry) if source_digest else None
+    use_snapshot = key is not None and snapshot_store is not None and snapshot_store.available
+
+    parsed = False
+
+    def compute():
+        nonlocal parsed
+        if use_snapshot:
+            df_mapped = snapshot_store.load("mapped", unit_name, salary_month, key)
+            if df_mapped is not None:
+                logger.debug("Loaded mapped frame for %s from snapshot, shape: %s", file_name, df_mapped.shape)
+                return df_mapped
+        df = load_source_frame(
+            file_path, source_identity_column,
+            snapshot_store=snapshot_store, unit_name=unit_name, salary_month=salary_month, source_digest=source_digest,
+        )
+        parsed = True
+        stage_done("read", len(df))
+
+        logger.debug("Starting grouped field mapping using '%s' for identity...", source_identity_column)
+        df_mapped, missing_rule_ids = apply_field_mapping_by_identity(df, registry, source_identity_column, rule_identity_key)
+        if missing_rule_ids:
+             logger.warning("No mapping rules found for %s values: %s", rule_identity_key, sorted(list(missing_rule_ids)))
+        if use_snapshot and not df_mapped.empty:
+            snapshot_store.save(df_mapped, "mapped", unit_name, salary_month, key, extra={"file_name": file_name})
+        return df_mapped
+
+    if key is not None and cache is not None:
+        misses = cache.misses
+        df_combined = cache.get_or_compute(key, compute)
+        if cache.misses == misses:
+            logger.debug("Reusing cached mapped frame for %s", file_name)
+    else:
+        df_combined = compute()
+
+    if df_combined.empty:
+        logger.warning("No rows processed successfully for file %s.", file_name)
+        return df_combined
+    logger.debug("df_combined shape after grouped mapping: %s", df_combined.shape)
+    if not parsed:
+        stage_done("read", len(df_combined))
+    stage_done("map", len(df_combined))
+    return df_combined
+
+def merge_and_calculate(df_combined: pd.DataFrame, deduction_df: pd.DataFrame, registry, selected_deduction_fields: list,
+                        source_identity_column: str, rule_identity_key: str, on_stage=None, claimed: set = None) -> pd.DataFrame:
+    """
+    在字段映射结果上合并扣款、执行复杂计算并计算实发工资（依赖扣款表的部分）。
+    on_stage 在 merge / calculate 阶段完成时调用；claimed 见 DeductionIndex.merge（分块处理时使用）。
+    """
+    def stage_done(stage, rows):
+        if on_stage is not None:
+            on_stage(stage, rows)
+
+    # --- 合并扣款数据 ---
+    logger.debug("Starting deduction merge...")
+    logger.debug("Selected deduction fields: %s", selected_deduction_fields)
+    # 扣款表可以是预先建立的 DeductionIndex（多个源文件共用），否则在这里建立
+    deduction_index = DeductionIndex.ensure(deduction_df, selected_deduction_fields)
+
+    source_key_columns = deduction_index.source_key_columns(df_combined.columns) if deduction_index is not None else []
+    if any(col is not None for col in source_key_columns):
+        missing_deduction_fields = [f for f in selected_deduction_fields if f not in deduction_index.fields]
+        if missing_deduction_fields:
+            logger.warning("The following selected deduction fields are missing from the deduction table: %s", missing_deduction_fields)
+        df_combined, merge_stats = deduction_index.merge(df_combined, source_key_columns, selected_deduction_fields,
+                                                         claimed=claimed)
+        logger.debug("Deduction merge on %s <- %s: %s/%s rows matched, unmatched: %s", merge_stats.key_columns,
+                     deduction_index.key_columns, merge_stats.matched, merge_stats.rows, merge_stats.unmatched[:10])
+    else:
+        error_msg = "Cannot perform merge. "
+        if deduction_index is None:
+            error_msg += f"Name column ({'/'.join(DEDUCTION_KEY_COLUMNS)}) not found in deduction data (deduction_df columns: {deduction_df.columns.tolist()})."
         else:
-            error_msg = "ERROR: Cannot perform merge. "
-            if not source_name_col:
-                error_msg += f"Name column ({'/'.join(possible_name_cols)}) not found in source data (df_combined columns: {df_combined.columns.tolist()}). "
-            if not deduction_name_col:
-                error_msg += f"Name column ({'/'.join(possible_name_cols)}) not found in deduction data (deduction_df columns: {deduction_df.columns.tolist()})."
-            print(error_msg)
-            # Consider adding empty columns for selected_deduction_fields if merge fails?
-            # for field in selected_deduction_fields:
-            #     if field not in df_combined.columns:
-            #         df_combined[field] = np.nan
-
-        # --- 应用复杂计算规则 --- #
-        print(f"DEBUG: Applying complex calculations based on field mapping...")
-        all_complex_mappings_details = {}
-        identity_column_for_lookup = f'_匹配字段 ({source_identity_column})'
-        if identity_column_for_lookup in df_combined.columns:
-             unique_identity_values = df_combined[identity_column_for_lookup].unique()
-             print(f"DEBUG: Found {len(unique_identity_values)} unique identity values for rule lookup from column '{identity_column_for_lookup}'")
-        else:
-             print(f"ERROR: Cannot find column '{identity_column_for_lookup}' in df_combined to look up rules. Skipping complex calculations.")
-             unique_identity_values = []
-
-        for identity_value in unique_identity_values:
-                rule = get_identity_mapping_rules(str(identity_value), field_mappings, rule_identity_key)
-                if rule:
-                    for mapping in rule.get("mappings", []):
-                        if "source_fields" in mapping:
-                            target = mapping["target_field"]
-                            if target not in all_complex_mappings_details:
-                                    all_complex_mappings_details[target] = {
-                                        "sources": mapping["source_fields"],
-                                        "calculation": mapping.get("calculation", "sum")
-                                    }
-
-        # --- 添加日志：打印应用复杂计算前的列名 和 '补发工资' 规则细节 ---
-        print(f"DEBUG: Columns available in df_combined *before* applying complex calculations: {df_combined.columns.tolist()}")
-        if '补发工资' in all_complex_mappings_details:
-            print(f"DEBUG: Rule details for '补发工资' from complex mappings: {all_complex_mappings_details['补发工资']}")
-        else:
-            print("DEBUG: No rule details found for '补发工资' in all_complex_mappings_details. It might not be a complex calculation or rule is missing.")
-        # --- 结束添加 ---
-
-        # 定义行计算辅助函数
-        def calculate_row(row, sources, calculation, target):
-            row_info = f"row index {row.name}" if hasattr(row, 'name') else "unknown row"
-            print(f"DEBUG: calculate_row for '{target}', {row_info}")
-
-            # Check for missing source columns *before* trying to access them
-            missing_sources = [s for s in sources if s not in row.index]
-            if missing_sources:
-                print(f"DEBUG: Missing sources for '{target}' in {row_info}: {missing_sources}")
-                return np.nan
-
-            try:
-                # Get only the source values that actually exist in the row
-                existing_sources = [s for s in sources if s in row.index] # Should be all sources now if no missing_sources
-                source_values = row[existing_sources]
-
-                print(f"DEBUG: Source values for '{target}': {source_values.to_dict()}")
-                print(f"DEBUG: Source values types: {source_values.apply(type)}")
-
-                # 尝试转换为数值类型，保留原始值用于调试
-                numeric_sources_nan = source_values.apply(pd.to_numeric, errors='coerce')
-                print(f"DEBUG: After to_numeric(coerce): {numeric_sources_nan.to_dict()}")
-                print(f"DEBUG: NaN values after conversion: {numeric_sources_nan[numeric_sources_nan.isna()].to_dict()}")
-
-                numeric_sources = numeric_sources_nan.fillna(0)
-                print(f"DEBUG: After fillna(0): {numeric_sources.to_dict()}")
-
-                result = np.nan # Default result
-                if calculation == "sum":
-                    result = numeric_sources.sum(skipna=False, min_count=0)
-                    print(f"DEBUG: Sum result for '{target}': {result}")
-
-                elif isinstance(calculation, str):
-                    # This part is less likely for '补发工资' if it's just a sum, but kept for completeness
-                    local_vars = numeric_sources.to_dict()
-                    print(f"DEBUG: Evaluating expression '{calculation}' with variables: {local_vars}")
-                    result = eval(calculation, {"__builtins__": {}}, local_vars)
-                    print(f"DEBUG: Eval result for '{target}': {result}")
-                else:
-                    print(f"Warning: Unsupported calculation type '{calculation}' for target '{target}'")
-
-                # 验证计算结果
-                if pd.isna(result):
-                    print(f"DEBUG: Result is NaN for '{target}' in {row_info}")
-                elif not isinstance(result, (int, float)):
-                    print(f"DEBUG: Result type is {type(result)} for '{target}' in {row_info}")
-
-                return result
-
-            except Exception as e:
-                print(f"ERROR calculating '{target}' for {row_info}:")
-                print(f"  Sources attempted: {sources}")
-                print(f"  Calculation: '{calculation}'")
-                print(f"  Error: {str(e)}")
-                print(f"  Source values (if available): {source_values.to_dict() if 'source_values' in locals() else 'N/A'}")
-                return np.nan
-
-        # 应用计算
-        print(f"DEBUG: Found complex mappings for targets: {list(all_complex_mappings_details.keys())}")
-        for target, details in all_complex_mappings_details.items():
-                print(f"DEBUG: Calculating '{target}' using '{details['calculation']}' on {details['sources']}")
-                df_combined[target] = df_combined.apply(
-                    lambda row: calculate_row(row, details["sources"], details["calculation"], target),
-                    axis=1
-                )
-                # DEBUG: 检查计算结果中 NaN 的数量
-                nan_count = df_combined[target].isnull().sum()
-                if nan_count > 0:
-                    print(f"DEBUG: Column '{target}' calculated with {nan_count} NaN values out of {len(df_combined)}.")
-
-        print("DEBUG: Finished applying complex calculations.")
-        # --- 结束新代码块 ---
-
-        # 计算实发工资，确保应发和扣发合计存在 (扣发合计现在由上面的复杂计算生成)
-        if "应发工资" in df_combined.columns and "扣发合计" in df_combined.columns:
-            try:
-                # 确保应发和扣发是数值，空值填0，并强制为 float 类型
-                yingfa = pd.to_numeric(df_combined["应发工资"], errors='coerce').fillna(0).astype(float)
-                koufa = pd.to_numeric(df_combined["扣发合计"], errors='coerce').fillna(0).astype(float)
-
-                # 显式处理其他补扣
-                if "其他补扣" in df_combined.columns:
-                    other_deductions = pd.to_numeric(df_combined["其他补扣"], errors='coerce').fillna(0).astype(float)
-                else:
-                    # 如果列不存在，创建一个与df_combined长度相同、值为0的Series
-                    other_deductions = pd.Series(0.0, index=df_combined.index) # 使用 0.0 明确为 float
-
-                # --- 调试信息 --- #
-                print("DEBUG: Calculating 实发工资 for first 5 rows:")
-                print(f"  Yingfa (dtype: {yingfa.dtype}):")
-                print(yingfa.head().to_string())
-                print(f"  Koufa (dtype: {koufa.dtype}):")
-                print(koufa.head().to_string())
-                print(f"  Other Deductions (dtype: {other_deductions.dtype}):")
-                print(other_deductions.head().to_string())
-                # --- 结束调试 --- #
-
-                # 核心计算
-                df_combined["实发工资"] = yingfa - koufa - other_deductions
-                print("DEBUG: 实发工资 calculation potentially successful.")
-
-            except Exception as e:
-                print(f"ERROR: Exception during 实发工资 calculation (yingfa - koufa - other): {e}")
-                # 计算失败时，填充 NaN
-                df_combined["实发工资"] = np.nan
-
-        elif "应发工资" in df_combined.columns:
-            try:
-                 # 如果没有扣发，实发=应发 (同样处理空值并强制类型)
-                yingfa = pd.to_numeric(df_combined["应发工资"], errors='coerce').fillna(0).astype(float)
-                print(f"DEBUG: Calculating 实发工资 (only yingfa) for first 5 rows:")
-                print(f"  Yingfa (dtype: {yingfa.dtype}):")
-                print(yingfa.head().to_string())
-                df_combined["实发工资"] = yingfa
-            except Exception as e:
-                print(f"ERROR: Exception during 实发工资 calculation (only yingfa): {e}")
-                df_combined["实发工资"] = np.nan
-        else:
-                # 如果连应发工资都没有
-                print("DEBUG: Yingfa column missing, setting 实发工资 to 0.")
-                df_combined["实发工资"] = 0.0 # 使用 0.0 明确为 float
+            error_msg += f"Key columns {deduction_index.key_columns} not found in source data (df_combined columns: {df_combined.columns.tolist()}). "
+        logger.error(error_msg)
+
+    stage_done("merge", len(df_combined))
+
+    # --- 应用复杂计算规则 --- #
+    logger.debug("Applying complex calculations based on field mapping...")
+    all_complex_mappings_details = {}
+    identity_column_for_lookup = f'_匹配字段 ({source_identity_column})'
+    if identity_column_for_lookup in df_combined.columns:
+         unique_identity_values = df_combined[identity_column_for_lookup].unique()
+         logger.debug("Found %s unique identity values for rule lookup from column '%s'", len(unique_identity_values), identity_column_for_lookup)
+    else:
+         logger.error("Cannot find column '%s' in df_combined to look up rules. Skipping complex calculations.", identity_column_for_lookup)
+         unique_identity_values = []
+
+    for identity_value in unique_identity_values:
+            rule = registry.lookup(str(identity_value), rule_identity_key)
+            if rule:
+                for mapping in rule.get("mappings", []):
+                    if "source_fields" in mapping:
+                        target = mapping["target_field"]
+                        if target not in all_complex_mappings_details:
+                                all_complex_mappings_details[target] = {
+                                    "sources": mapping["source_fields"],
+                                    "calculation": mapping.get("calculation", "sum")
+                                }
+
+    # --- 添加日志：打印应用复杂计算前的列名 和 '补发工资' 规则细节 ---
+    logger.debug("Columns available in df_combined *before* applying complex calculations: %s", df_combined.columns.tolist())
+    if '补发工资' in all_complex_mappings_details:
+        logger.debug("Rule details for '补发工资' from complex mappings: %s", all_complex_mappings_details['补发工资'])
+    else:
+        logger.debug("No rule details found for '补发工资' in all_complex_mappings_details. It might not be a complex calculation or rule is missing.")
+    # --- 结束添加 ---
+
+    # 应用计算：按依赖关系拓扑分层，逐层向量化计算（公式按 (公式, 源字段) 只编译一次）
+    logger.debug("Found complex mappings for targets: %s", list(all_complex_mappings_details.keys()))
+    calculation_plan = CalculationPlan(all_complex_mappings_details)
+    logger.debug("Calculation layers (dependency order): %s", calculation_plan.layers)
+    if calculation_plan.cycles:
+        logger.error("Circular dependency between calculated fields, skipping: %s", calculation_plan.cycles)
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+    for target in calculation_plan if debug_enabled else ():
+        missing_sources = [s for s in calculation_plan.definitions[target]["sources"] if s not in df_combined.columns and s not in calculation_plan.definitions]
+        if missing_sources:
+            logger.debug("Missing sources for '%s': %s", target, missing_sources)
+    evaluated_targets = calculation_plan.evaluate(
+        df_combined,
+        on_error=lambda target, e: logger.error("Calculating '%s' failed: %s", target, e)
+    )
+    for target in evaluated_targets if debug_enabled else ():
+        # DEBUG: 检查计算结果中 NaN 的数量
+        nan_count = df_combined[target].isnull().sum()
+        if nan_count > 0:
+            logger.debug("Column '%s' calculated with %s NaN values out of %s.", target, nan_count, len(df_combined))
+
+    logger.debug("Finished applying complex calculations.")
+    # --- 结束新代码块 ---
+
+    # 计算实发工资，确保应发和扣发合计存在 (扣发合计现在由上面的复杂计算生成)
+    if "应发工资" in df_combined.columns and "扣发合计" in df_combined.columns:
+        try:
+            # 确保应发和扣发是数值，空值填0，并强制为 float 类型
+            yingfa = pd.to_numeric(df_combined["应发工资"], errors='coerce').fillna(0).astype(float)
+            koufa = pd.to_numeric(df_combined["扣发合计"], errors='coerce').fillna(0).astype(float)
+
+            # 显式处理其他补扣
+            if "其他补扣" in df_combined.columns:
+                other_deductions = pd.to_numeric(df_combined["其他补扣"], errors='coerce').fillna(0).astype(float)
+            else:
+                # 如果列不存在，创建一个与df_combined长度相同、值为0的Series
+                other_deductions = pd.Series(0.0, index=df_combined.index) # 使用 0.0 明确为 float
 
-        print(f"DEBUG: Finished calculating 实发工资.")
-        # --- 结束实发工资计算 --- #
+            # --- 调试信息 --- #
+            logger.debug(
+                "Calculating 实发工资 for first 5 rows:\n  Yingfa (dtype: %s):\n%s\n  Koufa (dtype: %s):\n%s\n  Other Deductions (dtype: %s):\n%s",
+                yingfa.dtype, preview(yingfa), koufa.dtype, preview(koufa), other_deductions.dtype, preview(other_deductions),
+            )
+            # --- 结束调试 --- #
+
+            # 核心计算
+            df_combined["实发工资"] = yingfa - koufa - other_deductions
+            logger.debug("实发工资 calculation potentially successful.")
+
+        except Exception as e:
+            logger.error("Exception during 实发工资 calculation (yingfa - koufa - other): %s", e)
+            # 计算失败时，填充 NaN
+            df_combined["实发工资"] = np.nan
+
+    elif "应发工资" in df_combined.columns:
+        try:
+             # 如果没有扣发，实发=应发 (同样处理空值并强制类型)
+            yingfa = pd.to_numeric(df_combined["应发工资"], errors='coerce').fillna(0).astype(float)
+            logger.debug("Calculating 实发工资 (only yingfa) for first 5 rows:\n  Yingfa (dtype: %s):\n%s", yingfa.dtype, preview(yingfa))
+            df_combined["实发工资"] = yingfa
+        except Exception as e:
+            logger.error("Exception during 实发工资 calculation (only yingfa): %s", e)
+            df_combined["实发工资"] = np.nan
+    else:
+            # 如果连应发工资都没有
+            logger.debug("Yingfa column missing, setting 实发工资 to 0.")
+            df_combined["实发工资"] = 0.0 # 使用 0.0 明确为 float
+
+    logger.debug("Finished calculating 实发工资.")
+    # --- 结束实发工资计算 --- #
+
+    logger.debug("merge_and_calculate returning final shape: %s", df_combined.shape)
+    stage_done("calculate", len(df_combined))
+    return df_combined
+
+def process_sheet(file_path, deduction_df: pd.DataFrame, field_mappings, selected_deduction_fields: list, source_identity_column: str, rule_identity_key: str,
+                  snapshot_store=None, unit_name: str = "", salary_month: str = "", source_digest: str = None,
+                  on_stage=None, mapped_cache=None, profiler=None) -> pd.DataFrame:
+    """
+    处理单个源工资表：表头检测、字段映射、合并扣款、复杂计算。
 
-        print(f"DEBUG: process_sheet returning final shape: {df_combined.shape}")
-        return df_combined
+    file_path 可以是文件路径、上传文件对象，也可以是已读取的 WorkbookSnapshot（避免重复解析同一文件）。
+    deduction_df 可以是扣款表 DataFrame，也可以是预先建立的 DeductionIndex（多个源文件共用同一索引）。
+    提供 snapshot_store 时，过滤后的源数据与字段映射结果按 单位/月份/内容哈希 保存为快照，重跑时直接读取快照。
+    提供 mapped_cache 时字段映射结果同时缓存在内存中，见 load_mapped_frame。
+    on_stage 为可选回调 on_stage(阶段, 行数)，在 read / map / merge / calculate 各阶段完成时调用，用于报告进度。
+    提供 profiler (stage_profiler.RunProfiler) 时同时记录该文件各阶段的耗时、CPU 时间与内存。
 
-    except FileNotFoundError:
-        print(f"ERROR: File not found: {file_path}")
-        return pd.DataFrame() # Return empty if file not found
-    except ValueError as ve: # Catch header detection error
-        print(f"ERROR: Processing file {os.path.basename(file_path)} failed - {ve}")
-        return pd.DataFrame()
-    except Exception as e:
-        print(f"ERROR: Unexpected error processing file {os.path.basename(file_path)}: {e}")
-        import traceback
-        traceback.print_exc() # Print full traceback for unexpected errors
+    只有没有任何行匹配映射规则时才返回空 DataFrame；读取、表头检测、字段映射或计算失败时抛出异常，
+    由调用方（pipeline.process_sources）记为该文件出错。
+    """
+    file_name = getattr(file_path, "name", None) or os.path.basename(file_path)
+    if profiler is not None:
+        clock, report_stage = profiler.clock(file_name), on_stage
+
+        def on_stage(stage, rows):
+            clock.mark(stage, rows)
+            if report_stage is not None:
+                report_stage(stage, rows)
+    logger.debug("process_sheet called for file: %s", file_name)
+    logger.debug("Using source identity column: '%s', rule identity key: '%s'", source_identity_column, rule_identity_key)
+    # 规则注册表只构建一次，逐行匹配与复杂计算阶段共用
+    registry = RuleRegistry.ensure(field_mappings)
+    df_combined = load_mapped_frame(
+        file_path, registry, source_identity_column, rule_identity_key,
+        snapshot_store=snapshot_store, unit_name=unit_name, salary_month=salary_month, source_digest=source_digest,
+        cache=mapped_cache, on_stage=on_stage,
+    )
+    if df_combined.empty:
         return pd.DataFrame()
+    return merge_and_calculate(
+        df_combined, deduction_df, registry, selected_deduction_fields, source_identity_column, rule_identity_key,
+        on_stage=on_stage,
+    )
+
+# 分块处理源数据表时每块的数据行数
+SOURCE_CHUNK_ROWS = 5000
+
+def process_sheet_chunks(file_path, deduction_df, field_mappings, selected_deduction_fields: list, source_identity_column: str,
+                         rule_identity_key: str, chunk_rows: int = SOURCE_CHUNK_ROWS, name: str = None, on_stage=None):
+    """
+    分块处理单个源工资表，依次生成各块的结果（过滤合计行、字段映射、合并扣款、复杂计算），
+    内存占用与 chunk_rows 成正比而不随表的行数增长，用于市级汇总等超大的表。
+
+    每块的结果与 process_sheet 中对应行的结果一致，但不读写快照与字段映射缓存。
+    模糊匹配不会选用之前各块已匹配的扣款记录；"两个值模糊匹配到同一记录时都不采用"只在块内判断。
+
+    Args:
+        file_path: 文件路径、bytes、文件对象，或已创建的 WorkbookStream（调用方可由其 rows / declared_rows 估计进度，
+            此时 chunk_rows 与 name 不起作用）。
+        deduction_df: 预先建立的 DeductionIndex（扣款表 DataFrame 也可以，各块共用同一索引）。
+        chunk_rows: 每块的数据行数。
+        name: 用于日志的文件名。
+        on_stage: 同 process_sheet，每块的各阶段完成时调用。记录耗时时可以传入
+            profiler.clock(文件名, accumulate=True)，各块同一阶段的耗时累计为一条记录。
+
+    Yields:
+        各块的结果 DataFrame（没有成功映射的块不生成）。
+
+    Raises:
+        ValueError: 未找到表头行。
+    """
+    stream = file_path if isinstance(file_path, WorkbookStream) else WorkbookStream(
+        file_path, name=name, header_keywords=(source_identity_column,), batch_rows=chunk_rows)
+
+    def stage_done(stage, rows):
+        if on_stage is not None:
+            on_stage(stage, rows)
+
+    registry = RuleRegistry.ensure(field_mappings)
+    deduction_index = DeductionIndex.ensure(deduction_df, selected_deduction_fields)
+    claimed = set()
+    missing_rule_ids = set()
+    for df in stream:
+        df = filter_summary_rows(df, source_identity_column)
+        stage_done("read", len(df))
+        df_mapped, missing = apply_field_mapping_by_identity(df, registry, source_identity_column, rule_identity_key)
+        missing_rule_ids |= missing
+        stage_done("map", len(df_mapped))
+        if df_mapped.empty:
+            continue
+        yield merge_and_calculate(
+            df_mapped, deduction_index, registry, selected_deduction_fields, source_identity_column, rule_identity_key,
+            on_stage=on_stage, claimed=claimed,
+        )
+    if missing_rule_ids:
+        logger.warning("No mapping rules found for %s values: %s", rule_identity_key, sorted(missing_rule_ids))
+    logger.debug("process_sheet_chunks read %s data rows from %s in chunks of %s", stream.rows, stream.name, stream.batch_rows)
 
 # --- 6. 样式设置 ---
 def classify_fields(df):
@@ -512,35 +919,69 @@ def classify_fields(df):
         if field not in classified: field_styles[field] = "DEDUCT"; classified.add(field)
     return field_styles
 
-def get_column_width(cell):
-    """计算单元格内容的适当列宽"""
-    value = str(cell.value) if cell.value is not None else ""
-    max_width = 0
-    
-    # 计算字符宽度
-    for char in value:
+def _text_width(text: str, bold: bool = False, size: float = None) -> float:
+    """
+    按字符类型估算文本宽度：默认中文 2.1，数字和空格 1.1，其他 1.3（可由 SALARY_COLUMN_WIDTH_FONT
+    按字体的字形宽度换算，见 font_resolver.column_char_widths）；加粗与字号按比例放大。
+    """
+    cjk_width, narrow_width, other_width = column_char_widths()
+    width = 0
+    for char in text:
         if '\u4e00' <= char <= '\u9fff':  # 中文字符
-            max_width += 2.1
+            width += cjk_width
         elif char.isdigit() or char.isspace():  # 数字和空格
-            max_width += 1.1
+            width += narrow_width
         else:  # 其他字符
-            max_width += 1.3
-    
-    # 考虑字体样式的影响
-    if cell.font.bold:
-        max_width *= 1.2
-    
-    # 根据字体大小调整
-    if cell.font.size:
-        max_width *= cell.font.size / 11  # 11为默认字号
-        
-    return max_width
+            width += other_width
+    if bold:
+        width *= 1.2
+    if size:
+        width *= size / 11  # 11为默认字号
+    return width
+
+def get_column_width(cell):
+    """计算单元格内容的适当列宽"""
+    value = str(cell.value) if cell.value is not None else ""
+    return _text_width(value, bold=cell.font.bold, size=cell.font.size)
+
+# 表头按字段类型着色；openpyxl 只在写出报表时才导入，界面启动与只做计算的流程不加载
+HEADER_FILL_COLORS = {
+    "BASIC": "DCE6F1",
+    "STAT": "EAEAEA",
+    "INCOME": "E2F0D9",
+    "DEDUCT": "FCE4D6",
+}
+
+@lru_cache(maxsize=None)
+def header_fill(style_key):
+    """字段类型对应的表头填充（同一类型共用一个 PatternFill），未知类型返回 None。"""
+    color = HEADER_FILL_COLORS.get(style_key)
+    if color is None:
+        return None
+    from openpyxl.styles import PatternFill
+    return PatternFill("solid", fgColor=color)
+
+
+DEFAULT_UNIT_NAME = "高新区财政局"
+EXPORT_CHUNK_ROWS = 5000
+
+
+def _report_title(year, month) -> str:
+    return f"{year}年{month:02d}月工资基金 机关工资发放表（实发）"
+
+def _final_column_width(max_width: float) -> float:
+    # 设置最小宽度并添加一些padding，最大宽度限制为50
+    return min(max(8, max_width + 2), 50)
+
+def format_excel_with_styles(filepath, output_path, year, month, unit_name: str = DEFAULT_UNIT_NAME):
+    from openpyxl import load_workbook
+    from openpyxl.styles import Font
+    from openpyxl.utils import get_column_letter
 
-def format_excel_with_styles(filepath, output_path, year, month):
     wb = load_workbook(filepath)
     ws = wb.active
 
-    title = f"{year}年{month:02d}月工资基金 机关工资发放表（实发）"
+    title = _report_title(year, month)
     date_str = datetime.today().strftime("制表时间：%Y 年 %m 月 %d 日")
 
     ws.insert_rows(1)
@@ -550,25 +991,19 @@ def format_excel_with_styles(filepath, output_path, year, month):
     ws.merge_cells(f"A1:{get_column_letter(max_col)}1")
     ws["A1"] = title
     ws["A1"].font = Font(size=20, bold=True)
-    ws["B2"] = "单位名称：高新区财政局"
+    ws["B2"] = f"单位名称：{unit_name}"
     ws["B2"].font = Font(bold=True)
     ws["G2"] = date_str
     ws["G2"].font = Font(bold=True)
 
     headers = [cell.value for cell in ws[3]]
-    style_map = {
-        "BASIC": PatternFill("solid", fgColor="DCE6F1"),
-        "STAT": PatternFill("solid", fgColor="EAEAEA"),
-        "INCOME": PatternFill("solid", fgColor="E2F0D9"),
-        "DEDUCT": PatternFill("solid", fgColor="FCE4D6"),
-    }
     field_class = classify_fields(pd.DataFrame(columns=headers))
 
     for col_idx, col_name in enumerate(headers, 1):
         cell = ws.cell(row=3, column=col_idx)
-        style_key = field_class.get(col_name)
-        if style_key in style_map:
-            cell.fill = style_map[style_key]
+        fill = header_fill(field_class.get(col_name))
+        if fill is not None:
+            cell.fill = fill
 
     # 更新列宽度设置逻辑
     for col_idx, column_cells in enumerate(ws.columns, 1):
@@ -576,9 +1011,7 @@ def format_excel_with_styles(filepath, output_path, year, month):
         for cell in column_cells:
             width = get_column_width(cell)
             max_width = max(max_width, width)
-        # 设置最小宽度并添加一些padding
-        final_width = max(8, max_width + 2)
-        ws.column_dimensions[get_column_letter(col_idx)].width = min(final_width, 50)  # 限制最大宽度为50
+        ws.column_dimensions[get_column_letter(col_idx)].width = _final_column_width(max_width)
 
     for col_idx, col_name in enumerate(headers, 1):
         values = [ws.cell(row=row, column=col_idx).value for row in range(4, ws.max_row+1)]
@@ -587,3 +1020,257 @@ def format_excel_with_styles(filepath, output_path, year, month):
 
     ws.freeze_panes = "H4"
     wb.save(output_path)
+
+def _column_cell_values(column: pd.Series) -> list:
+    """把一列转换为写入单元格的 Python 值，缺失值为 None（与 to_excel 写入空单元格一致）。"""
+    values = column.astype(object)
+    return values.where(column.notna(), None).tolist()
+
+def _cell_text(value) -> str:
+    """单元格写入 Excel 后再读取得到的文本，与按已保存文件计算列宽的结果一致。"""
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        # openpyxl 以 16 位有效数字写出浮点数，读取时不含小数点/指数的按整数解析
+        text = "%.16g" % value
+        return str(float(text)) if any(mark in text for mark in ".Ee") else text
+    return str(value)
+
+# 列宽估算中的字符分类：中文、数字和空白、其他（宽度与 _text_width 一致）
+_CJK_CHARS = "[\u4e00-\u9fff]"
+_NARROW_CHARS = "[0-9\\s\u3000\u00a0\uff10-\uff19]"
+
+def _texts_max_width(texts: pd.Series) -> float:
+    """向量化计算一组文本的最大宽度（字符分类规则同 _text_width）。"""
+    if texts.empty:
+        return 0.0
+    texts = texts.astype(str)
+    lengths = texts.str.len()
+    cjk = texts.str.count(_CJK_CHARS)
+    narrow = texts.str.count(_NARROW_CHARS)
+    cjk_width, narrow_width, other_width = column_char_widths()
+    widths = cjk_width * cjk + narrow_width * narrow + other_width * (lengths - cjk - narrow)
+    return float(widths.max())
+
+def _numeric_max_width(values: np.ndarray) -> float:
+    """
+    不转换为字符串，直接由数值计算最大显示宽度：整数位数 + 小数位数按数字宽度计，
+    小数点与负号按其他字符宽度计。小数位数取能精确还原该值的最少位数，与写出后读回的文本一致；
+    其余值（极大/极小、6 位以上小数、浮点误差如 0.1 + 0.2、非有限值）回退到逐个格式化。
+    """
+    values = values.astype(float)
+    abs_values = np.abs(values)
+    regular = np.isfinite(values) & (abs_values < 1e15) & ((abs_values == 0) | (abs_values >= 1e-4))
+    safe = np.where(regular & (abs_values >= 1), abs_values, 1.0)
+    int_digits = np.floor(np.log10(safe)) + 1
+    # log10 在 10 的整数次幂附近可能有舍入误差，按实际区间修正
+    int_digits += (safe >= 10 ** int_digits)
+    int_digits -= (safe < 10 ** (int_digits - 1))
+
+    # 最少小数位数：v 恰好是某个 p 位小数最近的浮点数时，其读回文本（最短表示）正好有 p 位小数
+    decimals = np.full(len(values), -1)
+    for places in range(7):
+        exact = np.round(abs_values, places) == abs_values
+        decimals = np.where((decimals < 0) & exact, places, decimals)
+    regular &= (decimals >= 0) & (int_digits + decimals <= 15)
+
+    _, narrow_width, other_width = column_char_widths()
+    widths = (narrow_width * (int_digits + np.clip(decimals, 0, None))
+              + other_width * ((decimals > 0).astype(int) + np.signbit(values).astype(int)))
+    max_width = float(widths[regular].max()) if regular.any() else 0.0
+    if (~regular).any():
+        # 工资金额重复度高，去重后再逐个格式化
+        irregular_texts = pd.Series([_cell_text(float(v)) for v in np.unique(values[~regular])], dtype=object)
+        max_width = max(max_width, _texts_max_width(irregular_texts))
+    return max_width
+
+def _column_max_width(column: pd.Series) -> float:
+    values = column.dropna()
+    if values.empty:
+        return 0.0
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # 标签列只计算出现过的类别
+        return _column_max_width(pd.Series(values.cat.remove_unused_categories().cat.categories))
+    if pd.api.types.is_bool_dtype(values):
+        return _texts_max_width(values.astype(str))
+    if pd.api.types.is_integer_dtype(values):
+        return _numeric_max_width(values.to_numpy())
+    if pd.api.types.is_float_dtype(values):
+        return _numeric_max_width(values.to_numpy(dtype=float))
+    if isinstance(values.dtype, pd.StringDtype):
+        return _texts_max_width(values)
+    # 混合类型列逐个按单元格文本计算
+    return _texts_max_width(values.astype(object).map(_cell_text))
+
+def _column_has_content(column: pd.Series) -> bool:
+    values = column.dropna()
+    if values.empty:
+        return False
+    if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+        return True
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        values = pd.Series(values.cat.remove_unused_categories().cat.categories)
+    texts = values if isinstance(values.dtype, pd.StringDtype) else values.astype(object).map(_cell_text)
+    return bool((texts.astype(str).str.strip() != "").any())
+
+def compute_column_layout(df: pd.DataFrame, sample_rows: int = None):
+    """
+    由 DataFrame 计算每列内容（含表头）的最大文本宽度，以及每列是否有非空数据。
+
+    Args:
+        df: 待导出的数据。
+        sample_rows: 计算宽度时最多抽样的行数（固定随机种子），None 表示全部行。
+            空列判断不抽样，避免把有数据的列隐藏。
+
+    Returns:
+        (max_widths, non_empty) 两个与列一一对应的列表；宽度未加 padding 与上下限。
+    """
+    sampled = df
+    if sample_rows is not None and len(df) > sample_rows:
+        sampled = df.sample(n=sample_rows, random_state=0)
+    max_widths = []
+    non_empty = []
+    for col_idx, header in enumerate(df.columns):
+        header_text = "" if pd.isna(header) else _cell_text(header)
+        non_empty.append(_column_has_content(df.iloc[:, col_idx]))
+        max_widths.append(max(_text_width(header_text), _column_max_width(sampled.iloc[:, col_idx])))
+    return max_widths, non_empty
+
+class ColumnLayout:
+    """
+    分块累计各列（按列名）的最大文本宽度与是否有数据，全部块累计后的结果与
+    对合并后的数据调用 compute_column_layout 一致，用于分块写出报表前确定列宽与隐藏列。
+    """
+
+    def __init__(self):
+        self._widths = {}
+        self._non_empty = {}
+
+    def update(self, df: pd.DataFrame) -> None:
+        max_widths, non_empty = compute_column_layout(df)
+        for column, width, has_content in zip(df.columns, max_widths, non_empty):
+            self._widths[column] = max(self._widths.get(column, 0.0), width)
+            self._non_empty[column] = self._non_empty.get(column, False) or has_content
+
+    def merge(self, other: "ColumnLayout") -> None:
+        """并入另一个 ColumnLayout 的累计结果（如一个源文件处理成功后并入整个报表）。"""
+        for column, width in other._widths.items():
+            self._widths[column] = max(self._widths.get(column, 0.0), width)
+            self._non_empty[column] = self._non_empty.get(column, False) or other._non_empty[column]
+
+    @property
+    def columns(self) -> list:
+        """按首次出现顺序的全部列名（与 concat 合并各块时的列顺序一致）。"""
+        return list(self._widths)
+
+    def layout(self, columns) -> tuple:
+        """按 columns 的顺序返回 (max_widths, non_empty)；未出现过的列只计表头宽度、视为空列。"""
+        return ([self._widths.get(col, _text_width("" if pd.isna(col) else _cell_text(col))) for col in columns],
+                [self._non_empty.get(col, False) for col in columns])
+
+class StyledReportWriter:
+    """
+    按块写出格式化的工资发放表（openpyxl 只写模式）。
+
+    创建时写出标题行、单位/日期行与按字段类型着色的表头，之后每次 write 追加一块数据行，close 时保存。
+    只写模式下列宽、隐藏列与冻结窗格必须在写入第一行之前设置，因此列的布局在创建时给出。
+
+    Args:
+        output_path: 输出文件路径。
+        columns: 输出的列名（顺序即输出顺序）。
+        max_widths / non_empty: 与 columns 一一对应的内容宽度与是否有数据，见 compute_column_layout。
+        year / month: 标题中的年月。
+        unit_name: 单位名称。
+    """
+
+    def __init__(self, output_path, columns, max_widths, non_empty, year, month, unit_name: str = DEFAULT_UNIT_NAME):
+        from openpyxl import Workbook
+        from openpyxl.styles import Font
+        from openpyxl.utils import get_column_letter
+
+        self.output_path = output_path
+        self.rows = 0
+        title = _report_title(year, month)
+        date_str = datetime.today().strftime("制表时间：%Y 年 %m 月 %d 日")
+        headers = [None if pd.isna(col) else col for col in columns]
+        self.n_cols = n_cols = len(headers)
+
+        # 标题行与单位/日期行同样参与列宽计算（A1 标题、B2 单位、G2 日期）
+        title_cells = {1: (title, Font(size=20, bold=True)), 2: (f"单位名称：{unit_name}", Font(bold=True)), 7: (date_str, Font(bold=True))}
+        width_cols = max(n_cols, 7) if n_cols else 7
+        max_widths = list(max_widths) + [0] * (width_cols - n_cols)
+        for col_idx, (text, font) in title_cells.items():
+            max_widths[col_idx - 1] = max(max_widths[col_idx - 1], _text_width(text, bold=font.bold, size=font.size))
+
+        self._wb = Workbook(write_only=True)
+        self._ws = ws = self._wb.create_sheet()
+        for col_idx, max_width in enumerate(max_widths, 1):
+            dimension = ws.column_dimensions[get_column_letter(col_idx)]
+            dimension.width = _final_column_width(max_width)
+            if col_idx <= n_cols and not non_empty[col_idx - 1]:
+                dimension.hidden = True
+        ws.freeze_panes = "H4"
+        if n_cols:
+            ws.merged_cells.add(f"A1:{get_column_letter(n_cols)}1")
+
+        title_text, title_font = title_cells[1]
+        ws.append([self._styled(title_text, title_font)])
+        unit_row = [None] * 7
+        for col_idx in (2, 7):
+            text, font = title_cells[col_idx]
+            unit_row[col_idx - 1] = self._styled(text, font)
+        ws.append(unit_row)
+
+        field_class = classify_fields(pd.DataFrame(columns=[str(h) if h is not None else "" for h in headers]))
+        ws.append([
+            self._styled(header, fill=header_fill(field_class.get(str(header)))) if header is not None else None
+            for header in headers
+        ])
+
+    def _styled(self, value, font=None, fill=None):
+        from openpyxl.cell import WriteOnlyCell
+
+        cell = WriteOnlyCell(self._ws, value=value)
+        if font is not None:
+            cell.font = font
+        if fill is not None:
+            cell.fill = fill
+        return cell
+
+    def write(self, df: pd.DataFrame) -> None:
+        """追加数据行，df 的列与创建时的 columns 一一对应。"""
+        for start in range(0, len(df), EXPORT_CHUNK_ROWS):
+            chunk = df.iloc[start:start + EXPORT_CHUNK_ROWS]
+            columns = [_column_cell_values(chunk.iloc[:, col_idx]) for col_idx in range(self.n_cols)]
+            for row in zip(*columns):
+                self._ws.append(row)
+        self.rows += len(df)
+
+    def close(self) -> None:
+        self._wb.save(self.output_path)
+
+def export_excel_with_styles(df: pd.DataFrame, output_path, year, month, unit_name: str = DEFAULT_UNIT_NAME,
+                             width_sample_rows: int = None, on_progress=None):
+    """
+    单次写出格式化的工资发放表，替代 to_excel → format_excel_with_styles 的读回重写。
+
+    使用 openpyxl 只写模式按行流式写出（StyledReportWriter）：标题行、单位/日期行、按字段类型着色的表头、数据行，
+    列宽、空列隐藏与冻结窗格在写数据前根据 DataFrame 计算，输出与 format_excel_with_styles 一致。
+
+    Args:
+        df: 最终输出的数据（列顺序即输出顺序）。
+        output_path: 输出文件路径。
+        year / month: 标题中的年月。
+        unit_name: 单位名称。
+        width_sample_rows: 计算列宽时最多抽样的行数，None 表示使用全部行（空列判断始终使用全部行）。
+        on_progress: 可选回调 on_progress(已写出行数, 总行数)，每写完一块调用一次。
+    """
+    # 列宽与空列在写出前由 DataFrame 向量化计算
+    max_widths, non_empty = compute_column_layout(df, sample_rows=width_sample_rows)
+    writer = StyledReportWriter(output_path, df.columns, max_widths, non_empty, year, month, unit_name=unit_name)
+    # 按块写出数据行，内存占用不随行数增长
+    for start in range(0, len(df), EXPORT_CHUNK_ROWS):
+        writer.write(df.iloc[start:start + EXPORT_CHUNK_ROWS])
+        if on_progress is not None:
+            on_progress(writer.rows, len(df))
+    writer.close()
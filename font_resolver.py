@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+中文字体查找与缓存
+
+替代 font_cache.py 的做法（每次枚举全部系统字体并逐个创建 FontProperties）：
+- 只扫描一次字体目录，找出包含常用汉字的字体，连同字形宽度写入一个小的 JSON 索引；
+- 索引以各字体目录（含子目录）的修改时间为键，安装或删除字体后自动重新扫描，
+  否则启动时直接读取索引，选出最合适的字体只需几毫秒；
+- 同一族按 PREFERRED_FAMILIES 的顺序挑选，不依赖某个平台特有的字体名（如 macOS 的 Lantinghei SC）。
+
+用途：
+- column_char_widths() 为导出报表的列宽估算提供中文 / 数字 / 其他字符的宽度，
+  默认使用固定系数（与打开报表的 Excel 所用字体无关），设置 SALARY_COLUMN_WIDTH_FONT
+  （"auto" 或字体族名）后按该字体的字形宽度换算。
+
+环境变量：
+- SALARY_FONT_DIRS：要扫描的字体目录（以 os.pathsep 分隔），默认为各平台的系统与用户字体目录；
+- SALARY_FONT_INDEX：索引文件路径，默认 ~/.cache/salary-assist/font_index.json。
+
+字体解析使用 fontTools；未安装时按文件名关键字识别中文字体，不提供字形宽度。
+
+命令行：python font_resolver.py [--rescan] [--json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+from functools import lru_cache
+
+from log_config import configure_logging, get_logger
+
+logger = get_logger("font_resolver")
+
+INDEX_VERSION = 1
+FONT_EXTENSIONS = (".ttf", ".otf", ".ttc", ".otc")
+# 按优先顺序排列的中文字体族：Linux 常见开源字体在前，其次 Windows / macOS 自带字体
+PREFERRED_FAMILIES = (
+    "Noto Sans CJK SC", "Source Han Sans SC", "Source Han Sans CN", "WenQuanYi Micro Hei", "WenQuanYi Zen Hei",
+    "Microsoft YaHei", "PingFang SC", "Hiragino Sans GB", "Lantinghei SC", "Heiti SC", "SimHei", "DengXian",
+    "Noto Serif CJK SC", "Source Han Serif SC", "Songti SC", "SimSun", "AR PL UMing CN", "AR PL UKai CN",
+)
+# 判断字体是否可用于中文：必须包含这些字符的字形
+CJK_PROBE_CHARS = "中文工资发放表"
+# 未安装 fontTools 时按文件名识别中文字体
+CJK_FILENAME_KEYWORDS = ("cjk", "wqy", "wenquanyi", "sourcehan", "simhei", "simsun", "simkai", "simfang", "msyh",
+                         "yahei", "pingfang", "heiti", "songti", "kaiti", "uming", "ukai", "dengxian")
+# 列宽估算的默认字符宽度（中文、数字与空白、其他），与 Excel 默认字体下的经验值一致
+DEFAULT_CHAR_WIDTHS = (2.1, 1.1, 1.3)
+COLUMN_WIDTH_FONT = os.environ.get("SALARY_COLUMN_WIDTH_FONT") or None
+# 计算"其他字符"平均宽度时使用的样本
+_OTHER_SAMPLE = "ABCDEFGHabcdefgh-_.,:/()%"
+
+
+def default_font_dirs() -> list:
+    """当前平台的系统与用户字体目录（不检查是否存在）。"""
+    home = os.path.expanduser("~")
+    if sys.platform == "win32":
+        windir = os.environ.get("WINDIR", r"C:\Windows")
+        local = os.environ.get("LOCALAPPDATA", os.path.join(home, "AppData", "Local"))
+        return [os.path.join(windir, "Fonts"), os.path.join(local, "Microsoft", "Windows", "Fonts")]
+    if sys.platform == "darwin":
+        return ["/System/Library/Fonts", "/Library/Fonts", os.path.join(home, "Library", "Fonts")]
+    return ["/usr/share/fonts", "/usr/local/share/fonts", os.path.join(home, ".fonts"),
+            os.path.join(home, ".local", "share", "fonts")]
+
+
+def _default_index_path() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "salary-assist", "font_index.json")
+
+
+DEFAULT_FONT_DIRS = [d for d in os.environ.get("SALARY_FONT_DIRS", "").split(os.pathsep) if d] or default_font_dirs()
+DEFAULT_FONT_INDEX = os.environ.get("SALARY_FONT_INDEX") or _default_index_path()
+
+
+def dirs_signature(dirs) -> dict:
+    """各字体目录的签名 {目录: [最新修改时间, 子目录数]}；只读取目录的 stat，不打开字体文件。"""
+    signature = {}
+    for root in dirs:
+        if not os.path.isdir(root):
+            continue
+        latest, count = os.stat(root).st_mtime, 0
+        for dirpath, dirnames, _ in os.walk(root):
+            for name in dirnames:
+                try:
+                    latest = max(latest, os.stat(os.path.join(dirpath, name)).st_mtime)
+                except OSError:
+                    continue
+                count += 1
+        signature[os.path.abspath(root)] = [latest, count]
+    return signature
+
+
+def _font_files(dirs):
+    for root in dirs:
+        for dirpath, _, filenames in os.walk(root):
+            for name in sorted(filenames):
+                if name.lower().endswith(FONT_EXTENSIONS):
+                    yield os.path.join(dirpath, name)
+
+
+class FontInfo:
+    """索引中的一个中文字体；metrics 为以 em 为单位的字形宽度 {"cjk", "digit", "other"}，无法取得时为 None。"""
+
+    def __init__(self, family: str, path: str, index: int = 0, style: str = "", metrics: dict = None):
+        self.family = family
+        self.path = path
+        self.index = index
+        self.style = style
+        self.metrics = metrics
+
+    @property
+    def regular(self) -> bool:
+        return self.style.lower() in ("regular", "normal", "book", "")
+
+    def char_widths(self) -> tuple:
+        """按字形宽度换算的 (中文, 数字与空白, 其他) 列宽系数，数字宽度固定为默认值。"""
+        if not self.metrics or not self.metrics.get("digit"):
+            return DEFAULT_CHAR_WIDTHS
+        digit = DEFAULT_CHAR_WIDTHS[1]
+        scale = digit / self.metrics["digit"]
+        return (round(self.metrics["cjk"] * scale, 3), digit, round(self.metrics["other"] * scale, 3))
+
+    def to_dict(self) -> dict:
+        return {"family": self.family, "path": self.path, "index": self.index, "style": self.style,
+                "metrics": self.metrics}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "FontInfo":
+        return cls(data["family"], data["path"], index=data.get("index", 0), style=data.get("style", ""),
+                   metrics=data.get("metrics"))
+
+
+def _inspect_font(font, path: str, index: int):
+    """font 为 fontTools 的 TTFont；包含全部探测字符时返回 FontInfo，否则返回 None。"""
+    cmap = font.getBestCmap() or {}
+    if not all(ord(char) in cmap for char in CJK_PROBE_CHARS):
+        return None
+    names = font["name"]
+    family = names.getBestFamilyName() or os.path.splitext(os.path.basename(path))[0]
+    style = names.getBestSubFamilyName() or ""
+    metrics = None
+    try:
+        units = font["head"].unitsPerEm
+        advances = font["hmtx"].metrics
+
+        def advance(char):
+            glyph = cmap.get(ord(char))
+            return advances[glyph][0] / units if glyph in advances else None
+
+        others = [w for w in map(advance, _OTHER_SAMPLE) if w]
+        metrics = {"cjk": advance("中"), "digit": advance("0"), "other": sum(others) / len(others) if others else None}
+        if None in metrics.values():
+            metrics = None
+    except KeyError:
+        pass
+    return FontInfo(family, path, index=index, style=style, metrics=metrics)
+
+
+def scan_fonts(dirs) -> list:
+    """解析 dirs 下的全部字体文件，返回包含中文字形的字体。"""
+    try:
+        from fontTools.ttLib import TTCollection, TTFont
+    except ImportError:
+        logger.warning("未安装 fontTools，按文件名识别中文字体")
+        return [FontInfo(os.path.splitext(os.path.basename(path))[0], path) for path in _font_files(dirs)
+                if any(keyword in os.path.basename(path).lower() for keyword in CJK_FILENAME_KEYWORDS)]
+
+    fonts = []
+    for path in _font_files(dirs):
+        try:
+            if path.lower().endswith((".ttc", ".otc")):
+                members = list(enumerate(TTCollection(path, lazy=True).fonts))
+            else:
+                members = [(0, TTFont(path, lazy=True))]
+            for index, font in members:
+                info = _inspect_font(font, path, index)
+                if info is not None:
+                    fonts.append(info)
+        except Exception as e:  # 损坏或不支持的字体文件不影响其他字体
+            logger.debug("跳过无法解析的字体 %s: %s", path, e)
+    return fonts
+
+
+class FontResolver:
+    """
+    带磁盘索引的中文字体查找。
+
+    Args:
+        dirs: 扫描的字体目录，默认为 DEFAULT_FONT_DIRS。
+        index_path: 索引文件路径，None 表示只在内存中缓存。
+    """
+
+    def __init__(self, dirs=None, index_path: str = DEFAULT_FONT_INDEX):
+        self.dirs = list(dirs) if dirs is not None else list(DEFAULT_FONT_DIRS)
+        self.index_path = index_path
+        self._fonts = None
+        self._lock = threading.Lock()
+
+    def _load_index(self, signature: dict):
+        if not self.index_path or not os.path.exists(self.index_path):
+            return None
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("字体索引 %s 无法读取，重新扫描: %s", self.index_path, e)
+            return None
+        if data.get("version") != INDEX_VERSION or data.get("dirs") != signature:
+            return None
+        return [FontInfo.from_dict(item) for item in data.get("fonts", [])]
+
+    def _save_index(self, signature: dict, fonts: list) -> None:
+        if not self.index_path:
+            return
+        data = {"version": INDEX_VERSION, "dirs": signature, "fonts": [font.to_dict() for font in fonts]}
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logger.warning("字体索引无法写入 %s（本进程内仍会复用扫描结果）: %s", self.index_path, e)
+
+    def fonts(self, rescan: bool = False) -> list:
+        """索引中的全部中文字体；目录有变化或 rescan 时重新扫描。"""
+        with self._lock:
+            if self._fonts is not None and not rescan:
+                return self._fonts
+            # JSON 往返后签名中的列表与浮点数保持一致
+            signature = json.loads(json.dumps(dirs_signature(self.dirs)))
+            fonts = None if rescan else self._load_index(signature)
+            if fonts is None:
+                logger.info("扫描字体目录: %s", ", ".join(signature) or "（无）")
+                fonts = scan_fonts(list(signature))
+                logger.info("找到 %d 个中文字体", len(fonts))
+                self._save_index(signature, fonts)
+            self._fonts = fonts
+            return fonts
+
+    def families(self) -> list:
+        return sorted({font.family for font in self.fonts()})
+
+    def find(self, family: str):
+        """指定字体族中的字体（优先常规字重），不存在时返回 None。"""
+        matches = [font for font in self.fonts() if font.family.lower() == family.lower()]
+        matches.sort(key=lambda font: not font.regular)
+        return matches[0] if matches else None
+
+    def best(self, preferred=PREFERRED_FAMILIES):
+        """按 preferred 的顺序返回第一个可用的中文字体，都不可用时返回按族名排序的第一个，没有中文字体时返回 None。"""
+        for family in preferred:
+            font = self.find(family)
+            if font is not None:
+                return font
+        families = self.families()
+        return self.find(families[0]) if families else None
+
+
+@lru_cache(maxsize=None)
+def get_font_resolver() -> FontResolver:
+    """进程内共用的 FontResolver（默认目录与索引路径）。"""
+    return FontResolver()
+
+
+@lru_cache(maxsize=None)
+def column_char_widths(font_name: str = COLUMN_WIDTH_FONT) -> tuple:
+    """
+    列宽估算使用的 (中文, 数字与空白, 其他) 字符宽度。
+
+    Args:
+        font_name: None 使用 DEFAULT_CHAR_WIDTHS；"auto" 使用 best() 选出的字体；其他为字体族名。
+            字体不存在或没有字形宽度时回退到默认值。
+    """
+    if not font_name:
+        return DEFAULT_CHAR_WIDTHS
+    resolver = get_font_resolver()
+    font = resolver.best() if font_name == "auto" else resolver.find(font_name)
+    if font is None:
+        logger.warning("未找到用于列宽估算的字体 %s，使用默认字符宽度", font_name)
+        return DEFAULT_CHAR_WIDTHS
+    widths = font.char_widths()
+    logger.info("列宽估算使用字体 %s: 中文 %.2f，数字 %.2f，其他 %.2f", font.family, *widths)
+    return widths
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="列出可用的中文字体（使用并更新字体索引）")
+    parser.add_argument("--rescan", action="store_true", help="忽略索引，重新扫描字体目录")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出")
+    args = parser.parse_args(argv)
+    configure_logging()
+
+    resolver = get_font_resolver()
+    fonts = resolver.fonts(rescan=args.rescan)
+    best = resolver.best()
+    if args.json:
+        print(json.dumps({"best": best.to_dict() if best else None, "fonts": [font.to_dict() for font in fonts]},
+                         ensure_ascii=False, indent=2))
+        return 0
+    print(f"字体目录: {', '.join(resolver.dirs)}")
+    print(f"索引文件: {resolver.index_path}")
+    for font in sorted(fonts, key=lambda f: (f.family, f.style)):
+        widths = "中文 %.2f / 数字 %.2f / 其他 %.2f" % font.char_widths() if font.metrics else "无字形宽度"
+        print(f"  {font.family:<28} {font.style:<10} {widths}  {font.path}#{font.index}")
+    print(f"选用: {best.family if best else '（未找到中文字体）'}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
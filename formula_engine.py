@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+映射规则计算公式引擎
+
+将映射规则中 "calculation" 字段的公式（如 "应发工资 - 扣发合计 - 其他补扣"）
+一次性解析为 AST，只允许白名单内的运算：
+- 四则运算、整除、取余、乘方、正负号
+- 比较运算、and / or / not、条件表达式 (a if 条件 else b)
+- 函数 round、min、max
+
+编译后的公式对整张表按列执行 NumPy 运算，不再逐行调用 eval。
+数值转换语义与原逐行计算一致：源字段先 to_numeric(errors='coerce')，
+非数值按 0 处理；源字段缺失时整列结果为 NaN；除数为 0 的行结果为 NaN。
+"""
+
+import ast
+import operator
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+
+class FormulaError(ValueError):
+    """公式无法解析或包含不允许的语法。"""
+
+
+_BINARY_OPERATORS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.divide,
+    ast.FloorDiv: np.floor_divide,
+    ast.Mod: np.mod,
+    ast.Pow: np.power,
+}
+# 除数为 0 时 Python eval 会抛出 ZeroDivisionError，对应行结果记为 NaN
+_ZERO_DIVISION_OPERATORS = (ast.Div, ast.FloorDiv, ast.Mod)
+
+_COMPARE_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+
+def _round(values, ndigits=None):
+    if ndigits is None:
+        return np.round(values)
+    return np.round(values, int(np.asarray(ndigits).flat[0]))
+
+
+def _min(*args):
+    if len(args) < 2:
+        raise FormulaError("min() 至少需要两个参数")
+    return np.minimum.reduce(np.broadcast_arrays(*args))
+
+
+def _max(*args):
+    if len(args) < 2:
+        raise FormulaError("max() 至少需要两个参数")
+    return np.maximum.reduce(np.broadcast_arrays(*args))
+
+
+_FUNCTIONS = {
+    "round": _round,
+    "min": _min,
+    "max": _max,
+}
+
+
+def _compile_node(node, allowed_names: set):
+    """把单个 AST 节点编译为 env -> ndarray 的函数。"""
+    if isinstance(node, ast.Expression):
+        return _compile_node(node.body, allowed_names)
+
+    if isinstance(node, ast.Constant):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise FormulaError(f"不支持的常量: {node.value!r}")
+        value = float(node.value)
+        return lambda env: value
+
+    if isinstance(node, ast.Name):
+        name = node.id
+        if name not in allowed_names:
+            raise FormulaError(f"公式引用了未在 source_fields 中声明的字段: '{name}'")
+        return lambda env: env[name]
+
+    if isinstance(node, ast.BinOp):
+        op_type = type(node.op)
+        if op_type not in _BINARY_OPERATORS:
+            raise FormulaError(f"不支持的运算符: {op_type.__name__}")
+        func = _BINARY_OPERATORS[op_type]
+        left = _compile_node(node.left, allowed_names)
+        right = _compile_node(node.right, allowed_names)
+        if op_type in _ZERO_DIVISION_OPERATORS:
+            def divide(env):
+                numerator, denominator = np.broadcast_arrays(left(env), right(env))
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    result = func(numerator, denominator)
+                return np.where(denominator == 0, np.nan, result)
+            return divide
+        return lambda env: func(left(env), right(env))
+
+    if isinstance(node, ast.UnaryOp):
+        operand = _compile_node(node.operand, allowed_names)
+        if isinstance(node.op, ast.USub):
+            return lambda env: np.negative(operand(env))
+        if isinstance(node.op, ast.UAdd):
+            return operand
+        if isinstance(node.op, ast.Not):
+            return lambda env: (np.asarray(operand(env)) == 0).astype(float)
+        raise FormulaError(f"不支持的一元运算符: {type(node.op).__name__}")
+
+    if isinstance(node, ast.Compare):
+        operands = [_compile_node(node.left, allowed_names)]
+        operands += [_compile_node(comparator, allowed_names) for comparator in node.comparators]
+        ops = []
+        for op in node.ops:
+            if type(op) not in _COMPARE_OPERATORS:
+                raise FormulaError(f"不支持的比较运算符: {type(op).__name__}")
+            ops.append(_COMPARE_OPERATORS[type(op)])
+
+        def compare(env):
+            values = [operand(env) for operand in operands]
+            result = True
+            for op, left, right in zip(ops, values, values[1:]):
+                result = np.logical_and(result, op(left, right))
+            return np.asarray(result, dtype=float)
+        return compare
+
+    if isinstance(node, ast.BoolOp):
+        values = [_compile_node(value, allowed_names) for value in node.values]
+        is_and = isinstance(node.op, ast.And)
+
+        # 与 Python 语义一致：and 返回第一个假值或最后一个值，or 返回第一个真值或最后一个值
+        def boolean(env):
+            result = values[-1](env)
+            for value in reversed(values[:-1]):
+                current = value(env)
+                truthy = np.asarray(current) != 0
+                result = np.where(truthy, result, current) if is_and else np.where(truthy, current, result)
+            return result
+        return boolean
+
+    if isinstance(node, ast.IfExp):
+        test = _compile_node(node.test, allowed_names)
+        body = _compile_node(node.body, allowed_names)
+        orelse = _compile_node(node.orelse, allowed_names)
+        return lambda env: np.where(np.asarray(test(env)) != 0, body(env), orelse(env))
+
+    if isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name) or node.func.id not in _FUNCTIONS:
+            raise FormulaError(f"不支持的函数调用: {ast.dump(node.func)}")
+        if node.keywords:
+            raise FormulaError("函数调用不支持关键字参数")
+        func = _FUNCTIONS[node.func.id]
+        args = [_compile_node(arg, allowed_names) for arg in node.args]
+        return lambda env: func(*(arg(env) for arg in args))
+
+    raise FormulaError(f"公式包含不允许的语法: {type(node).__name__}")
+
+
+class CompiledFormula:
+    """
+    已编译的计算公式。
+
+    Attributes:
+        calculation: 原始公式文本，或 "sum"。
+        sources: 计算所需的源字段列表。
+    """
+
+    def __init__(self, calculation: str, sources: tuple):
+        self.calculation = calculation
+        self.sources = tuple(sources)
+        if calculation == "sum":
+            self._func = None
+        elif isinstance(calculation, str):
+            try:
+                tree = ast.parse(calculation.strip(), mode="eval")
+            except SyntaxError as e:
+                raise FormulaError(f"公式语法错误 '{calculation}': {e.msg}") from e
+            self._func = _compile_node(tree, set(self.sources))
+        else:
+            raise FormulaError(f"不支持的计算类型: {calculation!r}")
+
+    def missing_sources(self, columns) -> list:
+        """返回在给定列中缺失的源字段。"""
+        columns = set(columns)
+        return [source for source in self.sources if source not in columns]
+
+    def evaluate(self, df: pd.DataFrame) -> pd.Series:
+        """
+        对整张表按列计算公式。
+
+        Args:
+            df: 包含源字段的数据。
+
+        Returns:
+            与 df 索引对齐的 float Series；源字段缺失时整列为 NaN。
+        """
+        if self.missing_sources(df.columns):
+            return pd.Series(np.nan, index=df.index, dtype=float)
+        env = {
+            source: pd.to_numeric(df[source], errors="coerce").fillna(0).to_numpy(dtype=float)
+            for source in dict.fromkeys(self.sources)
+        }
+        if self._func is None:
+            result = np.zeros(len(df), dtype=float)
+            for source in self.sources:
+                result = result + env[source]
+        else:
+            result = self._func(env)
+        result = np.asarray(result, dtype=float)
+        if result.ndim == 0:
+            result = np.full(len(df), float(result))
+        return pd.Series(result, index=df.index)
+
+
+@lru_cache(maxsize=512)
+def _compile_cached(calculation, sources: tuple) -> CompiledFormula:
+    return CompiledFormula(calculation, sources)
+
+
+def compile_formula(calculation, sources) -> CompiledFormula:
+    """
+    编译计算公式，相同的 (公式, 源字段) 只解析一次。
+
+    Args:
+        calculation: "sum" 或算术表达式字符串。
+        sources: 公式允许引用的源字段列表。
+
+    Returns:
+        CompiledFormula 实例。
+
+    Raises:
+        FormulaError: 公式语法错误或包含不允许的运算。
+    """
+    if not isinstance(calculation, str):
+        raise FormulaError(f"不支持的计算类型: {calculation!r}")
+    return _compile_cached(calculation, tuple(sources))
+
+
+class CalculationCycleError(FormulaError):
+    """计算字段之间存在循环依赖。"""
+
+
+class CalculationPlan:
+    """
+    计算字段的依赖规划器。
+
+    根据各计算字段的 source_fields 建立依赖图（某个计算字段的源字段本身也是
+    计算字段时，形成一条边），检测循环依赖，并按拓扑顺序分层：同一层内的字段
+    互不依赖，按层依次向量化计算。例如 "单位代扣总计" 为求和，
+    "发放合计 - 单位代扣总计" 依赖它，因此会排在下一层。
+
+    Attributes:
+        definitions: {目标字段: {"sources": [...], "calculation": ...}}，同一目标以首次定义为准。
+        layers: 拓扑分层后的目标字段列表。
+        cycles: 处于循环依赖中、无法排序的目标字段列表。
+    """
+
+    def __init__(self, definitions: dict):
+        self.definitions = {
+            target: {"sources": list(details["sources"]), "calculation": details.get("calculation", "sum")}
+            for target, details in definitions.items()
+        }
+        # dependencies[t]: t 依赖的计算字段；dependents[s]: 依赖 s 的计算字段
+        self.dependencies = {
+            target: [source for source in dict.fromkeys(details["sources"]) if source in self.definitions]
+            for target, details in self.definitions.items()
+        }
+        self.dependents = {target: [] for target in self.definitions}
+        for target, sources in self.dependencies.items():
+            for source in sources:
+                self.dependents[source].append(target)
+        self.layers, self.cycles = self._topological_layers()
+
+    @classmethod
+    def from_rules(cls, rules) -> "CalculationPlan":
+        """
+        从规则列表收集全部计算映射并构建规划。
+
+        Args:
+            rules: 规则字典的可迭代对象（如 RuleRegistry 或 lookup 返回的规则）。
+        """
+        definitions = {}
+        for rule in rules:
+            for mapping in rule.get("mappings", []):
+                if "source_fields" in mapping and mapping.get("target_field"):
+                    definitions.setdefault(mapping["target_field"], {
+                        "sources": mapping["source_fields"],
+                        "calculation": mapping.get("calculation", "sum"),
+                    })
+        return cls(definitions)
+
+    def _topological_layers(self):
+        remaining = {target: len(sources) for target, sources in self.dependencies.items()}
+        layer = [target for target, count in remaining.items() if count == 0]
+        layers = []
+        while layer:
+            layers.append(layer)
+            next_layer = []
+            for target in layer:
+                del remaining[target]
+                for dependent in self.dependents[target]:
+                    remaining[dependent] -= 1
+                    if remaining[dependent] == 0:
+                        next_layer.append(dependent)
+            layer = next_layer
+        # 仍未出队的节点都在环上或依赖环上的节点
+        return layers, list(remaining.keys())
+
+    def __iter__(self):
+        for layer in self.layers:
+            yield from layer
+
+    def validate(self) -> None:
+        """存在循环依赖时抛出 CalculationCycleError。"""
+        if self.cycles:
+            raise CalculationCycleError(f"计算字段存在循环依赖: {self.cycles}")
+
+    def unresolved_sources(self, available_fields) -> dict:
+        """
+        检查每个计算字段能否由可用字段（直接或经其他计算字段）得到。
+
+        Args:
+            available_fields: 源文件与扣款表中实际存在的字段。
+
+        Returns:
+            {目标字段: [无法获得的源字段]}，全部可解析时为空字典。
+        """
+        available = set(available_fields)
+        resolved = set()
+        unresolved = {}
+        for target in self:
+            missing = [
+                source for source in self.definitions[target]["sources"]
+                if source not in available and source not in resolved
+            ]
+            if missing:
+                unresolved[target] = missing
+            else:
+                resolved.add(target)
+        for target in self.cycles:
+            unresolved[target] = [source for source in self.dependencies[target] if source in self.cycles]
+        return unresolved
+
+    def evaluate(self, df: pd.DataFrame, on_error=None) -> list:
+        """
+        按拓扑分层顺序在 df 上原地计算各目标字段。
+
+        Args:
+            df: 待计算的数据，结果直接写回该 DataFrame。
+            on_error: 可选回调 on_error(target, exception)，公式无法编译时调用。
+
+        Returns:
+            实际计算过的目标字段列表（按计算顺序）。
+        """
+        evaluated = []
+        for layer in self.layers:
+            for target in layer:
+                details = self.definitions[target]
+                try:
+                    formula = compile_formula(details["calculation"], details["sources"])
+                except FormulaError as e:
+                    if on_error is not None:
+                        on_error(target, e)
+                    df[target] = np.nan
+                    continue
+                df[target] = formula.evaluate(df)
+                evaluated.append(target)
+        return evaluated
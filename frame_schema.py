@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+处理结果的紧凑列类型
+
+各源文件处理完成后到合并为报表之前，结果在内存中保存（并行时还要从工作进程传回），
+字段映射生成的 编制、人员身份、岗位类别 以及 _匹配字段/_匹配规则键 追溯列在每一行重复同样的文本。
+compact_frame 把结果转换为紧凑的列类型：
+
+- 标签列（重复的文本）转为 category；
+- 其余纯文本列（姓名等）转为 Arrow 字符串；
+- 金额列转为以分为单位的整数（定点数），计算结果中的浮点误差（如 3990.8599999）在这一步消除。
+
+concat_frames 合并多个紧凑结果（统一各文件的 category 类别），expand_frame 把金额还原为元。
+还原后的金额是精确到分的浮点数，其余列保持紧凑类型，导出的报表内容不变。
+"""
+
+import numpy as np
+import pandas as pd
+
+# 金额定点表示：1 元 = 100 分
+MONEY_SCALE = 100
+# DataFrame.attrs 中记录以分存储的金额列
+FEN_COLUMNS_ATTR = "fen_columns"
+
+# 总是作为标签处理的列；其他文本列按重复程度判断
+LABEL_COLUMNS = ("编制", "人员身份", "岗位类别", "人员类别", "工资级别", "工资档次", "_扣款匹配方式")
+LABEL_COLUMN_PREFIXES = ("_匹配字段", "_匹配规则键")
+# 不同取值不超过行数的这一比例（且行数足够多）的文本列转为 category
+CATEGORY_MAX_RATIO = 0.5
+CATEGORY_MIN_ROWS = 32
+# 数值但不是金额的列
+NON_MONEY_COLUMNS = ("序号", "_扣款匹配置信度")
+# 与整分相差不超过这么多分的值视为浮点误差，超过的列（如比例、税率）不按金额处理
+FEN_TOLERANCE = 1e-4
+
+_INT32_MAX = np.iinfo(np.int32).max
+_TEXT_DTYPE = pd.StringDtype("pyarrow", na_value=np.nan)
+
+
+def _is_label(name, values: pd.Series) -> bool:
+    name = str(name)
+    if name in LABEL_COLUMNS or name.startswith(LABEL_COLUMN_PREFIXES):
+        return True
+    rows = values.notna().sum()
+    return rows >= CATEGORY_MIN_ROWS and values.nunique() <= rows * CATEGORY_MAX_RATIO
+
+
+def _is_text(values: pd.Series) -> bool:
+    """只含字符串（和空值）的列；混有数字的列保持 object，写出 Excel 时单元格类型不变。"""
+    if isinstance(values.dtype, pd.StringDtype):
+        return True
+    return values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) in ("string", "empty")
+
+
+def to_fen(values: pd.Series):
+    """
+    把元转换为分（可空整数，取值范围允许时为 Int32）；含有不足一分的数值（超出 FEN_TOLERANCE）时返回 None。
+    """
+    scaled = values.to_numpy(dtype=float, na_value=np.nan) * MONEY_SCALE
+    finite = np.isfinite(scaled)
+    if np.isinf(scaled).any():
+        return None
+    rounded = np.round(scaled[finite])
+    if np.abs(scaled[finite] - rounded).max(initial=0.0) > FEN_TOLERANCE:
+        return None
+    limit = np.abs(rounded).max(initial=0.0)
+    if limit > 2 ** 53:
+        return None
+    dtype = np.int32 if limit <= _INT32_MAX else np.int64
+    data = np.zeros(len(scaled), dtype=dtype)
+    data[finite] = rounded.astype(dtype)
+    return pd.Series(pd.arrays.IntegerArray(data, ~finite), index=values.index, name=values.name)
+
+
+def from_fen(values: pd.Series, integer: bool = False) -> pd.Series:
+    """分还原为元：float64（空值为 NaN）；integer 为 True 且没有空值和不足一元的值时还原为 int64。"""
+    if integer and not values.isna().any() and (values % MONEY_SCALE == 0).all():
+        return pd.Series(values.to_numpy(dtype=np.int64) // MONEY_SCALE, index=values.index, name=values.name)
+    return pd.Series(values.to_numpy(dtype=float, na_value=np.nan) / MONEY_SCALE, index=values.index, name=values.name)
+
+
+def compact_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    返回列类型紧凑的副本。以分存储的金额列及其原来是否为整数列记录在 attrs[FEN_COLUMNS_ATTR] 中
+    ({列名: 是否整数})；已经紧凑的列原样保留，列名重复的数值列不处理。
+    """
+    if df.empty:
+        return df
+    fen_columns = dict(df.attrs.get(FEN_COLUMNS_ATTR, {}))
+    duplicated = set(df.columns[df.columns.duplicated(keep=False)])
+    compact = df.copy(deep=False)
+    for position, name in enumerate(df.columns):
+        values = df.iloc[:, position]
+        if name in fen_columns or isinstance(values.dtype, pd.CategoricalDtype) or pd.api.types.is_bool_dtype(values):
+            continue
+        if pd.api.types.is_numeric_dtype(values):
+            if name in duplicated or str(name) in NON_MONEY_COLUMNS or values.isna().all():
+                continue
+            fen = to_fen(values)
+            if fen is not None:
+                compact.isetitem(position, fen)
+                fen_columns[name] = pd.api.types.is_integer_dtype(values)
+        elif _is_text(values):
+            compact.isetitem(position, values.astype("category") if _is_label(name, values) else values.astype(_TEXT_DTYPE))
+    compact.attrs[FEN_COLUMNS_ATTR] = fen_columns
+    return compact
+
+
+def concat_frames(frames) -> pd.DataFrame:
+    """
+    按行合并 compact_frame 的结果：同名 category 列先统一类别（否则 pd.concat 会退回 object）。
+    只有在所有含该列的结果中都以分存储的金额列合并后仍以分存储；某个结果中该列保持浮点元
+    （如含不足一分的公式结果）时，其他结果中的该列先还原为元再合并，避免按分还原时把元再除以 100。
+    """
+    frames = list(frames)
+    fen_columns = {}
+    uncompacted = set()
+    categories = {}
+    for df in frames:
+        frame_fen = df.attrs.get(FEN_COLUMNS_ATTR, {})
+        for name, integer in frame_fen.items():
+            fen_columns[name] = fen_columns.get(name, True) and integer
+        uncompacted.update(name for name in df.columns if name not in frame_fen)
+        for position, name in enumerate(df.columns):
+            if isinstance(df.iloc[:, position].dtype, pd.CategoricalDtype):
+                known = categories.setdefault(name, {})
+                known.update(dict.fromkeys(df.iloc[:, position].cat.categories))
+    mixed = uncompacted.intersection(fen_columns)
+    for name in mixed:
+        del fen_columns[name]
+    aligned = []
+    for df in frames:
+        frame_fen = df.attrs.get(FEN_COLUMNS_ATTR, {})
+        positions = [i for i, name in enumerate(df.columns)
+                     if (name in categories and isinstance(df.iloc[:, i].dtype, pd.CategoricalDtype))
+                     or (name in mixed and name in frame_fen)]
+        if positions:
+            df = df.copy(deep=False)
+            for i in positions:
+                name = df.columns[i]
+                if name in mixed:
+                    df.isetitem(i, from_fen(df.iloc[:, i]))
+                else:
+                    df.isetitem(i, df.iloc[:, i].astype(pd.CategoricalDtype(list(categories[name]))))
+        aligned.append(df)
+    combined = pd.concat(aligned, ignore_index=True)
+    combined.attrs = {FEN_COLUMNS_ATTR: fen_columns}
+    return combined
+
+
+def expand_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """把以分存储的金额列还原为元，其余列保持紧凑类型。"""
+    fen_columns = df.attrs.get(FEN_COLUMNS_ATTR, {})
+    expanded = df.copy(deep=False)
+    for position, name in enumerate(df.columns):
+        if name in fen_columns:
+            expanded.isetitem(position, from_fen(df.iloc[:, position], integer=fen_columns[name]))
+    expanded.attrs = {key: value for key, value in df.attrs.items() if key != FEN_COLUMNS_ATTR}
+    return expanded
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+已解析输入文件的内容哈希缓存
+
+Streamlit 每次控件交互都会重新执行 app.py，过去每次都会重新解析模板表头、
+源文件表头预览和扣款表。ParsedInputCache 以 "上传内容的 SHA-256 + 读取参数"
+为键缓存解析结果（WorkbookSnapshot、DataFrame、表头列表），
+命中时不再调用 openpyxl；按估算的内存占用做 LRU 淘汰。
+"""
+
+import hashlib
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from workbook_reader import WorkbookSnapshot
+
+# 默认缓存上限 (MB)，可通过环境变量调整
+DEFAULT_MAX_MB = int(os.environ.get("SALARY_INPUT_CACHE_MB", "512"))
+
+
+def content_digest(data) -> str:
+    """计算上传内容的 SHA-256。data 可以是 bytes 或带 getvalue() 的文件对象。"""
+    if hasattr(data, "getvalue"):
+        data = data.getvalue()
+    return hashlib.sha256(data).hexdigest()
+
+
+def combine_digests(*parts) -> str:
+    """把多个哈希/参数组合成一个键，用于依赖多个输入的结果（如合并后的报表）。"""
+    hasher = hashlib.sha256()
+    for part in parts:
+        hasher.update(repr(part).encode("utf-8"))
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+def estimate_size(obj) -> int:
+    """粗略估算缓存对象占用的内存字节数，用于 LRU 容量控制。"""
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True, deep=True).sum())
+    if isinstance(obj, WorkbookSnapshot):
+        if not obj.rows:
+            return sys.getsizeof(obj.rows)
+        # 抽样估算每个单元格的平均大小，避免遍历大文件的全部单元格
+        sample = obj.rows[:: max(1, len(obj.rows) // 50)]
+        cells = sum(len(row) for row in sample) or 1
+        per_cell = sum(sys.getsizeof(cell) for row in sample for cell in row) / cells + 8
+        per_row = sys.getsizeof(obj.rows[0]) + per_cell * len(obj.rows[0])
+        return int(per_row * len(obj.rows))
+    if isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum(sys.getsizeof(item) for item in obj)
+    return sys.getsizeof(obj)
+
+
+def _freeze(value):
+    """把读取参数转换为可哈希的形式。"""
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    return value
+
+
+def _copy_result(value):
+    # 调用方可能原地修改返回的 DataFrame（如扣款表数值化），命中时返回副本
+    if isinstance(value, pd.DataFrame):
+        return value.copy()
+    if isinstance(value, list):
+        return list(value)
+    return value
+
+
+class ParsedInputCache:
+    """
+    按内容哈希缓存的解析结果，线程安全，按内存占用做 LRU 淘汰。
+
+    Attributes:
+        max_bytes: 缓存总大小上限（字节）。
+        hits / misses: 命中与未命中次数，便于在日志中观察效果。
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._total_bytes = 0
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def get_or_compute(self, key, compute):
+        """命中则返回缓存值（DataFrame/列表返回副本），否则调用 compute() 计算并缓存。"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return _copy_result(self._entries[key][0])
+            self.misses += 1
+        value = compute()
+        self._store(key, value)
+        return _copy_result(value)
+
+    def _store(self, key, value) -> None:
+        size = estimate_size(value)
+        with self._lock:
+            if size > self.max_bytes:
+                return  # 单个对象超过上限时不缓存
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes and self._entries:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def snapshot(self, data, digest: str = None, name: str = "", **load_params) -> WorkbookSnapshot:
+        """
+        返回上传内容对应的 WorkbookSnapshot，相同内容与参数只解析一次。
+
+        Args:
+            data: 上传文件的 bytes（或带 getvalue() 的文件对象）。
+            digest: 已知的内容哈希，提供时跳过重新计算。
+            name: 文件名，仅用于日志。
+            load_params: 传给 WorkbookSnapshot.load 的参数。
+        """
+        digest = digest or content_digest(data)
+        key = (digest, "snapshot", _freeze(load_params))
+
+        def load():
+            raw = data.getvalue() if hasattr(data, "getvalue") else data
+            return WorkbookSnapshot.load(raw, name=name, **load_params)
+
+        snapshot = self.get_or_compute(key, load)
+        # 同一内容可能以不同文件名上传，日志中使用本次的文件名
+        snapshot.name = name or snapshot.name
+        return snapshot
+
+    def read(self, data, operation: str, digest: str = None, name: str = "", **params):
+        """
+        返回快照上某个读取操作的结果并缓存，如 read(header=2)、columns(header=2)、
+        find_header_row(keywords=[...], max_scan_rows=20)。
+
+        Args:
+            data: 上传文件的 bytes（或带 getvalue() 的文件对象）。
+            operation: WorkbookSnapshot 的方法名。
+            digest: 已知的内容哈希。
+            name: 文件名，仅用于日志。
+            params: 该方法的参数，同时作为缓存键的一部分。
+        """
+        digest = digest or content_digest(data)
+        key = (digest, operation, _freeze(params))
+        return self.get_or_compute(
+            key, lambda: getattr(self.snapshot(data, digest=digest, name=name), operation)(**params)
+        )
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""
+后台处理任务队列
+
+"开始处理数据" 过去在 Streamlit 脚本运行中同步执行整个流程，浏览器刷新后结果丢失，
+处理过程中也看不到进度。JobQueue 在一个后台线程中运行 asyncio 事件循环：
+
+- submit() 立即返回任务 ID，任务排队后执行（同时运行的任务数有上限）
+- 任务执行时通过 progress(阶段, 进度, 说明) 更新阶段与进度，界面轮询 get() 显示
+- 每个任务有自己的日志缓冲区，任务执行中产生的 salary.* 日志都进入该缓冲区
+- 完成的任务（含输出文件路径）保留在队列中，页面重新运行或刷新后仍可下载
+
+多个单位同时提交时：
+- 排队的任务按提交者 (owner，通常为单位名称) 分队列，各队列轮流取任务，
+  一个单位一次提交很多任务不会让其他单位一直等待
+- 准入控制：单个任务的文件总大小、所有未完成任务的文件总大小、每个单位排队的任务数
+  超过上限时 submit() 抛出 JobRejected
+- use_processes=True 时任务在进程池中执行，吞吐量随 CPU 核数增长（不受 GIL 限制），
+  进度与日志通过队列传回主进程
+
+队列对象应在进程内共享（界面中用 st.cache_resource 创建）。
+"""
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from log_config import DEFAULT_BUFFER_SIZE, LOGGER_NAMESPACE, RingBufferHandler, get_logger, route_thread_logs
+
+logger = get_logger(__name__)
+
+# 同时运行的任务数与保留的已结束任务数
+DEFAULT_CONCURRENCY = int(os.environ.get("SALARY_JOB_CONCURRENCY", "2"))
+DEFAULT_HISTORY = int(os.environ.get("SALARY_JOB_HISTORY", "50"))
+# 准入控制：单个任务文件大小上限、所有未完成任务文件总大小上限 (MB)、每个单位排队任务数上限；0 表示不限制
+DEFAULT_MAX_JOB_MB = float(os.environ.get("SALARY_JOB_MAX_MB", "100"))
+DEFAULT_MAX_PENDING_MB = float(os.environ.get("SALARY_JOB_MAX_PENDING_MB", "1024"))
+DEFAULT_MAX_QUEUED_PER_OWNER = int(os.environ.get("SALARY_JOB_MAX_PER_UNIT", "10"))
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+FINISHED_STATES = (JOB_DONE, JOB_FAILED)
+JOB_STATE_FILE = "job.json"
+
+
+class JobRejected(Exception):
+    """
+    任务未被接受。
+
+    Attributes:
+        reason: "too_large"（单个任务超过大小上限，重试无用）或 "busy"（队列已满，稍后重试）。
+    """
+
+    def __init__(self, message: str, reason: str = "busy"):
+        super().__init__(message)
+        self.reason = reason
+
+
+class Job:
+    """
+    一个后台任务的状态。
+
+    Attributes:
+        id: 任务 ID。
+        name: 显示名称。
+        owner: 提交者标识（如单位名称），用于公平调度与筛选。
+        cost: 任务输入文件的总字节数，用于准入控制。
+        status: queued / running / done / failed。
+        stage / progress / message: 当前阶段、0~1 的进度与说明。
+        result: 任务函数的返回值。
+        error: 失败时的错误信息。
+        work_dir: 任务专用的目录（输出报表写在这里）。
+        logs: 任务日志的环形缓冲区。
+    """
+
+    def __init__(self, name: str = "", owner: str = "", cost: int = 0, work_root: str = None,
+                 log_capacity: int = DEFAULT_BUFFER_SIZE):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.owner = owner
+        self.cost = cost
+        self.status = JOB_QUEUED
+        self.stage = ""
+        self.progress = 0.0
+        self.message = ""
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        if work_root:
+            self.work_dir = os.path.join(work_root, self.id)
+            os.makedirs(self.work_dir, exist_ok=True)
+        else:
+            self.work_dir = tempfile.mkdtemp(prefix=f"salary-job-{self.id}-")
+        self.logs = RingBufferHandler(capacity=log_capacity)
+
+    @property
+    def finished_ok(self) -> bool:
+        return self.status == JOB_DONE
+
+    @property
+    def output_path(self):
+        """任务结果中的输出文件路径（任务函数返回 dict 且含 output_path 时）。"""
+        return self.result.get("output_path") if isinstance(self.result, dict) else None
+
+    def update(self, stage: str, progress: float, message: str = "") -> None:
+        """任务函数的进度回调：进度只增不减。"""
+        self.stage = stage
+        self.progress = max(self.progress, min(max(float(progress), 0.0), 1.0))
+        self.message = message
+
+    def to_dict(self, log_limit: int = 0) -> dict:
+        result = self.result.to_dict() if hasattr(self.result, "to_dict") else self.result
+        data = {
+            "id": self.id,
+            "name": self.name,
+            "owner": self.owner,
+            "cost": self.cost,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": round(self.progress, 4),
+            "message": self.message,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "result": result,
+        }
+        if log_limit:
+            data["logs"] = list(self.logs)[-log_limit:]
+        return data
+
+    def save_state(self) -> None:
+        """把任务状态写入任务目录（结果存储、服务重启后查询用）。"""
+        path = os.path.join(self.work_dir, JOB_STATE_FILE)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(log_limit=len(self.logs)), f, ensure_ascii=False, default=str)
+        os.replace(f"{path}.tmp", path)
+
+
+class _EventLogHandler(logging.Handler):
+    """工作进程中把日志发送到事件队列。"""
+
+    def __init__(self, events, job_id: str):
+        super().__init__()
+        self.events = events
+        self.job_id = job_id
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.events.put((self.job_id, "log", (record.created, record.levelname, record.name, record.getMessage())))
+        except Exception:
+            self.handleError(record)
+
+
+def _run_job_in_process(func, args, kwargs, events, job_id: str, work_dir: str, log_level: int):
+    """进程池中执行任务：进度与日志通过 events 队列发回主进程。"""
+    root = logging.getLogger(LOGGER_NAMESPACE)
+    root.handlers = [_EventLogHandler(events, job_id)]
+    root.setLevel(log_level)
+    root.propagate = False
+
+    def progress(stage, fraction, message=""):
+        events.put((job_id, "progress", (stage, fraction, message)))
+
+    return func(*args, progress=progress, work_dir=work_dir, **kwargs)
+
+
+class JobQueue:
+    """
+    基于 asyncio 的后台任务队列，线程安全。
+
+    任务函数以 func(*args, progress=..., work_dir=job.work_dir, **kwargs) 调用；
+    线程模式下在线程池中执行，进程模式下 func 及参数需可 pickle（模块级函数）。
+
+    Args:
+        concurrency: 同时运行的任务数（工作线程/进程数）。
+        history: 内存中保留的已结束任务数。
+        use_processes: 在进程池中执行任务。
+        work_root: 任务目录的根目录；为 None 时使用临时目录，任务移出内存时删除。
+            指定时任务目录与状态文件保留（作为结果存储），由调用方负责清理。
+        max_job_bytes / max_pending_bytes / max_queued_per_owner: 准入控制，None 取环境变量默认值，0 为不限制。
+        on_finish: 任务结束时的回调 on_finish(job)。
+    """
+
+    def __init__(self, concurrency: int = DEFAULT_CONCURRENCY, history: int = DEFAULT_HISTORY,
+                 use_processes: bool = False, work_root: str = None,
+                 max_job_bytes: int = None, max_pending_bytes: int = None, max_queued_per_owner: int = None,
+                 on_finish=None):
+        self.concurrency = max(1, concurrency)
+        self.history = history
+        self.use_processes = use_processes
+        self.work_root = work_root
+        self.max_job_bytes = int(DEFAULT_MAX_JOB_MB * 1024 * 1024) if max_job_bytes is None else max_job_bytes
+        self.max_pending_bytes = int(DEFAULT_MAX_PENDING_MB * 1024 * 1024) if max_pending_bytes is None else max_pending_bytes
+        self.max_queued_per_owner = DEFAULT_MAX_QUEUED_PER_OWNER if max_queued_per_owner is None else max_queued_per_owner
+        self.on_finish = on_finish
+        self._jobs = OrderedDict()
+        self._pending = OrderedDict()  # owner -> deque[(job, func, args, kwargs)]，轮流取任务
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="salary-job")
+        if use_processes:
+            context = multiprocessing.get_context(os.environ.get("SALARY_MP_START_METHOD", "spawn"))
+            self._process_pool = ProcessPoolExecutor(max_workers=self.concurrency, mp_context=context)
+            self._manager = context.Manager()
+            self._events = self._manager.Queue()
+            threading.Thread(target=self._dispatch_events, name="salary-job-events", daemon=True).start()
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, name="salary-job-loop", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    # --- 调度 ---
+    def _run_loop(self) -> None:
+        asyncio.set_event_loop(self._loop)
+        self._wakeup = asyncio.Condition()
+        for _ in range(self.concurrency):
+            self._loop.create_task(self._worker())
+        self._ready.set()
+        self._loop.run_forever()
+
+    def _next_pending(self):
+        """按单位轮流取下一个任务：取出后该单位移到队尾。"""
+        with self._lock:
+            for owner in list(self._pending):
+                queue = self._pending.pop(owner)
+                item = queue.popleft()
+                if queue:
+                    self._pending[owner] = queue
+                return item
+        return None
+
+    async def _enqueue(self, item) -> None:
+        async with self._wakeup:
+            self._wakeup.notify()
+
+    async def _worker(self) -> None:
+        while True:
+            async with self._wakeup:
+                item = self._next_pending()
+                while item is None:
+                    await self._wakeup.wait()
+                    item = self._next_pending()
+            await self._loop.run_in_executor(self._executor, self._execute, *item)
+
+    def _execute(self, job: Job, func, args, kwargs) -> None:
+        # 执行线程中产生的日志全部进入任务自己的缓冲区
+        route_thread_logs(job.logs)
+        job.status = JOB_RUNNING
+        job.started = time.time()
+        try:
+            if self.use_processes:
+                future = self._process_pool.submit(
+                    _run_job_in_process, func, args, kwargs, self._events, job.id, job.work_dir,
+                    logging.getLogger(LOGGER_NAMESPACE).getEffectiveLevel(),
+                )
+                job.result = future.result()
+            else:
+                job.result = func(*args, progress=job.update, work_dir=job.work_dir, **kwargs)
+            job.status = JOB_DONE
+            job.progress = 1.0
+        except Exception as e:
+            logger.error("任务 %s 失败: %s", job.name or job.id, e)
+            logger.debug("Traceback for job %s", job.id, exc_info=True)
+            job.error = str(e)
+            job.status = JOB_FAILED
+        finally:
+            job.finished = time.time()
+            route_thread_logs(None)
+            if self.work_root:
+                job.save_state()
+            if self.on_finish is not None:
+                self.on_finish(job)
+            self._prune()
+
+    def _dispatch_events(self) -> None:
+        """把工作进程发回的进度与日志写入对应任务。"""
+        while True:
+            try:
+                job_id, kind, payload = self._events.get()
+            except (EOFError, OSError):
+                return
+            job = self.get(job_id)
+            if job is None:
+                continue
+            if kind == "progress":
+                job.update(*payload)
+            elif kind == "log":
+                created, levelname, name, message = payload
+                job.logs.add(levelname, message, name=name, created=created)
+
+    # --- 提交与查询 ---
+    def _admit(self, owner: str, cost: int) -> None:
+        if self.max_job_bytes and cost > self.max_job_bytes:
+            raise JobRejected(
+                f"提交的文件共 {cost / 1024 / 1024:.1f} MB，超过单个任务上限 {self.max_job_bytes / 1024 / 1024:.1f} MB。",
+                reason="too_large",
+            )
+        active = [job for job in self._jobs.values() if job.status not in FINISHED_STATES]
+        if self.max_pending_bytes and sum(job.cost for job in active) + cost > self.max_pending_bytes:
+            raise JobRejected("处理队列已满，请稍后重试。", reason="busy")
+        queued = sum(1 for job in active if job.owner == owner and job.status == JOB_QUEUED)
+        if self.max_queued_per_owner and queued >= self.max_queued_per_owner:
+            raise JobRejected(f"单位 {owner} 已有 {queued} 个任务在排队，请等待完成后再提交。", reason="busy")
+
+    def submit(self, func, *args, name: str = "", owner: str = "", cost: int = 0, **kwargs) -> str:
+        """
+        提交任务并立即返回任务 ID。
+
+        Args:
+            cost: 任务输入的字节数（用于准入控制）。
+
+        Raises:
+            JobRejected: 超过准入限制。
+        """
+        with self._lock:
+            self._admit(owner, cost)
+            job = Job(name=name, owner=owner, cost=cost, work_root=self.work_root)
+            self._jobs[job.id] = job
+            self._pending.setdefault(owner, deque()).append((job, func, args, kwargs))
+        asyncio.run_coroutine_threadsafe(self._enqueue(job), self._loop)
+        logger.info("已提交任务 %s (%s)", job.id, name)
+        return job.id
+
+    def get(self, job_id: str):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self, owner: str = None) -> list:
+        """按提交时间倒序返回任务。"""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [job for job in reversed(jobs) if owner is None or job.owner == owner]
+
+    def queued_ahead(self, job_id: str) -> int:
+        """按轮流调度估算该任务开始前还要等待的排队任务数。"""
+        with self._lock:
+            queues = [list(queue) for queue in self._pending.values()]
+        for owner_index, queue in enumerate(queues):
+            for position, (job, *_rest) in enumerate(queue):
+                if job.id == job_id:
+                    # 每轮每个单位取一个：排在前面的轮次中其他单位各有一个，本轮中排在前面的单位各有一个
+                    return position + sum(min(len(other), position + (i < owner_index))
+                                          for i, other in enumerate(queues) if i != owner_index)
+        return 0
+
+    def report(self, job_id: str):
+        """返回已完成任务的 (文件名, 内容 bytes)，没有输出文件时返回 None。"""
+        job = self.get(job_id)
+        path = job.output_path if job is not None else None
+        if not path or not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return os.path.basename(path), f.read()
+
+    def stats(self) -> dict:
+        with self._lock:
+            jobs = list(self._jobs.values())
+            queued_by_owner = {owner: len(queue) for owner, queue in self._pending.items()}
+        active = [job for job in jobs if job.status not in FINISHED_STATES]
+        return {
+            "concurrency": self.concurrency,
+            "use_processes": self.use_processes,
+            "running": sum(1 for job in jobs if job.status == JOB_RUNNING),
+            "queued": sum(queued_by_owner.values()),
+            "queued_by_owner": queued_by_owner,
+            "pending_bytes": sum(job.cost for job in active),
+            "max_pending_bytes": self.max_pending_bytes,
+        }
+
+    def _prune(self) -> None:
+        """只在内存中保留最近 history 个已结束的任务；未指定 work_root 时删除其临时目录。"""
+        with self._lock:
+            finished = [job for job in self._jobs.values() if job.status in FINISHED_STATES]
+            expired = finished[: max(0, len(finished) - self.history)]
+            for job in expired:
+                del self._jobs[job.id]
+        if not self.work_root:
+            for job in expired:
+                shutil.rmtree(job.work_dir, ignore_errors=True)
+
+    def shutdown(self) -> None:
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        if self.use_processes:
+            self._process_pool.shutdown(wait=False, cancel_futures=True)
+            self._manager.shutdown()
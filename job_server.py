@@ -0,0 +1,486 @@
+# -*- coding: utf-8 -*-
+"""
+本地 HTTP 处理任务服务
+
+多个单位的财务人员同时处理时，每个 Streamlit 会话都在自己的进程中解析与导出，
+彼此争用 CPU，一个大单位的任务会拖慢所有人。本服务把处理集中到一个进程池中：
+
+- 固定数量的工作进程（--concurrency），吞吐量随 CPU 核数增长
+- 按单位分队列轮流调度，一个单位连续提交多个任务不会让其他单位一直等待
+- 按提交文件大小做准入控制：单个任务过大返回 413，队列中待处理的文件总量过大或
+  该单位排队任务过多返回 429（附 Retry-After）
+- 结果存储：每个任务的报表与状态保存在 --results-dir 下，服务重启后仍可查询与下载，
+  超过保留时间（--ttl-hours）的结果自动清理
+
+启动：
+
+    python job_server.py --port 8765 --concurrency 4
+
+界面设置环境变量 SALARY_JOB_SERVER=http://127.0.0.1:8765 后只负责上传与显示，
+处理提交到本服务（见 JobServerClient）。
+
+接口（JSON）：
+
+    POST /jobs                  提交任务，文件内容 base64 编码，返回 {"id": ...}
+    GET  /jobs?owner=单位       任务列表
+    GET  /jobs/<id>?logs=200    任务状态（含最近的日志）
+    GET  /jobs/<id>/report      下载报表
+    GET  /health                队列状态
+
+服务没有身份验证，默认只监听 127.0.0.1。
+"""
+
+import argparse
+import base64
+import json
+import os
+import shutil
+import signal
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from job_queue import (DEFAULT_CONCURRENCY, FINISHED_STATES, JOB_STATE_FILE, JobQueue, JobRejected)
+from log_config import configure_logging, get_logger
+from pipeline import InputFile, run_pipeline_job
+from snapshot_store import DEFAULT_SNAPSHOT_DIR, SnapshotStore
+
+logger = get_logger("job_server")
+
+DEFAULT_HOST = os.environ.get("SALARY_JOB_SERVER_HOST", "127.0.0.1")
+DEFAULT_PORT = int(os.environ.get("SALARY_JOB_SERVER_PORT", "8765"))
+DEFAULT_RESULTS_DIR = os.environ.get("SALARY_RESULTS_DIR", "results")
+DEFAULT_RESULT_TTL_HOURS = float(os.environ.get("SALARY_RESULT_TTL_HOURS", "72"))
+# 界面使用的服务地址；为空时界面在本进程内处理
+JOB_SERVER_URL = os.environ.get("SALARY_JOB_SERVER", "")
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# run_pipeline 的位置参数，提交时按名称编码
+PIPELINE_ARGS = ("sources", "deduction", "field_mappings", "salary_date")
+
+
+class JobServerError(Exception):
+    """任务服务不可用或返回错误。"""
+
+
+# --- 请求编码 ---
+def _encode_file(input_file):
+    if input_file is None:
+        return None
+    input_file = InputFile.open(input_file)
+    return {"name": input_file.name, "digest": input_file.digest, "data": base64.b64encode(input_file.data).decode("ascii")}
+
+
+def _decode_file(entry):
+    if not entry:
+        return None
+    return InputFile(base64.b64decode(entry["data"]), entry.get("name", ""), entry.get("digest"))
+
+
+def encode_pipeline_request(args, kwargs, name: str = "", owner: str = "") -> dict:
+    """把 run_pipeline_job 的参数编码为可 JSON 序列化的请求体。"""
+    request = dict(zip(PIPELINE_ARGS, args))
+    request.update(kwargs)
+    salary_date = request["salary_date"]
+    return {
+        "name": name,
+        "owner": owner,
+        "sources": [_encode_file(source) for source in request["sources"]],
+        "deduction": _encode_file(request["deduction"]),
+        "template": _encode_file(request.get("template")),
+        "field_mappings": request["field_mappings"],
+        "salary_date": salary_date.strftime("%Y-%m-%d") if hasattr(salary_date, "strftime") else str(salary_date),
+        "unit_name": request.get("unit_name"),
+        "identity_column": request.get("identity_column"),
+        "key_identifier_columns": request.get("key_identifier_columns"),
+        "stop_on_error": request.get("stop_on_error", True),
+        "use_snapshots": request.get("snapshot_store") is not None,
+        "profile_capture": request.get("profile_capture"),
+        "chunk_rows": request.get("chunk_rows"),
+        "fuzzy_threshold": request.get("fuzzy_threshold"),
+    }
+
+
+def decode_pipeline_request(payload: dict, snapshot_store=None):
+    """
+    解码提交的请求。
+
+    Returns:
+        (args, kwargs, 文件总字节数)
+
+    Raises:
+        ValueError: 请求体不是对象、缺少必要字段或内容无法解码。
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("请求体应为 JSON 对象。")
+    for key in ("sources", "deduction", "field_mappings", "salary_date"):
+        if not payload.get(key):
+            raise ValueError(f"缺少字段: {key}")
+    try:
+        sources = [_decode_file(entry) for entry in payload["sources"]]
+        deduction = _decode_file(payload["deduction"])
+        template = _decode_file(payload.get("template"))
+        salary_date = datetime.strptime(payload["salary_date"], "%Y-%m-%d")
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"请求内容无效: {e}") from e
+    cost = sum(len(f.data) for f in sources + [deduction, template] if f is not None)
+    kwargs = {
+        "template": template,
+        "identity_column": payload.get("identity_column"),
+        "key_identifier_columns": payload.get("key_identifier_columns"),
+        "snapshot_store": snapshot_store if payload.get("use_snapshots") else None,
+        "stop_on_error": bool(payload.get("stop_on_error", True)),
+        # 服务的并行在任务之间（进程池），任务内部不再开进程
+        "workers": 1,
+        "profile_capture": payload.get("profile_capture"),
+    }
+    if payload.get("unit_name"):
+        kwargs["unit_name"] = payload["unit_name"]
+    try:
+        if payload.get("chunk_rows") is not None:
+            kwargs["chunk_rows"] = int(payload["chunk_rows"])
+        if payload.get("fuzzy_threshold") is not None:
+            kwargs["fuzzy_threshold"] = float(payload["fuzzy_threshold"])
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"请求内容无效: {e}") from e
+    return (sources, deduction, payload["field_mappings"], salary_date), kwargs, cost
+
+
+# --- 结果存储 ---
+class ResultStore:
+    """
+    任务目录（报表与 job.json）的查询与清理。
+
+    Attributes:
+        root: 结果根目录，每个任务一个子目录。
+    """
+
+    def __init__(self, root: str = DEFAULT_RESULTS_DIR):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _job_dir(self, job_id: str):
+        # 任务 ID 为十六进制，拒绝其他字符以免访问到结果目录之外
+        if not job_id or not all(c in "0123456789abcdef" for c in job_id):
+            return None
+        return os.path.join(self.root, job_id)
+
+    def load(self, job_id: str):
+        """读取已结束任务的状态，不存在时返回 None。"""
+        job_dir = self._job_dir(job_id)
+        path = os.path.join(job_dir, JOB_STATE_FILE) if job_dir else None
+        if not path or not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def report_path(self, state: dict):
+        """任务状态中的报表路径（限定在结果目录内）。"""
+        path = (state.get("result") or {}).get("output_path")
+        if not path:
+            return None
+        path = os.path.abspath(path)
+        if os.path.commonpath([path, self.root]) != self.root or not os.path.exists(path):
+            return None
+        return path
+
+    def cleanup(self, max_age_hours: float, keep=()) -> int:
+        """删除修改时间早于 max_age_hours 的任务目录（keep 中的任务除外），返回删除数量。"""
+        cutoff = time.time() - max_age_hours * 3600
+        removed = 0
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and entry.name not in keep and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+        if removed:
+            logger.info("已清理 %s 个过期的任务结果", removed)
+        return removed
+
+
+# --- HTTP 服务 ---
+class JobRequestHandler(BaseHTTPRequestHandler):
+    server_version = "SalaryJobServer/1.0"
+
+    @property
+    def queue(self) -> JobQueue:
+        return self.server.queue
+
+    @property
+    def store(self) -> ResultStore:
+        return self.server.store
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def _send_json(self, status: int, data, headers=None) -> None:
+        body = json.dumps(data, ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: int, message: str, headers=None) -> None:
+        self._send_json(status, {"error": message}, headers)
+
+    def _job_state(self, job_id: str, log_limit: int):
+        job = self.queue.get(job_id)
+        if job is not None:
+            return dict(job.to_dict(log_limit=log_limit), queued_ahead=self.queue.queued_ahead(job_id))
+        state = self.store.load(job_id)
+        if state is not None and "logs" in state:
+            state["logs"] = state["logs"][-log_limit:] if log_limit else []
+        return state
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        parts = [part for part in url.path.split("/") if part]
+        if parts == ["health"]:
+            return self._send_json(HTTPStatus.OK, self.queue.stats())
+        if parts == ["jobs"]:
+            owner = query.get("owner", [None])[0]
+            return self._send_json(HTTPStatus.OK, [job.to_dict() for job in self.queue.jobs(owner)])
+        if len(parts) in (2, 3) and parts[0] == "jobs":
+            try:
+                log_limit = int(query.get("logs", ["0"])[0] or 0)
+            except ValueError:
+                log_limit = -1
+            if log_limit < 0:
+                return self._send_error(HTTPStatus.BAD_REQUEST, "logs 参数应为非负整数。")
+            state = self._job_state(parts[1], log_limit)
+            if state is None:
+                return self._send_error(HTTPStatus.NOT_FOUND, "任务不存在或已过期。")
+            if len(parts) == 2:
+                return self._send_json(HTTPStatus.OK, state)
+            if parts[2] == "report":
+                return self._send_report(state)
+        self._send_error(HTTPStatus.NOT_FOUND, "未知的地址。")
+
+    def _send_report(self, state: dict) -> None:
+        path = self.store.report_path(state) if state["status"] in FINISHED_STATES else None
+        if path is None:
+            return self._send_error(HTTPStatus.NOT_FOUND, "报表尚未生成。")
+        file_name = os.path.basename(path)
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", XLSX_MIME)
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{urllib.parse.quote(file_name)}")
+        self.end_headers()
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, self.wfile)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            return self._send_error(HTTPStatus.NOT_FOUND, "未知的地址。")
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            return self._send_error(HTTPStatus.BAD_REQUEST, "Content-Length 无效。")
+        # base64 使请求体约为文件大小的 4/3，读取前先按请求体大小拒绝明显过大的任务
+        if self.queue.max_job_bytes and length > self.queue.max_job_bytes * 4 // 3 + 1024 * 1024:
+            self.close_connection = True
+            return self._send_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "提交的文件超过单个任务大小上限。")
+        try:
+            payload = json.loads(self.rfile.read(length))
+            args, kwargs, cost = decode_pipeline_request(payload, self.server.snapshot_store)
+        except ValueError as e:
+            return self._send_error(HTTPStatus.BAD_REQUEST, str(e))
+        owner = payload.get("owner") or payload.get("unit_name") or ""
+        try:
+            job_id = self.queue.submit(run_pipeline_job, *args, name=payload.get("name", ""), owner=owner,
+                                       cost=cost, **kwargs)
+        except JobRejected as e:
+            if e.reason == "too_large":
+                return self._send_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, str(e))
+            return self._send_error(HTTPStatus.TOO_MANY_REQUESTS, str(e), {"Retry-After": "30"})
+        self._send_json(HTTPStatus.ACCEPTED, {"id": job_id})
+
+
+class JobServer(ThreadingHTTPServer):
+    """持有任务队列与结果存储的 HTTP 服务。"""
+
+    daemon_threads = True
+
+    def __init__(self, address, queue: JobQueue, store: ResultStore, snapshot_store=None):
+        super().__init__(address, JobRequestHandler)
+        self.queue = queue
+        self.store = store
+        self.snapshot_store = snapshot_store
+
+
+def _cleanup_loop(queue: JobQueue, store: ResultStore, ttl_hours: float, interval: float = 3600) -> None:
+    while True:
+        active = {job.id for job in queue.jobs() if job.status not in FINISHED_STATES}
+        try:
+            store.cleanup(ttl_hours, keep=active)
+        except OSError as e:
+            logger.warning("清理任务结果失败: %s", e)
+        time.sleep(interval)
+
+
+# --- 客户端 ---
+class RemoteJob:
+    """服务返回的任务状态，属性与 job_queue.Job 相同，供界面直接显示。"""
+
+    def __init__(self, data: dict):
+        self.id = data["id"]
+        self.name = data.get("name", "")
+        self.owner = data.get("owner", "")
+        self.status = data["status"]
+        self.stage = data.get("stage", "")
+        self.progress = data.get("progress", 0.0)
+        self.message = data.get("message", "")
+        self.result = data.get("result")
+        self.error = data.get("error")
+        self.created = data.get("created")
+        self.started = data.get("started")
+        self.finished = data.get("finished")
+        self.logs = [tuple(entry) for entry in data.get("logs", [])]
+        self.queued_ahead = data.get("queued_ahead", 0)
+
+    @property
+    def output_path(self):
+        return self.result.get("output_path") if isinstance(self.result, dict) else None
+
+
+class JobServerClient:
+    """
+    任务服务的客户端，接口与 JobQueue 相同（submit/get/jobs/queued_ahead/report），
+    界面可以不区分本地队列与远程服务。只能提交 run_pipeline_job。
+
+    Args:
+        base_url: 服务地址，如 http://127.0.0.1:8765。
+        timeout: 单次请求超时秒数。
+        log_limit: 查询任务状态时返回的日志条数。
+    """
+
+    def __init__(self, base_url: str = JOB_SERVER_URL, timeout: float = 30, log_limit: int = 200):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.log_limit = log_limit
+
+    def _request(self, method: str, path: str, payload=None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8") if payload is not None else None
+        request = urllib.request.Request(f"{self.base_url}{path}", data=data, method=method,
+                                         headers={"Content-Type": "application/json"} if data else {})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.read(), response.headers
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read()).get("error", e.reason)
+            except ValueError:
+                message = e.reason
+            if e.code == HTTPStatus.REQUEST_ENTITY_TOO_LARGE:
+                raise JobRejected(message, reason="too_large") from e
+            if e.code == HTTPStatus.TOO_MANY_REQUESTS:
+                raise JobRejected(message, reason="busy") from e
+            if e.code == HTTPStatus.NOT_FOUND:
+                return None, None
+            raise JobServerError(f"任务服务返回错误 {e.code}: {message}") from e
+        except (urllib.error.URLError, OSError) as e:
+            raise JobServerError(f"无法连接任务服务 {self.base_url}: {e}") from e
+
+    def submit(self, func, *args, name: str = "", owner: str = "", cost: int = 0, **kwargs) -> str:
+        """
+        提交任务并返回任务 ID。
+
+        Raises:
+            JobRejected: 服务拒绝（过大或繁忙）。
+            JobServerError: 服务不可用。
+        """
+        if func is not run_pipeline_job:
+            raise ValueError("任务服务只能执行 run_pipeline_job。")
+        kwargs.pop("workers", None)
+        body, _ = self._request("POST", "/jobs", encode_pipeline_request(args, kwargs, name=name, owner=owner))
+        return json.loads(body)["id"]
+
+    def get(self, job_id: str):
+        """任务状态；任务不存在或服务暂时不可用时返回 None。"""
+        try:
+            body, _ = self._request("GET", f"/jobs/{urllib.parse.quote(job_id)}?logs={self.log_limit}")
+        except JobServerError as e:
+            logger.warning("%s", e)
+            return None
+        return RemoteJob(json.loads(body)) if body is not None else None
+
+    def jobs(self, owner: str = None) -> list:
+        query = f"?owner={urllib.parse.quote(owner)}" if owner is not None else ""
+        body, _ = self._request("GET", f"/jobs{query}")
+        return [RemoteJob(data) for data in json.loads(body or b"[]")]
+
+    def queued_ahead(self, job_id: str) -> int:
+        job = self.get(job_id)
+        return job.queued_ahead if job is not None else 0
+
+    def report(self, job_id: str):
+        """下载报表，返回 (文件名, 内容 bytes)；没有报表时返回 None。"""
+        body, headers = self._request("GET", f"/jobs/{urllib.parse.quote(job_id)}/report")
+        if body is None:
+            return None
+        disposition = headers.get("Content-Disposition", "")
+        file_name = urllib.parse.unquote(disposition.split("''", 1)[1]) if "''" in disposition else f"{job_id}.xlsx"
+        return file_name, body
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="工资表处理任务服务")
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"监听地址（默认: {DEFAULT_HOST}）")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"端口（默认: {DEFAULT_PORT}）")
+    parser.add_argument("-c", "--concurrency", type=int, default=max(DEFAULT_CONCURRENCY, os.cpu_count() or 1),
+                        help="同时处理的任务数（工作进程数，默认取 CPU 核数）")
+    parser.add_argument("--threads", action="store_true", help="在线程中执行任务（调试用，不使用进程池）")
+    parser.add_argument("--results-dir", default=DEFAULT_RESULTS_DIR, help=f"结果目录（默认: {DEFAULT_RESULTS_DIR}）")
+    parser.add_argument("--ttl-hours", type=float, default=DEFAULT_RESULT_TTL_HOURS,
+                        help=f"结果保留小时数（默认: {DEFAULT_RESULT_TTL_HOURS:g}）")
+    parser.add_argument("--max-job-mb", type=float, help="单个任务文件大小上限 MB（默认取 SALARY_JOB_MAX_MB）")
+    parser.add_argument("--max-pending-mb", type=float, help="待处理文件总大小上限 MB（默认取 SALARY_JOB_MAX_PENDING_MB）")
+    parser.add_argument("--max-per-unit", type=int, help="每个单位排队任务数上限（默认取 SALARY_JOB_MAX_PER_UNIT）")
+    parser.add_argument("--snapshots", action="store_true", help=f"读写 Arrow 数据快照（目录: {DEFAULT_SNAPSHOT_DIR}）")
+    parser.add_argument("--log-level", help="日志级别（默认取 SALARY_LOG_LEVEL 或 INFO）")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    configure_logging(level=args.log_level, force=args.log_level is not None)
+    store = ResultStore(args.results_dir)
+    snapshot_store = SnapshotStore() if args.snapshots else None
+    queue = JobQueue(
+        concurrency=args.concurrency,
+        use_processes=not args.threads,
+        work_root=store.root,
+        max_job_bytes=int(args.max_job_mb * 1024 * 1024) if args.max_job_mb is not None else None,
+        max_pending_bytes=int(args.max_pending_mb * 1024 * 1024) if args.max_pending_mb is not None else None,
+        max_queued_per_owner=args.max_per_unit,
+    )
+    threading.Thread(target=_cleanup_loop, args=(queue, store, args.ttl_hours), name="salary-result-cleanup",
+                     daemon=True).start()
+    server = JobServer((args.host, args.port), queue, store, snapshot_store)
+    logger.info("任务服务已启动: http://%s:%s（%s 个%s，结果目录 %s）", args.host, args.port, queue.concurrency,
+                "线程" if args.threads else "进程", store.root)
+    # kill/systemd 停止服务时同样关闭工作进程
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        queue.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+关键标识匹配
+
+把源数据行与参照表（扣款表）的记录按一个或多个关键列（如 姓名 + 身份证号、姓名 + 部门）对应起来，
+按可信度从高到低逐级匹配，每一级只处理上一级没有匹配上的行：
+
+1. exact      规范化后的组合键完全相同（全角转半角、去空白，见 normalize_key）
+2. normalized 进一步去掉标点与分隔符并忽略大小写后相同（如 "阿卜杜·热合曼" 与 "阿卜杜热合曼"）
+3. partial    行内部分关键列为空时，只按不为空的列匹配（要求这些列在参照表中唯一）
+4. fuzzy      字符 bigram（按多重集）的 Dice 相似度不低于阈值，且最相似的候选唯一
+
+模糊匹配通过 bigram 倒排索引取候选，不做两两比较；出现次数过多的 bigram（如常见姓氏）
+不参与取候选，整体耗时与行数近似线性。
+"""
+
+import math
+import os
+from collections import Counter, defaultdict
+
+import numpy as np
+import pandas as pd
+
+MATCH_EXACT = "exact"
+MATCH_NORMALIZED = "normalized"
+MATCH_PARTIAL = "partial"
+MATCH_FUZZY = "fuzzy"
+# 各级匹配的置信度；模糊匹配的置信度为相似度本身
+MATCH_CONFIDENCE = {MATCH_EXACT: 1.0, MATCH_NORMALIZED: 0.98, MATCH_PARTIAL: 0.9}
+
+# 模糊匹配的最低相似度，默认为 1（不做模糊匹配）：模糊匹配到的扣款金额需人工核对，只在明确开启时使用。
+# 设为 0.9 时两个字的姓名差一个字不会被匹配，姓名 + 18 位证件号中错一个字符可以匹配
+DEFAULT_FUZZY_THRESHOLD = float(os.environ.get("SALARY_FUZZY_MATCH_THRESHOLD", "1"))
+# 每个待匹配值最多精算相似度的候选数
+FUZZY_CANDIDATES = 20
+
+_KEY_SEPARATOR = "\x1f"
+
+
+def normalize_key(values: pd.Series) -> pd.Series:
+    """关键标识规范化：全角字符转半角 (NFKC)、去掉所有空白（含全角空格）；空值与空字符串为缺失。"""
+    if pd.api.types.is_float_dtype(values) and (values.dropna() % 1 == 0).all():
+        # Excel 中存为数字的编号 (工号、证件号) 读出为浮点，按整数比较，避免与文本形式的 "123" 对不上
+        values = values.astype("Int64")
+    text = values.astype("string").str.normalize("NFKC").str.replace(r"\s+", "", regex=True)
+    return text.mask(text == "")
+
+
+def loose_key(values: pd.Series) -> pd.Series:
+    """在 normalize_key 的基础上去掉标点、分隔符并统一大小写。"""
+    # 按 object 列用 Python 正则处理：Arrow 字符串的正则中 \W 只识别 ASCII，会把汉字当作标点去掉
+    text = normalize_key(values).astype(object).str.replace(r"[\W_]+", "", regex=True).str.casefold()
+    return text.astype("string").mask(text == "")
+
+
+def composite_key(parts) -> pd.Series:
+    """把已规范化的多列关键标识拼接为一列；任一列为空时该行为空。"""
+    # 全部为空的列经 to_numpy 后是 object 类型，不能与字符串列相加，统一为 string 类型
+    parts = [part.astype("string") for part in parts]
+    key = parts[0]
+    for part in parts[1:]:
+        key = key + _KEY_SEPARATOR + part
+    return key
+
+
+def display_key(values) -> str:
+    """组合键的可读形式，用于日志与核对清单。"""
+    return " / ".join(str(v) for v in values)
+
+
+def _bigrams(text: str) -> Counter:
+    padded = f"\x02{text}\x03"
+    return Counter(padded[i:i + 2] for i in range(len(padded) - 1))
+
+
+def _dice(a: Counter, b: Counter) -> float:
+    # 按多重集计算：证件号中重复出现的数字对各自计数
+    return 2.0 * sum((a & b).values()) / (sum(a.values()) + sum(b.values()))
+
+
+class NgramIndex:
+    """
+    字符 bigram 倒排索引，用于模糊匹配取候选。
+
+    Args:
+        keys: 参照键，索引为参照表中的行位置，值为字符串。
+        max_postings: 出现在多于这么多条记录中的 bigram 不参与取候选，默认 max(64, √n)。
+    """
+
+    def __init__(self, keys: pd.Series, max_postings: int = None):
+        self._keys = dict(zip(keys.index.tolist(), keys.tolist()))
+        postings = defaultdict(list)
+        for position, key in self._keys.items():
+            padded = f"\x02{key}\x03"
+            for gram in {padded[i:i + 2] for i in range(len(padded) - 1)}:
+                postings[gram].append(position)
+        limit = max_postings or max(64, int(math.sqrt(len(self._keys))))
+        self._postings = {gram: rows for gram, rows in postings.items() if len(rows) <= limit}
+
+    def search(self, query: str, threshold: float, exclude=frozenset()):
+        """返回相似度不低于 threshold 且唯一最高的 (行位置, 相似度)，没有时返回 None。"""
+        grams = _bigrams(query)
+        counts = Counter()
+        for gram in grams:
+            counts.update(self._postings.get(gram, ()))
+        best, best_score, second_score = None, 0.0, 0.0
+        for position, _ in counts.most_common(FUZZY_CANDIDATES):
+            if position in exclude:
+                continue
+            score = _dice(grams, _bigrams(self._keys[position]))
+            if score > best_score:
+                best, best_score, second_score = position, score, best_score
+            elif score > second_score:
+                second_score = score
+        if best is None or best_score < threshold or best_score == second_score:
+            return None
+        return best, best_score
+
+
+class KeyMatcher:
+    """
+    参照表关键列上的分级匹配器。各级查找表在第一次用到时建立并缓存，多个源文件共用。
+
+    Args:
+        keys: 参照表的关键列（原始值），行位置即匹配结果中的位置。
+    """
+
+    def __init__(self, keys: pd.DataFrame):
+        self.columns = list(keys.columns)
+        self._keys = keys.reset_index(drop=True)
+        self._exact = pd.DataFrame({col: normalize_key(self._keys[col]) for col in self.columns})
+        self._loose = None   # 宽松规范化较慢，只在有行精确匹配不上时计算
+        self._lookups = {}   # {(列, 是否宽松): (键 Index, 行位置)}
+        self._ngrams = {}    # {列: NgramIndex}
+
+    def __len__(self) -> int:
+        return len(self._exact)
+
+    @property
+    def loose(self) -> pd.DataFrame:
+        if self._loose is None:
+            self._loose = pd.DataFrame({col: loose_key(self._keys[col]) for col in self.columns})
+        return self._loose
+
+    def _lookup(self, columns: tuple, loose: bool):
+        cache_key = (columns, loose)
+        if cache_key not in self._lookups:
+            frame = self.loose if loose else self._exact
+            keys = composite_key(frame[col] for col in columns)
+            # 同一个键对应多条记录时无法确定是哪一条，该键不参与匹配
+            valid = (keys.notna() & ~keys.duplicated(keep=False)).to_numpy()
+            self._lookups[cache_key] = (pd.Index(keys[valid].to_numpy()), np.flatnonzero(valid))
+        return self._lookups[cache_key]
+
+    def _find(self, keys: pd.Series, columns: tuple, loose: bool) -> np.ndarray:
+        index, positions = self._lookup(columns, loose)
+        found = index.get_indexer(keys.fillna(""))
+        return np.where(found >= 0, positions[np.maximum(found, 0)], -1)
+
+    def _ngram_index(self, columns: tuple) -> NgramIndex:
+        if columns not in self._ngrams:
+            keys = composite_key(self.loose[col] for col in columns).dropna()
+            self._ngrams[columns] = NgramIndex(keys)
+        return self._ngrams[columns]
+
+    def match(self, keys: pd.DataFrame, fuzzy_threshold: float = None, claimed: set = None):
+        """
+        逐级匹配源数据的关键列。
+
+        Args:
+            keys: 源数据的关键列，列名为本匹配器 columns 的子集（源数据缺少的列不参与匹配）。
+            fuzzy_threshold: 模糊匹配的最低相似度，默认 DEFAULT_FUZZY_THRESHOLD；不低于 1 时不做模糊匹配。
+            claimed: 分块匹配同一份源数据时在各块间共用的集合：其中的参照表行位置（之前各块已匹配的记录）
+                不作为模糊匹配的候选，本次匹配到的行位置加入其中。
+
+        Returns:
+            (参照表行位置, 匹配方式, 置信度) 三个与 keys 等长的数组；未匹配的行位置为 -1、方式为 None、置信度为 NaN。
+        """
+        columns = tuple(col for col in self.columns if col in keys.columns)
+        threshold = DEFAULT_FUZZY_THRESHOLD if fuzzy_threshold is None else fuzzy_threshold
+        n = len(keys)
+        positions = np.full(n, -1, dtype=np.int64)
+        methods = np.full(n, None, dtype=object)
+        confidence = np.full(n, np.nan)
+        if not columns or not len(self) or not n:
+            return positions, methods, confidence
+
+        def assign(rows, found, method, scores=None):
+            hit = found >= 0
+            rows, found = rows[hit], found[hit]
+            positions[rows] = found
+            methods[rows] = method
+            confidence[rows] = MATCH_CONFIDENCE[method] if scores is None else scores[hit]
+            if claimed is not None:
+                claimed.update(found.tolist())
+
+        exact = pd.DataFrame({col: normalize_key(keys[col]).to_numpy() for col in columns})
+        rows = np.flatnonzero(exact.notna().all(axis=1).to_numpy())
+        assign(rows, self._find(composite_key(exact[col] for col in columns).iloc[rows], columns, loose=False), MATCH_EXACT)
+        rest = np.flatnonzero((positions < 0) & exact.notna().any(axis=1).to_numpy())
+        if not len(rest):
+            return positions, methods, confidence
+
+        # 以下只处理精确匹配不上的行，索引为其在 keys 中的行位置
+        loose = pd.DataFrame({col: loose_key(keys[col].iloc[rest]).to_numpy() for col in columns}, index=rest)
+        present = loose.notna()
+        complete = present.all(axis=1).to_numpy()
+        loose_keys = composite_key(loose[col] for col in columns)
+        rows = rest[complete]
+        assign(rows, self._find(loose_keys.loc[rows], columns, loose=True), MATCH_NORMALIZED)
+
+        # 部分关键列为空的行：按该行不为空的列匹配，同一种缺失组合一起查找
+        partial = present.any(axis=1).to_numpy() & ~complete
+        if partial.any():
+            patterns = pd.Series([tuple(row) for row in present.to_numpy()[partial]], index=rest[partial])
+            for pattern, group in patterns.groupby(patterns, sort=False):
+                subset = tuple(col for col, has in zip(columns, pattern) if has)
+                rows = group.index.to_numpy()
+                subset_keys = composite_key(loose.loc[rows, col] for col in subset)
+                assign(rows, self._find(subset_keys, subset, loose=True), MATCH_PARTIAL)
+
+        rows = rest[complete & (positions[rest] < 0)]
+        if threshold < 1 and len(rows):
+            ngram_index = self._ngram_index(columns)
+            taken = frozenset(positions[positions >= 0].tolist()) | frozenset(claimed or ())
+            query_keys = loose_keys.loc[rows]
+            candidates = {}
+            for query in query_keys.unique():
+                hit = ngram_index.search(query, threshold, exclude=taken)
+                if hit is not None:
+                    candidates[query] = hit
+            # 两个不同的值模糊匹配到同一条记录时都不采用
+            targets = Counter(position for position, _ in candidates.values())
+            candidates = {query: hit for query, hit in candidates.items() if targets[hit[0]] == 1}
+            if candidates:
+                found = query_keys.map(lambda q: candidates.get(q, (-1, np.nan))[0]).to_numpy(dtype=np.int64)
+                scores = query_keys.map(lambda q: candidates.get(q, (-1, np.nan))[1]).to_numpy(dtype=float)
+                assign(rows, found, MATCH_FUZZY, scores)
+        return positions, methods, confidence
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+分级、惰性的日志配置
+
+处理流程各模块通过 get_logger(__name__) 取得 "salary.<模块名>" 日志器，替代 print：
+- 级别过滤在格式化之前完成，DEBUG 关闭时 logger.debug("...%s", preview(df))
+  不会调用 df.head().to_string()，也不会构造消息字符串
+- 开销大的内容用 Lazy / preview 包装，只在真正输出时求值
+- 总级别与各模块级别通过环境变量配置：
+      SALARY_LOG_LEVEL=INFO
+      SALARY_LOG_LEVELS=fiscal_report_full_script=DEBUG,formula_engine=WARNING
+- RingBufferHandler 为界面保留最近 N 条已格式化的日志，内存占用有上限；
+  route_thread_logs 把当前线程产生的日志转发到该会话的缓冲区
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+LOGGER_NAMESPACE = "salary"
+SUCCESS = 25
+logging.addLevelName(SUCCESS, "SUCCESS")
+
+DEFAULT_LEVEL = os.environ.get("SALARY_LOG_LEVEL", "INFO")
+DEFAULT_MODULE_LEVELS = os.environ.get("SALARY_LOG_LEVELS", "")
+DEFAULT_BUFFER_SIZE = int(os.environ.get("SALARY_LOG_BUFFER", "2000"))
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+
+_configure_lock = threading.Lock()
+_configured = False
+_thread_route = threading.local()
+
+
+class Lazy:
+    """延迟求值的日志参数：仅当该条日志真正输出时才调用 func。"""
+
+    __slots__ = ("func",)
+
+    def __init__(self, func):
+        self.func = func
+
+    def __str__(self) -> str:
+        return str(self.func())
+
+    __repr__ = __str__
+
+
+def preview(df, n: int = 5) -> Lazy:
+    """DataFrame/Series 前 n 行的惰性文本。"""
+    return Lazy(lambda: df.head(n).to_string())
+
+
+def level_number(level) -> int:
+    """把 "DEBUG"/"SUCCESS" 等级别名或数字转换为级别数字，未知名称按 INFO 处理。"""
+    if isinstance(level, int):
+        return level
+    value = logging.getLevelName(str(level).upper())
+    return value if isinstance(value, int) else logging.INFO
+
+
+def get_logger(name: str) -> logging.Logger:
+    """返回 salary 命名空间下的日志器，name 通常为模块的 __name__。"""
+    if name == LOGGER_NAMESPACE or name.startswith(LOGGER_NAMESPACE + "."):
+        return logging.getLogger(name)
+    return logging.getLogger(f"{LOGGER_NAMESPACE}.{name}")
+
+
+def parse_module_levels(spec: str) -> dict:
+    """解析 "模块=级别,模块=级别" 形式的配置。"""
+    levels = {}
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        module, level = item.split("=", 1)
+        if module.strip():
+            levels[module.strip()] = level_number(level.strip())
+    return levels
+
+
+def configure_logging(level=None, module_levels=None, stream=None, force: bool = False) -> logging.Logger:
+    """
+    配置 salary 命名空间的日志输出（默认输出到 stderr），重复调用时只生效一次（force 除外）。
+
+    Args:
+        level: 总级别，默认取环境变量 SALARY_LOG_LEVEL。
+        module_levels: {模块名: 级别} 或 "模块=级别,..." 字符串，默认取 SALARY_LOG_LEVELS。
+        stream: 输出流，默认 sys.stderr。
+        force: 为 True 时重新配置（如命令行参数覆盖环境变量）。
+    """
+    global _configured
+    root = logging.getLogger(LOGGER_NAMESPACE)
+    with _configure_lock:
+        if _configured and not force:
+            return root
+        root.setLevel(level_number(level or DEFAULT_LEVEL))
+        for handler in [h for h in root.handlers if getattr(h, "_salary_stream_handler", False)]:
+            root.removeHandler(handler)
+        handler = logging.StreamHandler(stream or sys.stderr)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handler._salary_stream_handler = True
+        root.addHandler(handler)
+        root.propagate = False
+
+        if module_levels is None:
+            module_levels = DEFAULT_MODULE_LEVELS
+        if isinstance(module_levels, str):
+            module_levels = parse_module_levels(module_levels)
+        for module, module_level in module_levels.items():
+            get_logger(module).setLevel(level_number(module_level))
+        _configured = True
+    return root
+
+
+class RingBufferHandler(logging.Handler):
+    """
+    保留最近 capacity 条日志的处理器，供界面显示。
+
+    记录在 emit 时即格式化为 (时间戳, 级别名, 日志器名, 消息)，不持有 LogRecord 及其参数
+    （避免通过参数引用大 DataFrame）。
+    """
+
+    def __init__(self, capacity: int = DEFAULT_BUFFER_SIZE, level=logging.INFO):
+        super().__init__(level_number(level))
+        self.entries = deque(maxlen=capacity)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            message = record.getMessage()
+        except Exception:
+            self.handleError(record)
+            return
+        self.add(record.levelname, message, name=record.name, created=record.created)
+
+    def add(self, level, message: str, name: str = "", created: float = None) -> None:
+        """直接追加一条已格式化的消息（界面自身的日志不经过 logging）。"""
+        levelname = level if isinstance(level, str) else logging.getLevelName(level)
+        if level_number(levelname) < self.level:
+            return
+        self.entries.append((created or time.time(), levelname, name, message))
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+
+class _ThreadRouteHandler(logging.Handler):
+    """把日志转发给当前线程绑定的缓冲区（见 route_thread_logs）。"""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        target = getattr(_thread_route, "handler", None)
+        if target is None or record.name in _thread_route.exclude:
+            return
+        if record.levelno >= target.level:
+            target.handle(record)
+
+
+_route_handler = _ThreadRouteHandler()
+
+
+def route_thread_logs(handler: logging.Handler, exclude=()) -> None:
+    """
+    把当前线程此后产生的 salary.* 日志转发到 handler（handler 为 None 时解除绑定）。
+
+    Streamlit 每个会话的脚本在各自线程中运行，在脚本开头绑定该会话的 RingBufferHandler，
+    多个会话同时处理时日志互不混入；绑定随线程结束而失效，不会在全局日志器上累积处理器。
+
+    Args:
+        handler: 接收日志的处理器。
+        exclude: 不转发的日志器名称（例如已直接写入缓冲区的界面日志器）。
+    """
+    root = logging.getLogger(LOGGER_NAMESPACE)
+    if _route_handler not in root.handlers:
+        with _configure_lock:
+            if _route_handler not in root.handlers:
+                root.addHandler(_route_handler)
+    _thread_route.handler = handler
+    _thread_route.exclude = frozenset(exclude)
@@ -0,0 +1,925 @@
+# -*- coding: utf-8 -*-
+"""
+不依赖界面的完整处理流程
+
+app.py 的 "开始处理数据" 与命令行批处理 (batch_run.py) 共用这里的步骤：
+读取并数值化扣款表 → 按源文件字段预过滤映射规则 → 逐个源文件调用 process_sheet
+→ 合并并按模板排列 → 写出格式化报表。
+
+各源文件字段映射后的结果按 源文件哈希 + 规则哈希 缓存（进程内 mapped_frame_cache，
+启用快照时另存 mapped 快照），只修正扣款表后重跑时只重新合并扣款、计算与导出。
+
+多个源文件之间互不依赖（只共享只读的扣款表与规则），process_sources 可以把它们分发到
+进程池并行处理：扣款表与规则在进程初始化时传给每个工作进程一次，各文件的结果按原顺序合并，
+单个文件出错不影响其他文件。
+
+超大的源数据表（如市级汇总）可以分块处理 (chunk_rows / SALARY_CHUNK_ROWS)：stream_sources 每次只读取、
+映射、合并与计算一块，结果追加到临时文件并累计列宽，全部文件处理完后再逐块读回写出报表，
+内存占用与块大小而不是表的行数成正比。此时不读写源数据/合并结果快照，PipelineResult.report 为 None。
+
+输入既可以是文件路径，也可以是 bytes / 上传文件对象；
+目录输入按文件名自动识别扣款表（含 "扣款"/"扣费"）和导出模板（含 "模板"），其余为源数据表。
+"""
+
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from fiscal_report_full_script import (DEFAULT_UNIT_NAME, MATCH_COLUMNS, MATCH_CONFIDENCE_COLUMN, MATCH_METHOD_COLUMN,
+                                       MATCH_RECORD_COLUMN, ColumnLayout, DeductionIndex, RuleRegistry, StyledReportWriter,
+                                       export_excel_with_styles, process_sheet, process_sheet_chunks)
+from frame_schema import compact_frame, concat_frames, expand_frame
+from input_cache import ParsedInputCache, combine_digests, content_digest
+from key_matching import MATCH_EXACT, display_key
+from log_config import LOGGER_NAMESPACE, SUCCESS, get_logger, preview
+from snapshot_store import SnapshotStore
+from stage_profiler import DEFAULT_PROFILE_CAPTURE, RunProfiler
+from workbook_reader import DEFAULT_HEADER_KEYWORDS, WorkbookSnapshot, WorkbookStream
+
+logger = get_logger(__name__)
+
+# 扣款表与导出模板的表头都在第三行
+DEDUCTION_HEADER_ROW = 2
+TEMPLATE_HEADER_ROW = 2
+DEDUCTION_FILE_KEYWORDS = ("扣款", "扣费")
+TEMPLATE_FILE_KEYWORDS = ("模板",)
+# 未指定时依次尝试的规则匹配字段（与界面的默认选择一致）
+IDENTITY_COLUMN_CANDIDATES = ("人员身份", "岗位类别")
+# 并行处理源文件的默认进程数（1 为在当前进程中顺序处理）
+DEFAULT_WORKERS = int(os.environ.get("SALARY_WORKERS", "1"))
+# 默认分块处理源文件的每块行数（0 为整表读入内存处理）
+DEFAULT_CHUNK_ROWS = int(os.environ.get("SALARY_CHUNK_ROWS", "0"))
+# 处理阶段及显示名称（进度报告用）
+PIPELINE_STAGES = {"read": "读取", "map": "字段映射", "merge": "合并扣款", "calculate": "计算", "export": "导出"}
+# 单个源文件内各阶段完成时的进度
+_FILE_STAGE_FRACTIONS = {"read": 0.25, "map": 0.5, "merge": 0.75, "calculate": 1.0}
+# Streamlit 服务进程是多线程的，fork 可能复制持有中的锁，默认使用 spawn 启动工作进程
+MP_START_METHOD = os.environ.get("SALARY_MP_START_METHOD", "spawn")
+# 字段映射结果（合并扣款之前）的进程内缓存上限 (MB)：只修改扣款表后重跑时各源文件不再重新解析与映射
+MAPPED_CACHE_MB = int(os.environ.get("SALARY_MAPPED_CACHE_MB", "256"))
+mapped_frame_cache = ParsedInputCache(max_bytes=MAPPED_CACHE_MB * 1024 * 1024)
+
+
+class PipelineError(Exception):
+    """输入不完整或无法继续处理时抛出。"""
+
+
+def is_temporary_file(path) -> bool:
+    """Excel 打开文件时生成的 ~$ 锁文件。"""
+    return os.path.basename(path).startswith("~$")
+
+
+def expand_inputs(patterns, recursive: bool = True) -> list:
+    """
+    把文件、目录与通配符展开为排序后的 xlsx 文件列表（去重，跳过 ~$ 锁文件）。
+
+    Args:
+        patterns: 路径或通配符，如 "input/公务员-事业-参公/"、"input/**/9月*.xlsx"。
+        recursive: 目录是否包含子目录。
+    """
+    if isinstance(patterns, (str, os.PathLike)):
+        patterns = [patterns]
+    paths = []
+    for pattern in patterns:
+        pattern = os.fspath(pattern)
+        if os.path.isdir(pattern):
+            matches = glob.glob(os.path.join(pattern, "**", "*.xlsx") if recursive else os.path.join(pattern, "*.xlsx"),
+                                recursive=recursive)
+        elif glob.has_magic(pattern):
+            matches = glob.glob(pattern, recursive=True)
+        else:
+            matches = [pattern]
+        paths.extend(os.path.normpath(path) for path in matches if not is_temporary_file(path))
+    return sorted(dict.fromkeys(paths))
+
+
+def classify_inputs(paths) -> dict:
+    """
+    按文件名把 xlsx 文件分为扣款表、导出模板与源数据表。
+
+    Returns:
+        {"deduction": [...], "template": [...], "sources": [...]}
+    """
+    groups = {"deduction": [], "template": [], "sources": []}
+    for path in paths:
+        name = os.path.basename(path)
+        if any(keyword in name for keyword in TEMPLATE_FILE_KEYWORDS):
+            groups["template"].append(path)
+        elif any(keyword in name for keyword in DEDUCTION_FILE_KEYWORDS):
+            groups["deduction"].append(path)
+        else:
+            groups["sources"].append(path)
+    return groups
+
+
+def load_field_mappings(source) -> list:
+    """读取映射规则 JSON（路径或已解析的 dict），并做与界面相同的顶层结构检查。"""
+    if isinstance(source, dict):
+        data = source
+    else:
+        with open(source, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    if not isinstance(data, dict) or not isinstance(data.get("field_mappings"), list):
+        raise PipelineError("映射规则 JSON 顶层结构错误：需要包含 'field_mappings' 列表。")
+    return data["field_mappings"]
+
+
+class InputFile:
+    """
+    一个输入文件的内容与哈希，解析结果按需生成一次。
+
+    Attributes:
+        name: 文件名（用于日志）。
+        data: 文件内容 bytes。
+        digest: 内容的 SHA-256。
+    """
+
+    def __init__(self, data: bytes, name: str, digest: str = None):
+        self.data = data
+        self.name = name
+        self.digest = digest or content_digest(data)
+        self._snapshot = None
+
+    @classmethod
+    def open(cls, source) -> "InputFile":
+        """source 可以是路径、bytes、上传文件对象或已有的 InputFile。"""
+        if isinstance(source, cls):
+            return source
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, "rb") as f:
+                return cls(f.read(), os.path.basename(source))
+        if isinstance(source, (bytes, bytearray)):
+            return cls(bytes(source), "")
+        return cls(source.getvalue(), getattr(source, "name", ""))
+
+    @property
+    def snapshot(self) -> WorkbookSnapshot:
+        if self._snapshot is None:
+            self._snapshot = WorkbookSnapshot.load(self.data, name=self.name)
+        return self._snapshot
+
+    def header_fields(self, keywords=DEFAULT_HEADER_KEYWORDS, max_scan_rows: int = 10) -> list:
+        """按关键字检测表头并返回列名；尚未完整解析时只读取前 max_scan_rows 行。"""
+        snapshot = self._snapshot or WorkbookSnapshot.load(self.data, name=self.name, max_rows=max_scan_rows)
+        return source_header_fields(snapshot, keywords, max_scan_rows)
+
+    def columns(self, header: int) -> list:
+        """第 header 行（0 起）的列名；尚未完整解析时只读取到该行。"""
+        snapshot = self._snapshot or WorkbookSnapshot.load(self.data, name=self.name, max_rows=header + 1)
+        return snapshot.columns(header=header)
+
+
+def deduction_snapshot_key(deduction_digest: str, key_identifier_columns) -> str:
+    """数值化后扣款表快照的键：数值化的字段取决于关键标识列（组合键中的各列都不数值化）。"""
+    return combine_digests("deduction/2", deduction_digest, tuple(key_identifier_columns))
+
+
+def combined_snapshot_key(source_digests, deduction_digest: str, registry, identity_column: str, columns) -> str:
+    """合并结果快照的键。"""
+    return combine_digests(
+        "combined",
+        tuple(source_digests),
+        deduction_digest,
+        registry.digest,
+        identity_column,
+        tuple(pd.Index(columns).astype(str)),
+    )
+
+
+def prepare_deductions(deduction_df: pd.DataFrame, key_identifier_columns, coerce: bool = True):
+    """
+    确定扣款表的关键标识列与扣款字段，并把扣款字段转换为数值（无法转换的按 0）。
+
+    Args:
+        deduction_df: 扣款表，原地修改。
+        key_identifier_columns: 用户选择的关键标识列；存在于扣款表中的列组合为匹配键（如 姓名 + 身份证号）。
+        coerce: 为 False 时跳过数值化（如数据来自已数值化的快照）。
+
+    Returns:
+        (扣款表, 关键标识列列表, 扣款字段列表)
+
+    Raises:
+        PipelineError: 扣款表不包含任何关键标识列。
+    """
+    key_columns = [col for col in key_identifier_columns if col in deduction_df.columns]
+    if not key_columns:
+        raise PipelineError(f"扣款表必须包含用户选择的关键标识列中的至少一个 ({list(key_identifier_columns)})！")
+    deduction_fields = [col for col in deduction_df.columns.tolist() if col not in key_columns]
+    if coerce:
+        for field in deduction_fields:
+            deduction_df[field] = pd.to_numeric(deduction_df[field], errors="coerce").fillna(0)
+    return deduction_df, key_columns, deduction_fields
+
+
+def filter_mappings(field_mappings, deduction_columns, source_fields, identity_column: str = None):
+    """
+    去掉源字段只存在于扣款表（源数据表中没有）的简单映射，这些字段会在合并扣款时直接带入。
+
+    Returns:
+        (过滤后的规则列表, 过滤掉的映射数)
+    """
+    deduction_columns = set(deduction_columns)
+    source_fields = set(source_fields)
+    filtered_mappings = []
+    removed = 0
+    for rule in field_mappings:
+        filtered_rule = rule.copy()
+        filtered_rule["mappings"] = []
+        for mapping in rule.get("mappings", []):
+            src = mapping.get("source_field")
+            if src is not None and src in deduction_columns and src not in source_fields:
+                logger.debug("  - 过滤掉规则 '%s' 中的无效映射: 源 '%s' 仅存在于扣款表。", rule.get(identity_column, "未知规则"), src)
+                removed += 1
+                continue
+            filtered_rule["mappings"].append(mapping)
+        filtered_mappings.append(filtered_rule)
+    return filtered_mappings, removed
+
+
+def source_header_fields(snapshot: WorkbookSnapshot, keywords=DEFAULT_HEADER_KEYWORDS, max_scan_rows: int = 10) -> list:
+    """按关键字检测源数据表的表头行并返回列名，未检测到时返回空列表。"""
+    header_row = snapshot.find_header_row(keywords, max_scan_rows=max_scan_rows)
+    return [] if header_row is None else snapshot.columns(header=header_row)
+
+
+def default_identity_column(source_fields):
+    """未指定规则匹配字段时，依次尝试 人员身份、岗位类别。"""
+    return next((col for col in IDENTITY_COLUMN_CANDIDATES if col in source_fields), None)
+
+
+def report_file_name(unit_name: str, salary_date) -> str:
+    return f"{unit_name}_{salary_date.strftime('%Y%m')}_工资发放表_已处理.xlsx"
+
+
+def build_report(results, template_fields=None) -> pd.DataFrame:
+    """
+    合并各源文件结果（compact_frame 的紧凑列类型）；提供模板字段时严格按模板筛选和排序列（模板中多出的列为空），
+    否则去掉扣款匹配的追溯列（已汇总到 log_match_summary，不写入报表）。
+    金额在按模板筛选后才从分还原为元，不在报表中的列不还原。
+    """
+    combined_df = concat_frames(results)
+    if template_fields:
+        combined_df = combined_df.reindex(columns=template_fields)
+    else:
+        combined_df = combined_df.drop(columns=list(MATCH_COLUMNS), errors="ignore")
+    return expand_frame(combined_df)
+
+
+def log_match_summary(results, deduction_index: DeductionIndex, review_limit: int = 50, exact_rows: int = 0) -> dict:
+    """
+    汇总各源文件合并扣款时的匹配情况（按 _扣款匹配方式 列）并写日志。
+    exact_rows 为 results 之外另计的精确匹配行数（分块处理时只保留需要汇总明细的行，见 inexact_match_rows）。
+
+    Returns:
+        {"key_columns": 关键标识列, "rows": 源数据行数, "deduction": 扣款表记录数, "matched": 匹配行数,
+        "methods": {匹配方式: 行数}, "unmatched": 未匹配的关键标识示例, "duplicates": 扣款表中重复的关键标识,
+        "unkeyed": 扣款表中关键列全部为空的记录数, "review": 需要核对的非精确匹配 [{"key", "method", "confidence", "record"}, ...]}；
+        结果中没有匹配信息时为 {}。
+    """
+    frames = [df for df in results if MATCH_METHOD_COLUMN in df.columns]
+    if not frames:
+        logger.warning("结果中没有扣款匹配信息，未能验证关键标识列 %s 的匹配情况。", deduction_index.key_columns)
+        return {}
+    key_columns = [col for col in deduction_index.source_key_columns(frames[0].columns) if col is not None]
+    combined = pd.concat([df.reindex(columns=key_columns + list(MATCH_COLUMNS))
+                          for df in frames], ignore_index=True)
+    keys = [display_key(row) for row in combined[key_columns].itertuples(index=False)]
+    methods = combined[MATCH_METHOD_COLUMN]
+    matched = methods.notna()
+    has_key = combined[key_columns].notna().any(axis=1)
+    counts = {str(method): int(count) for method, count in methods[matched].value_counts().items() if count}
+    if exact_rows:
+        counts[MATCH_EXACT] = counts.get(MATCH_EXACT, 0) + exact_rows
+    rows, matched_rows = len(combined) + exact_rows, int(matched.sum()) + exact_rows
+    unmatched = sorted({keys[i] for i in np.flatnonzero((~matched & has_key).to_numpy())})
+    review = [
+        {"key": keys[i], "method": str(methods.iloc[i]), "confidence": round(float(combined[MATCH_CONFIDENCE_COLUMN].iloc[i]), 4),
+         "record": str(combined[MATCH_RECORD_COLUMN].iloc[i])}
+        for i in np.flatnonzero((matched & (methods != MATCH_EXACT)).to_numpy())[:review_limit]
+    ]
+    logger.info("按关键列 %s 合并扣款: 源数据 %s 行, 扣款表 %s 条, 成功匹配 %s 行 %s",
+                key_columns, rows, len(deduction_index), matched_rows, counts)
+    if unmatched:
+        logger.warning("%s 个关键标识未能匹配到扣款数据，未匹配示例: %s", len(unmatched), unmatched[:5])
+    if review:
+        logger.warning("%s 行为非精确匹配（规范化/部分列/模糊），请核对: %s", matched_rows - counts.get(MATCH_EXACT, 0),
+                       [f"{item['key']} -> {item['record']} ({item['method']} {item['confidence']:.2f})" for item in review[:5]])
+    return {"key_columns": key_columns, "rows": rows, "deduction": len(deduction_index), "matched": matched_rows,
+            "methods": counts, "unmatched": unmatched[:review_limit], "duplicates": deduction_index.duplicates[:review_limit],
+            "unkeyed": deduction_index.unkeyed, "review": review}
+
+
+def inexact_match_rows(df: pd.DataFrame, deduction_index: DeductionIndex):
+    """
+    分块处理时汇总匹配情况用：只保留关键标识列与匹配信息列中非精确匹配（含未匹配）的行。
+
+    Returns:
+        (保留的行, 精确匹配的行数)；df 中没有匹配信息时为 (None, 0)。
+    """
+    if MATCH_METHOD_COLUMN not in df.columns:
+        return None, 0
+    key_columns = [col for col in deduction_index.source_key_columns(df.columns) if col is not None]
+    exact = (df[MATCH_METHOD_COLUMN] == MATCH_EXACT).to_numpy(dtype=bool, na_value=False)
+    columns = key_columns + [col for col in MATCH_COLUMNS if col in df.columns]
+    return df.loc[~exact, columns], int(exact.sum())
+
+
+class FileResult:
+    """单个源文件的处理结果。status 为 "ok" / "empty" / "error"。"""
+
+    def __init__(self, name: str, status: str, rows: int = 0, error: str = None):
+        self.name = name
+        self.status = status
+        self.rows = rows
+        self.error = error
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "status": self.status, "rows": self.rows, "error": self.error}
+
+
+class PipelineResult:
+    """
+    一次完整处理的结果。
+
+    Attributes:
+        report: 合并并按模板排列后的结果，没有有效数据或分块处理时为 None。
+        rows: 报表的数据行数。
+        output_path: 写出的报表路径，未写出时为 None。
+        files: 各源文件的 FileResult，顺序与输入一致。
+        snapshot_path: 合并结果快照的路径。
+        match: 扣款匹配汇总，见 log_match_summary。
+        profile: 各阶段的耗时与内存，见 stage_profiler.RunProfiler.to_dict。
+    """
+
+    def __init__(self, report=None, output_path=None, files=None, snapshot_path=None, match=None, profile=None, rows: int = 0):
+        self.report = report
+        self.rows = rows
+        self.output_path = output_path
+        self.files = files or []
+        self.snapshot_path = snapshot_path
+        self.match = match or {}
+        self.profile = profile or {}
+
+    @property
+    def ok(self) -> bool:
+        return (self.report is not None or self.rows > 0) and all(f.status != "error" for f in self.files)
+
+    def to_dict(self) -> dict:
+        return {
+            "ok": self.ok,
+            "output_path": self.output_path,
+            "rows": int(self.rows),
+            "snapshot_path": self.snapshot_path,
+            "files": [f.to_dict() for f in self.files],
+            "match": self.match,
+            "profile": self.profile,
+        }
+
+
+class _RecordCollector(logging.Handler):
+    """工作进程中收集日志，随结果带回主进程重新输出（主进程的界面日志面板才能看到）。"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.records.append((record.levelno, record.name, record.getMessage()))
+        except Exception:
+            self.handleError(record)
+
+
+# 工作进程内的只读状态，由 _init_worker 在进程启动时设置一次
+_worker_state = {}
+
+
+def _init_worker(deduction_df, field_mappings, deduction_fields, identity_column, snapshot_root,
+                 unit_name, salary_month, log_level) -> None:
+    root = logging.getLogger(LOGGER_NAMESPACE)
+    collector = _RecordCollector()
+    root.handlers = [collector]
+    root.setLevel(log_level)
+    root.propagate = False
+    _worker_state.update(
+        collector=collector,
+        context=dict(
+            deduction_df=deduction_df,
+            registry=RuleRegistry(field_mappings),
+            deduction_fields=deduction_fields,
+            identity_column=identity_column,
+            snapshot_store=SnapshotStore(snapshot_root) if snapshot_root else None,
+            unit_name=unit_name,
+            salary_month=salary_month,
+        ),
+    )
+
+
+def _process_one(source, deduction_df, registry, deduction_fields, identity_column,
+                 snapshot_store=None, unit_name: str = "", salary_month: str = "", on_stage=None, profiler=None) -> pd.DataFrame:
+    # 传入 InputFile 而不是其快照：字段映射结果命中缓存时不再解析工作簿
+    result_df = process_sheet(
+        source, deduction_df, registry, deduction_fields, identity_column, identity_column,
+        snapshot_store=snapshot_store, unit_name=unit_name, salary_month=salary_month, source_digest=source.digest,
+        on_stage=on_stage, mapped_cache=mapped_frame_cache, profiler=profiler,
+    )
+    # 结果保存到全部文件处理完（并行时还要传回主进程），转换为紧凑列类型
+    return compact_frame(result_df)
+
+
+def _process_in_worker(data: bytes, name: str, digest: str):
+    """工作进程中处理一个源文件，返回 (结果, 错误信息, 日志记录, 各阶段耗时记录)。"""
+    collector = _worker_state["collector"]
+    collector.records = []
+    profiler = RunProfiler()
+    try:
+        result_df = _process_one(InputFile(data, name, digest), profiler=profiler, **_worker_state["context"])
+        error = None
+    except Exception as e:
+        logger.debug("Traceback for %s", name, exc_info=True)
+        result_df, error = None, f"{type(e).__name__}: {e}"
+    return result_df, error, collector.records, [record.to_dict() for record in profiler.records]
+
+
+def scaled_progress(progress, start: float, end: float):
+    """把 [0, 1] 的进度映射到总进度的 [start, end] 区间；progress 为 None 时返回 None。"""
+    if progress is None:
+        return None
+    return lambda stage, fraction, message="": progress(stage, start + (end - start) * min(max(fraction, 0.0), 1.0), message)
+
+
+def _replay_records(records) -> None:
+    for levelno, name, message in records:
+        logging.getLogger(name).log(levelno, "%s", message)
+
+
+def process_sources(source_files, deduction_df, registry, deduction_fields: list, identity_column: str,
+                    snapshot_store=None, unit_name: str = "", salary_month: str = "",
+                    workers: int = DEFAULT_WORKERS, stop_on_error: bool = True, on_file_done=None, progress=None,
+                    profiler=None) -> list:
+    """
+    对每个源文件调用 process_sheet，结果顺序与输入一致。
+
+    Args:
+        source_files: InputFile 列表。
+        deduction_df: 扣款表 DataFrame，或预先建立的 DeductionIndex。
+        workers: 进程数；大于 1 且文件多于一个时使用进程池并行处理，
+            扣款表与规则在进程初始化时序列化一次，不随每个文件重复传输。
+        stop_on_error: 为 True 时某个文件出错即中止（并行时取消尚未开始的文件）；
+            为 False 时只记录该文件的错误，继续处理其他文件。
+        on_file_done: 每个文件完成时的回调 on_file_done(序号, FileResult)，序号从 0 开始。
+        progress: 可选回调 progress(阶段, 0~1 的进度, 说明)。顺序处理时按文件内各阶段报告，
+            并行处理时按完成的文件报告。
+        profiler: stage_profiler.RunProfiler，提供时记录每个文件各阶段的耗时（并行时由工作进程带回）。
+
+    Returns:
+        [(FileResult, 结果 DataFrame 或 None), ...]
+
+    Raises:
+        PipelineError: stop_on_error 时某个文件处理出错。
+    """
+    total = len(source_files)
+    outcomes = [None] * total
+
+    def finish(i, result_df, error):
+        name = source_files[i].name
+        if error is not None:
+            logger.error("[%s/%s] 处理文件 %s 时发生意外错误: %s", i + 1, total, name, error)
+            file_result = FileResult(name, "error", error=error)
+            result_df = None
+        elif result_df is None or result_df.empty:
+            logger.warning("[%s/%s] 文件 %s 未返回有效数据 (可能无匹配行或处理错误)。", i + 1, total, name)
+            file_result = FileResult(name, "empty")
+            result_df = None
+        else:
+            file_result = FileResult(name, "ok", rows=len(result_df))
+            logger.log(SUCCESS, "[%s/%s] 文件 %s 处理成功，%s 行。", i + 1, total, name, len(result_df))
+        outcomes[i] = (file_result, result_df)
+        if progress is not None:
+            progress("calculate", (i + 1) / total, f"{name}: {file_result.rows} 行")
+        if on_file_done is not None:
+            on_file_done(i, file_result)
+        if error is not None and stop_on_error:
+            raise PipelineError(f"因处理文件 {name} 时发生错误，处理中止。")
+
+    registry = RuleRegistry.ensure(registry)
+    if workers is None or workers <= 1 or total <= 1:
+        for i, source_file in enumerate(source_files):
+            logger.info("[%s/%s] 处理文件: %s", i + 1, total, source_file.name)
+            on_stage = None
+            if progress is not None:
+                on_stage = (lambda i, name: lambda stage, rows: progress(
+                    stage, (i + _FILE_STAGE_FRACTIONS.get(stage, 1.0)) / total, f"{name}: {rows} 行"))(i, source_file.name)
+            try:
+                result_df, error = _process_one(source_file, deduction_df, registry, deduction_fields, identity_column,
+                                                snapshot_store, unit_name, salary_month, on_stage=on_stage,
+                                                profiler=profiler), None
+            except Exception as e:
+                logger.debug("Traceback for %s", source_file.name, exc_info=True)
+                result_df, error = None, f"{type(e).__name__}: {e}"
+            finish(i, result_df, error)
+        return outcomes
+
+    workers = min(workers, total)
+    logger.info("使用 %s 个进程并行处理 %s 个源文件...", workers, total)
+    snapshot_root = snapshot_store.root if snapshot_store is not None and snapshot_store.available else None
+    initargs = (deduction_df, registry.field_mappings, deduction_fields, identity_column, snapshot_root,
+                unit_name, salary_month, logging.getLogger(LOGGER_NAMESPACE).getEffectiveLevel())
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(MP_START_METHOD),
+                             initializer=_init_worker, initargs=initargs) as pool:
+        futures = [pool.submit(_process_in_worker, f.data, f.name, f.digest) for f in source_files]
+        try:
+            # 按原顺序收集：日志与回调顺序稳定，总耗时仍约等于最慢的文件
+            for i, future in enumerate(futures):
+                try:
+                    result_df, error, records, stages = future.result()
+                except BrokenProcessPool as e:
+                    result_df, error, records, stages = None, f"工作进程异常退出: {e}", [], []
+                _replay_records(records)
+                if profiler is not None:
+                    profiler.extend(stages)
+                finish(i, result_df, error)
+        except PipelineError:
+            for future in futures:
+                future.cancel()
+            raise
+    return outcomes
+
+
+class SpilledReport:
+    """
+    分块处理的报表：各块结果按模板排列后依次追加到临时目录中（每个源文件一个文件），同时累计列宽与匹配情况，
+    写出时再逐块读回，内存中不保留合并后的完整结果。
+
+    Attributes:
+        template_fields: 模板字段，None 时按各块首次出现的顺序输出全部列。
+        layout: 全部块累计的列布局 (ColumnLayout)。
+        rows: 已追加的数据行数。
+        match_frames / exact_rows: 供 log_match_summary 使用的非精确匹配行与精确匹配行数。
+    """
+
+    def __init__(self, spill_dir: str, template_fields=None):
+        self.spill_dir = spill_dir
+        self.template_fields = template_fields
+        self.layout = ColumnLayout()
+        self.rows = 0
+        self.match_frames = []
+        self.exact_rows = 0
+        self._paths = []
+
+    @property
+    def columns(self) -> list:
+        return list(self.template_fields) if self.template_fields else self.layout.columns
+
+    def chunks(self):
+        """依次读回各块，按最终的列排列。"""
+        columns = self.columns
+        for path in self._paths:
+            with open(path, "rb") as f:
+                while True:
+                    try:
+                        df = pickle.load(f)
+                    except EOFError:
+                        break
+                    yield df.reindex(columns=columns)
+
+    def append_file(self, index: int, chunks, deduction_index: DeductionIndex, on_chunk=None) -> int:
+        """
+        把一个源文件的各块结果（process_sheet_chunks 生成）转换为紧凑列类型、按模板排列后追加到临时文件。
+        全部块处理完才计入报表：中途出错时丢弃该文件已追加的块，异常照常抛出。
+
+        Args:
+            on_chunk: 每块追加后调用 on_chunk(行数)。
+
+        Returns:
+            该文件的数据行数。
+        """
+        path = os.path.join(self.spill_dir, f"{index:04d}.pkl")
+        layout, match_frames, exact_rows, rows = ColumnLayout(), [], 0, 0
+        try:
+            with open(path, "wb") as spill:
+                for chunk in chunks:
+                    chunk = compact_frame(chunk)
+                    inexact, exact = inexact_match_rows(chunk, deduction_index)
+                    if inexact is not None:
+                        match_frames.append(inexact)
+                        exact_rows += exact
+                    part = build_report([chunk], self.template_fields)
+                    layout.update(part)
+                    pickle.dump(part, spill, protocol=pickle.HIGHEST_PROTOCOL)
+                    rows += len(part)
+                    if on_chunk is not None:
+                        on_chunk(len(part))
+        except BaseException:
+            os.remove(path)
+            raise
+        if not rows:
+            os.remove(path)
+            return 0
+        self._paths.append(path)
+        self.layout.merge(layout)
+        self.match_frames.extend(match_frames)
+        self.exact_rows += exact_rows
+        self.rows += rows
+        return rows
+
+    def export(self, output_path, year, month, unit_name: str = DEFAULT_UNIT_NAME, on_progress=None) -> None:
+        """逐块写出格式化报表，列宽与隐藏列由全部块累计的布局决定；on_progress 同 export_excel_with_styles。"""
+        columns = self.columns
+        max_widths, non_empty = self.layout.layout(columns)
+        writer = StyledReportWriter(output_path, columns, max_widths, non_empty, year, month, unit_name=unit_name)
+        for chunk in self.chunks():
+            writer.write(chunk)
+            if on_progress is not None:
+                on_progress(writer.rows, self.rows)
+        writer.close()
+
+
+def stream_sources(source_files, deduction_index: DeductionIndex, registry, deduction_fields: list, identity_column: str,
+                   report: SpilledReport, chunk_rows: int, stop_on_error: bool = True, on_file_done=None, progress=None,
+                   profiler=None) -> list:
+    """
+    逐个源文件分块处理（process_sheet_chunks），结果追加到 report。参数同 process_sources；
+    不使用进程池，也不读写快照与字段映射缓存。
+
+    Returns:
+        各源文件的 FileResult 列表，顺序与输入一致。
+
+    Raises:
+        PipelineError: stop_on_error 时某个文件处理出错。
+    """
+    total = len(source_files)
+    registry = RuleRegistry.ensure(registry)
+    files = []
+    for i, source_file in enumerate(source_files):
+        name = source_file.name
+        logger.info("[%s/%s] 分块处理文件: %s（每块 %s 行）", i + 1, total, name, chunk_rows)
+        stream = WorkbookStream(source_file.data, name=name, header_keywords=(identity_column,), batch_rows=chunk_rows)
+        clock = profiler.clock(name, accumulate=True) if profiler is not None else None
+
+        def on_stage(stage, rows, i=i, name=name, stream=stream, clock=clock):
+            if clock is not None:
+                clock.mark(stage, rows)
+            if progress is not None:
+                fraction = min(stream.rows / stream.declared_rows, 1.0) if stream.declared_rows else 0.0
+                progress(stage, (i + fraction) / total, f"{name}: 已读取 {stream.rows} 行")
+
+        chunks = process_sheet_chunks(stream, deduction_index, registry, deduction_fields, identity_column, identity_column,
+                                      on_stage=on_stage)
+        error = None
+        try:
+            rows = report.append_file(i, chunks, deduction_index,
+                                      on_chunk=None if clock is None else lambda rows, clock=clock: clock.mark("combine", rows))
+        except Exception as e:
+            logger.debug("Traceback for %s", name, exc_info=True)
+            rows = 0
+            if stream.header_row is None:
+                # 与 process_sheet 一致：无法读取或未找到表头的文件按没有有效数据处理
+                logger.error("读取文件 %s 时出错: %s", name, e)
+            else:
+                error = f"{type(e).__name__}: {e}"
+
+        if error is not None:
+            logger.error("[%s/%s] 处理文件 %s 时发生意外错误: %s", i + 1, total, name, error)
+            file_result = FileResult(name, "error", error=error)
+        elif not rows:
+            logger.warning("[%s/%s] 文件 %s 未返回有效数据 (可能无匹配行或处理错误)。", i + 1, total, name)
+            file_result = FileResult(name, "empty")
+        else:
+            file_result = FileResult(name, "ok", rows=rows)
+            logger.log(SUCCESS, "[%s/%s] 文件 %s 处理成功，%s 行。", i + 1, total, name, rows)
+        files.append(file_result)
+        if progress is not None:
+            progress("calculate", (i + 1) / total, f"{name}: {rows} 行")
+        if on_file_done is not None:
+            on_file_done(i, file_result)
+        if error is not None and stop_on_error:
+            raise PipelineError(f"因处理文件 {name} 时发生错误，处理中止。")
+    return files
+
+
+def run_pipeline(sources, deduction, field_mappings, salary_date, output_path=None, unit_name: str = DEFAULT_UNIT_NAME,
+                 template=None, identity_column: str = None, key_identifier_columns=None,
+                 snapshot_store=None, stop_on_error: bool = True, workers: int = DEFAULT_WORKERS,
+                 progress=None, profile_capture: str = DEFAULT_PROFILE_CAPTURE,
+                 chunk_rows: int = DEFAULT_CHUNK_ROWS, fuzzy_threshold: float = None) -> PipelineResult:
+    """
+    执行完整处理流程并写出格式化报表。
+
+    Args:
+        sources: 源数据表（路径、bytes、上传文件对象或 InputFile）列表。
+        deduction: 扣款表。
+        field_mappings: 映射规则列表、RuleRegistry、规则 JSON 路径或已解析的 dict。
+        salary_date: 工资表日期 (datetime/date)，用于标题与快照月份。
+        output_path: 报表输出路径，为目录时按单位与月份生成文件名；为 None 时不写出。
+        unit_name: 单位名称。
+        template: 导出模板，提供时按模板字段排列输出列。
+        identity_column: 用于匹配转换规则的列名，默认依次尝试 人员身份、岗位类别。
+        key_identifier_columns: 合并扣款表的关键标识列，默认为源文件中存在的 姓名/人员姓名。
+        snapshot_store: SnapshotStore，提供时读写 源数据/扣款表/合并结果 快照。
+        stop_on_error: 为 True 时某个源文件出错即中止；为 False 时跳过出错的文件继续处理。
+        workers: 并行处理源文件的进程数，见 process_sources。
+        progress: 可选回调 progress(阶段, 0~1 的总进度, 说明)，阶段见 PIPELINE_STAGES。
+        profile_capture: 除各阶段耗时外的深入分析，None / "cprofile" / "tracemalloc"，结果在 PipelineResult.profile 中。
+        chunk_rows: 大于 0 时分块处理源文件（每块的行数，见 stream_sources），内存占用不随表的行数增长；
+            此时必须指定 output_path，workers 不起作用，不读写源数据与合并结果快照，结果的 report 为 None。
+        fuzzy_threshold: 合并扣款表时模糊匹配的最低相似度，默认 DEFAULT_FUZZY_THRESHOLD（1，不做模糊匹配）。
+
+    Raises:
+        PipelineError: 输入不完整，或 stop_on_error 时某个源文件处理出错。
+    """
+    profiler = RunProfiler(profile_capture)
+    with profiler:
+        pipeline_result = _run_pipeline(
+            sources, deduction, field_mappings, salary_date, output_path=output_path, unit_name=unit_name,
+            template=template, identity_column=identity_column, key_identifier_columns=key_identifier_columns,
+            snapshot_store=snapshot_store, stop_on_error=stop_on_error, workers=workers, progress=progress,
+            profiler=profiler, chunk_rows=chunk_rows, fuzzy_threshold=fuzzy_threshold,
+        )
+    pipeline_result.profile = profiler.to_dict()
+    profiler.log_summary(logger)
+    return pipeline_result
+
+
+def _run_pipeline(sources, deduction, field_mappings, salary_date, output_path, unit_name, template, identity_column,
+                  key_identifier_columns, snapshot_store, stop_on_error, workers, progress, profiler, chunk_rows,
+                  fuzzy_threshold) -> PipelineResult:
+    clock = profiler.clock()
+    if not sources:
+        raise PipelineError("请至少提供一个源数据工资表！")
+    if deduction is None:
+        raise PipelineError("请提供扣款项表！")
+    if chunk_rows and output_path is None:
+        raise PipelineError("分块处理时结果直接写入报表文件，请指定输出路径。")
+    source_files = [InputFile.open(source) for source in sources]
+    deduction_file = InputFile.open(deduction)
+    salary_month = salary_date.strftime("%Y%m")
+    if progress is not None:
+        progress("read", 0.0, "读取表头与扣款表")
+
+    # 源文件字段：用于默认选择、规则预过滤
+    source_fields = set()
+    for source_file in source_files:
+        # 只读取表头，完整解析留给 process_sheet（并行时在工作进程中进行）
+        try:
+            source_fields.update(source_file.header_fields())
+        except Exception as e:
+            # 无法读取的文件在逐个处理时按该文件出错处理
+            logger.warning("读取源文件 %s 的表头失败: %s", source_file.name, e)
+    if key_identifier_columns is None:
+        key_identifier_columns = [col for col in DEFAULT_HEADER_KEYWORDS if col in source_fields]
+    if not key_identifier_columns:
+        raise PipelineError("未能在源文件中找到关键标识列（姓名/人员姓名），请指定关键标识列。")
+    identity_column = identity_column or default_identity_column(source_fields)
+    if not identity_column:
+        raise PipelineError(f"源文件中没有 {list(IDENTITY_COLUMN_CANDIDATES)}，请指定用于匹配规则的字段名。")
+    logger.info("规则匹配字段: '%s'，关键标识列: %s", identity_column, key_identifier_columns)
+
+    # 扣款表：有数值化后的快照时直接读取
+    ded_key = deduction_snapshot_key(deduction_file.digest, key_identifier_columns)
+    deduction_df = snapshot_store.load("deduction", unit_name, salary_month, ded_key) if snapshot_store is not None else None
+    from_snapshot = deduction_df is not None
+    if not from_snapshot:
+        deduction_df = deduction_file.snapshot.read(header=DEDUCTION_HEADER_ROW)
+    deduction_df, key_columns, deduction_fields = prepare_deductions(deduction_df, key_identifier_columns, coerce=not from_snapshot)
+    logger.info("扣款表 %s 读取成功%s，关键标识列 %s，扣款字段 %s 个", deduction_file.name,
+                "（快照）" if from_snapshot else "", key_columns, len(deduction_fields))
+    logger.debug("扣款表明细 (前 5 行):\n%s", preview(deduction_df))
+    if snapshot_store is not None and not from_snapshot:
+        snapshot_store.save(deduction_df, "deduction", unit_name, salary_month, ded_key, extra={"file_name": deduction_file.name})
+
+    if not isinstance(field_mappings, (list, RuleRegistry)):
+        field_mappings = load_field_mappings(field_mappings)
+    rules = field_mappings.field_mappings if isinstance(field_mappings, RuleRegistry) else field_mappings
+    filtered_mappings, removed = filter_mappings(rules, deduction_df.columns, source_fields, identity_column)
+    logger.info("映射规则预过滤完成。共过滤掉 %s 个无效的简单映射。", removed)
+    registry = RuleRegistry(filtered_mappings)
+
+    # 进度区间：表头与扣款表 0~5%，逐文件处理 5%~85%，导出 85%~100%
+    # 扣款表按关键标识建立一次索引，所有源文件（包括工作进程）共用
+    deduction_index = DeductionIndex(deduction_df, key_columns, deduction_fields, fuzzy_threshold=fuzzy_threshold)
+    clock.mark("prepare", len(deduction_df))
+    if progress is not None:
+        progress("read", 0.05, f"扣款表 {len(deduction_df)} 行")
+    if chunk_rows:
+        return _run_chunked(source_files, deduction_index, registry, deduction_fields, identity_column, template, output_path,
+                            salary_date, unit_name, snapshot_store, workers, stop_on_error, progress, profiler, clock, chunk_rows)
+    outcomes = process_sources(
+        source_files, deduction_index, registry, deduction_fields, identity_column,
+        snapshot_store=snapshot_store, unit_name=unit_name, salary_month=salary_month,
+        workers=workers, stop_on_error=stop_on_error, progress=scaled_progress(progress, 0.05, 0.85),
+        profiler=profiler,
+    )
+    results = [result_df for _, result_df in outcomes if result_df is not None]
+    pipeline_result = PipelineResult(files=[file_result for file_result, _ in outcomes])
+    clock.mark("sources", sum(file_result.rows for file_result in pipeline_result.files))
+    if not results:
+        logger.warning("未生成任何有效数据，请检查源文件内容和映射规则。")
+        return pipeline_result
+
+    template_fields = None
+    if template is not None:
+        template_fields = InputFile.open(template).columns(header=TEMPLATE_HEADER_ROW)
+    combined_df = build_report(results, template_fields)
+    pipeline_result.report = combined_df
+    pipeline_result.rows = len(combined_df)
+    logger.info("结果合并完成，总行数: %s，列数: %s", len(combined_df), combined_df.shape[1])
+    pipeline_result.match = log_match_summary(results, deduction_index)
+
+    if snapshot_store is not None:
+        key = combined_snapshot_key((f.digest for f in source_files), deduction_file.digest, registry, identity_column, combined_df.columns)
+        pipeline_result.snapshot_path = snapshot_store.save(
+            combined_df, "combined", unit_name, salary_month, key,
+            extra={"source_files": [f.name for f in source_files], "deduction_file": deduction_file.name},
+        )
+    clock.mark("combine", len(combined_df))
+
+    if output_path is not None:
+        output_path = _report_path(output_path, unit_name, salary_date)
+        export_progress = scaled_progress(progress, 0.85, 1.0)
+        export_excel_with_styles(
+            combined_df, output_path, salary_date.year, salary_date.month, unit_name=unit_name,
+            on_progress=None if export_progress is None else
+            lambda written, total: export_progress("export", written / max(total, 1), f"已写出 {written}/{total} 行"),
+        )
+        pipeline_result.output_path = output_path
+        clock.mark("export", len(combined_df))
+        logger.log(SUCCESS, "报表已写出: %s", output_path)
+    if progress is not None:
+        progress("export", 1.0, "完成")
+    return pipeline_result
+
+
+def _report_path(output_path, unit_name: str, salary_date):
+    """输出路径为目录时按单位与月份生成文件名。"""
+    if os.path.isdir(output_path):
+        return os.path.join(output_path, report_file_name(unit_name, salary_date))
+    return output_path
+
+
+def _run_chunked(source_files, deduction_index, registry, deduction_fields, identity_column, template, output_path,
+                 salary_date, unit_name, snapshot_store, workers, stop_on_error, progress, profiler, clock,
+                 chunk_rows) -> PipelineResult:
+    """_run_pipeline 的分块处理部分：各源文件的结果暂存在临时目录中，全部处理完后逐块写出报表。"""
+    if workers is not None and workers > 1:
+        logger.info("分块处理时逐个顺序处理源文件，忽略并行进程数 %s。", workers)
+    if snapshot_store is not None:
+        logger.info("分块处理时不读写源数据与合并结果快照。")
+    template_fields = None
+    if template is not None:
+        template_fields = InputFile.open(template).columns(header=TEMPLATE_HEADER_ROW)
+    with tempfile.TemporaryDirectory(prefix="salary-chunks-") as spill_dir:
+        report = SpilledReport(spill_dir, template_fields)
+        files = stream_sources(source_files, deduction_index, registry, deduction_fields, identity_column, report, chunk_rows,
+                               stop_on_error=stop_on_error, progress=scaled_progress(progress, 0.05, 0.85), profiler=profiler)
+        pipeline_result = PipelineResult(files=files, rows=report.rows)
+        clock.mark("sources", report.rows)
+        if not report.rows:
+            logger.warning("未生成任何有效数据，请检查源文件内容和映射规则。")
+            return pipeline_result
+        logger.info("结果分块处理完成，总行数: %s，列数: %s", report.rows, len(report.columns))
+        pipeline_result.match = log_match_summary(report.match_frames, deduction_index, exact_rows=report.exact_rows)
+
+        output_path = _report_path(output_path, unit_name, salary_date)
+        export_progress = scaled_progress(progress, 0.85, 1.0)
+        report.export(
+            output_path, salary_date.year, salary_date.month, unit_name=unit_name,
+            on_progress=None if export_progress is None else
+            lambda written, total: export_progress("export", written / max(total, 1), f"已写出 {written}/{total} 行"),
+        )
+        pipeline_result.output_path = output_path
+        clock.mark("export", report.rows)
+        logger.log(SUCCESS, "报表已写出: %s", output_path)
+    if progress is not None:
+        progress("export", 1.0, "完成")
+    return pipeline_result
+
+
+def run_pipeline_job(*args, progress=None, work_dir=None, **kwargs) -> dict:
+    """
+    JobQueue 的任务函数：在任务目录中写出报表，返回结果摘要（不持有合并后的 DataFrame）。
+    参数同 run_pipeline，output_path 为任务目录。
+    """
+    result = run_pipeline(*args, output_path=work_dir, progress=progress, **kwargs)
+    return result.to_dict()
+
+
+def parse_salary_month(text: str) -> datetime:
+    """解析 "2025-09"、"202509"、"2025/9" 形式的工资月份，返回该月第一天。"""
+    text = str(text).strip()
+    for fmt in ("%Y-%m", "%Y%m", "%Y/%m", "%Y.%m", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(text, fmt).replace(day=1)
+        except ValueError:
+            continue
+    raise PipelineError(f"无法识别的工资月份: {text}（应为 YYYY-MM 或 YYYYMM）")
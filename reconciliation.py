@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+"""
+两次处理结果（或两个月的报表）逐行对账
+
+过去核对本月与上月的实发工资需要在 Excel 中手工比对。reconcile() 接收两个结果
+（process_sheet / run_pipeline 的 DataFrame、已导出的报表 xlsx 或 Arrow 快照）：
+
+- 按关键标识列做哈希连接（同一键重复出现时按出现顺序一一对应，不产生笛卡尔积）
+- 逐字段向量化计算差异：数值字段比较差额（空值按 0），文本字段比较去空白后的内容
+- 标出新增人员（只在本期）与减少人员（只在上期）
+- 按身份（规则匹配字段）汇总人数、变动人数与主要金额合计的变化
+
+export_reconciliation() 写出带格式的对账工作簿（汇总、变动明细、新增人员、减少人员）。
+整个过程只按列循环，不逐行循环，5 万行对比在数秒内完成。
+
+命令行：
+
+    python reconciliation.py 上月报表.xlsx 本月报表.xlsx --key-columns 姓名 -o 对账.xlsx
+"""
+
+import argparse
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from fiscal_report_full_script import EXPORT_CHUNK_ROWS, compute_column_layout, header_fill
+from log_config import configure_logging, get_logger
+from snapshot_store import SnapshotStore
+from workbook_reader import WorkbookSnapshot
+
+logger = get_logger("reconciliation")
+
+# 导出报表的表头在第三行（标题行、单位/日期行之后）
+REPORT_HEADER_ROW = 2
+# 汇总中统计合计变化的金额字段（存在时）
+SUMMARY_FIELDS = ("应发工资", "扣发合计", "实发工资", "发放合计")
+IDENTITY_COLUMN_CANDIDATES = ("人员身份", "岗位类别")
+# 同一含义的姓名列：报表按模板输出时列名可能与源文件不同
+NAME_COLUMN_ALIASES = ("人员姓名", "姓名")
+DEFAULT_TOLERANCE = 0.005
+ALL_IDENTITIES = "全部"
+
+_PREVIOUS = "上期"
+_CURRENT = "本期"
+_INCREASE_COLOR = "E2F0D9"
+_DECREASE_COLOR = "FCE4D6"
+_MONEY_FORMAT = "#,##0.00"
+
+
+def load_report(source, header: int = REPORT_HEADER_ROW) -> pd.DataFrame:
+    """
+    读取一次处理结果。
+
+    Args:
+        source: DataFrame、导出的报表（路径、bytes 或上传文件对象）或 .arrow 快照路径。
+        header: 报表表头所在行（0 起）。
+    """
+    if isinstance(source, pd.DataFrame):
+        return source
+    if isinstance(source, (str, os.PathLike)) and str(source).endswith(".arrow"):
+        return SnapshotStore(os.path.dirname(os.path.abspath(source))).load_path(source)
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    return WorkbookSnapshot.load(source).read(header=header)
+
+
+def resolve_key_columns(df: pd.DataFrame, key_columns) -> list:
+    """
+    返回 df 中实际使用的关键标识列：缺少的姓名列用同义列（人员姓名/姓名）代替。
+
+    Raises:
+        ValueError: 关键标识列不存在。
+    """
+    resolved = []
+    for col in key_columns:
+        if col not in df.columns and col in NAME_COLUMN_ALIASES:
+            col = next((alias for alias in NAME_COLUMN_ALIASES if alias in df.columns), col)
+        if col not in df.columns:
+            raise ValueError(f"结果中没有关键标识列 '{col}'，现有列: {df.columns.tolist()}")
+        resolved.append(col)
+    return resolved
+
+
+def _key_series(df: pd.DataFrame, key_columns) -> pd.Series:
+    """多列关键标识拼接为一个字符串键（去掉首尾空白，空值为空字符串）。"""
+    parts = [df[col].astype("string").str.strip().fillna("") for col in key_columns]
+    key = parts[0]
+    for part in parts[1:]:
+        key = key.str.cat(part, sep="\x1f")
+    return key.astype(object)
+
+
+def _numeric_or_none(before: pd.Series, after: pd.Series):
+    """两列都可以按数值比较时返回数值化后的两列，否则返回 None。"""
+    before_num = pd.to_numeric(before, errors="coerce")
+    after_num = pd.to_numeric(after, errors="coerce")
+    if (before_num.notna() | before.isna()).all() and (after_num.notna() | after.isna()).all():
+        return before_num.astype(float), after_num.astype(float)
+    return None
+
+
+def _text(column: pd.Series) -> pd.Series:
+    return column.astype("string").str.strip().fillna("")
+
+
+class Reconciliation:
+    """
+    对账结果。
+
+    Attributes:
+        key_columns: 使用的关键标识列（本期结果中的列名）。
+        fields: 参与比较的字段。
+        matched: 两期都有的人数。
+        changed: 两期都有且至少一个字段变动的人数。
+        changes: 变动明细，每个变动字段一行：关键标识列、身份、字段、上期、本期、差额。
+        added: 新增人员（本期结果中的行）。
+        removed: 减少人员（上期结果中的行）。
+        summary: 按身份汇总：上期人数、本期人数、新增、减少、变动人数及主要金额字段的合计变化。
+        duplicate_keys: 在任一期中重复出现的键数。
+    """
+
+    def __init__(self, key_columns, fields, matched, changed, changes, added, removed, summary, duplicate_keys=0):
+        self.key_columns = key_columns
+        self.fields = fields
+        self.matched = matched
+        self.changed = changed
+        self.changes = changes
+        self.added = added
+        self.removed = removed
+        self.summary = summary
+        self.duplicate_keys = duplicate_keys
+
+    def to_dict(self) -> dict:
+        return {
+            "key_columns": self.key_columns,
+            "matched": self.matched,
+            "changed": self.changed,
+            "added": len(self.added),
+            "removed": len(self.removed),
+            "changed_fields": len(self.changes),
+            "duplicate_keys": self.duplicate_keys,
+        }
+
+
+def reconcile(previous, current, key_columns, identity_column: str = None, fields=None,
+              tolerance: float = DEFAULT_TOLERANCE) -> Reconciliation:
+    """
+    逐行对比两次处理结果。
+
+    Args:
+        previous / current: 上期与本期结果，见 load_report。
+        key_columns: 关键标识列（如界面中选择的 人员姓名）。
+        identity_column: 汇总分组的身份列，默认依次尝试 人员身份、岗位类别；都没有时不分组。
+        fields: 参与比较的字段，默认为两期共有的全部字段（关键标识列与 _ 开头的内部列除外）。
+        tolerance: 数值差额绝对值不超过该值时视为未变动。
+
+    Raises:
+        ValueError: 缺少关键标识列。
+    """
+    previous = load_report(previous).reset_index(drop=True)
+    current = load_report(current).reset_index(drop=True)
+    if not key_columns:
+        raise ValueError("请指定关键标识列。")
+    current_keys = resolve_key_columns(current, key_columns)
+    previous_keys = resolve_key_columns(previous, key_columns)
+    if identity_column is None:
+        identity_column = next((col for col in IDENTITY_COLUMN_CANDIDATES if col in current.columns or col in previous.columns), None)
+
+    if fields is None:
+        excluded = set(current_keys) | set(previous_keys)
+        fields = [col for col in current.columns
+                  if col in previous.columns and col not in excluded and not str(col).startswith("_")]
+    fields = [col for col in fields if col in current.columns and col in previous.columns]
+
+    # 哈希连接：键 + 同键出现序号，重复键按出现顺序一一对应
+    left = pd.DataFrame({"_键": _key_series(previous, previous_keys)})
+    right = pd.DataFrame({"_键": _key_series(current, current_keys)})
+    duplicate_keys = int(left["_键"].duplicated().sum() + right["_键"].duplicated().sum())
+    if duplicate_keys:
+        logger.warning("关键标识列 %s 有 %s 个重复值，重复的人员按出现顺序对应。", current_keys, duplicate_keys)
+    left["_序号"] = left.groupby("_键").cumcount()
+    right["_序号"] = right.groupby("_键").cumcount()
+    left["_上期行"] = np.arange(len(left))
+    right["_本期行"] = np.arange(len(right))
+    joined = left.merge(right, on=["_键", "_序号"], how="outer", sort=False)
+    both = joined["_上期行"].notna() & joined["_本期行"].notna()
+    pairs = joined[both]
+    prev_rows = pairs["_上期行"].to_numpy(dtype=np.int64)
+    cur_rows = pairs["_本期行"].to_numpy(dtype=np.int64)
+    added = current.iloc[joined.loc[joined["_上期行"].isna(), "_本期行"].to_numpy(dtype=np.int64)]
+    removed = previous.iloc[joined.loc[joined["_本期行"].isna(), "_上期行"].to_numpy(dtype=np.int64)]
+
+    # 身份：优先取本期
+    def identities(df, rows):
+        if identity_column and identity_column in df.columns:
+            return _text(df[identity_column].iloc[rows]).replace("", ALL_IDENTITIES).to_numpy(dtype=object)
+        return np.full(len(rows), ALL_IDENTITIES, dtype=object)
+
+    pair_identity = identities(current, cur_rows)
+    if identity_column and identity_column not in current.columns:
+        pair_identity = identities(previous, prev_rows)
+
+    # 逐字段向量化比较
+    frames = []
+    changed_any = np.zeros(len(pairs), dtype=bool)
+    for field in fields:
+        before = previous[field].iloc[prev_rows].reset_index(drop=True)
+        after = current[field].iloc[cur_rows].reset_index(drop=True)
+        numeric = _numeric_or_none(before, after)
+        if numeric is not None:
+            before_num, after_num = numeric
+            delta = after_num.fillna(0.0).to_numpy() - before_num.fillna(0.0).to_numpy()
+            changed = np.abs(delta) > tolerance
+        else:
+            before_text, after_text = _text(before), _text(after)
+            changed = (before_text != after_text).to_numpy()
+            delta = np.full(len(before), np.nan)
+        positions = np.flatnonzero(changed)
+        if not len(positions):
+            continue
+        changed_any |= changed
+        frames.append(pd.DataFrame({
+            "_行": positions,
+            "字段": field,
+            _PREVIOUS: before.iloc[positions].astype(object).to_numpy(),
+            _CURRENT: after.iloc[positions].astype(object).to_numpy(),
+            "差额": delta[positions],
+        }))
+
+    if frames:
+        changes = pd.concat(frames, ignore_index=True)
+        rows = changes["_行"].to_numpy()
+        key_values = current[current_keys].iloc[cur_rows[rows]].reset_index(drop=True)
+        changes = pd.concat([key_values, pd.DataFrame({"身份": pair_identity[rows]}), changes], axis=1)
+        # 按人员、字段顺序排列
+        field_order = {field: i for i, field in enumerate(fields)}
+        changes = changes.assign(_字段序=changes["字段"].map(field_order)).sort_values(
+            ["_行", "_字段序"], kind="stable").drop(columns=["_字段序", "_行"]).reset_index(drop=True)
+    else:
+        changes = pd.DataFrame(columns=current_keys + ["身份", "字段", _PREVIOUS, _CURRENT, "差额"])
+
+    summary = _summarize(previous, current, identity_column, pair_identity, changed_any, added, removed)
+    result = Reconciliation(current_keys, fields, int(both.sum()), int(changed_any.sum()), changes, added, removed,
+                            summary, duplicate_keys)
+    logger.info("对账完成：两期都有 %s 人，新增 %s 人，减少 %s 人，变动 %s 人（%s 个字段变动）",
+                result.matched, len(added), len(removed), result.changed, len(changes))
+    return result
+
+
+def _summarize(previous, current, identity_column, pair_identity, changed_any, added, removed) -> pd.DataFrame:
+    """按身份汇总人数与主要金额字段合计。"""
+    def identity_of(df):
+        if identity_column and identity_column in df.columns:
+            return _text(df[identity_column]).replace("", ALL_IDENTITIES)
+        return pd.Series(ALL_IDENTITIES, index=df.index, dtype=object)
+
+    parts = {
+        f"{_PREVIOUS}人数": identity_of(previous).value_counts(),
+        f"{_CURRENT}人数": identity_of(current).value_counts(),
+        "新增": identity_of(added).value_counts(),
+        "减少": identity_of(removed).value_counts(),
+        "变动人数": pd.Series(pair_identity[changed_any]).value_counts(),
+    }
+    for field in SUMMARY_FIELDS:
+        for label, df in ((_PREVIOUS, previous), (_CURRENT, current)):
+            if field in df.columns:
+                values = pd.to_numeric(df[field], errors="coerce").fillna(0.0)
+                parts[f"{field}{label}合计"] = values.groupby(identity_of(df)).sum()
+    summary = pd.DataFrame(parts).fillna(0)
+    for col in ("上期人数", "本期人数", "新增", "减少", "变动人数"):
+        summary[col] = summary[col].astype(np.int64)
+    for field in SUMMARY_FIELDS:
+        if f"{field}{_PREVIOUS}合计" in summary and f"{field}{_CURRENT}合计" in summary:
+            summary[f"{field}差额"] = summary[f"{field}{_CURRENT}合计"] - summary[f"{field}{_PREVIOUS}合计"]
+    summary.index.name = "身份"
+    summary = summary.reset_index()
+    if len(summary) > 1:
+        values = summary.drop(columns=["身份"])
+        total = values.sum().to_frame().T.astype(values.dtypes)
+        summary = pd.concat([summary, total.assign(身份="合计")[summary.columns]], ignore_index=True)
+    return summary
+
+
+# --- 对账工作簿 ---
+def _write_sheet(wb, title: str, df: pd.DataFrame, caption: str = None, delta_column: str = None) -> None:
+    """把 df 写入只写模式的工作表：表头着色、金额格式、差额列按增减着色。"""
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, PatternFill
+    from openpyxl.utils import get_column_letter
+
+    increase_fill = PatternFill("solid", fgColor=_INCREASE_COLOR)
+    decrease_fill = PatternFill("solid", fgColor=_DECREASE_COLOR)
+    ws = wb.create_sheet(title)
+    max_widths, _ = compute_column_layout(df, sample_rows=2000)
+    for col_idx, width in enumerate(max_widths, 1):
+        ws.column_dimensions[get_column_letter(col_idx)].width = min(max(8, width + 2), 50)
+    ws.freeze_panes = "A3" if caption else "A2"
+
+    def cell(value, font=None, fill=None, number_format=None):
+        c = WriteOnlyCell(ws, value=value)
+        if font is not None:
+            c.font = font
+        if fill is not None:
+            c.fill = fill
+        if number_format is not None:
+            c.number_format = number_format
+        return c
+
+    if caption:
+        ws.append([cell(caption, font=Font(size=14, bold=True))])
+    ws.append([cell(str(col), font=Font(bold=True), fill=header_fill("BASIC")) for col in df.columns])
+
+    numeric_cols = {i for i, dtype in enumerate(df.dtypes) if pd.api.types.is_float_dtype(dtype)}
+    delta_idx = df.columns.get_loc(delta_column) if delta_column in df.columns else None
+    for start in range(0, len(df), EXPORT_CHUNK_ROWS):
+        chunk = df.iloc[start:start + EXPORT_CHUNK_ROWS]
+        columns = []
+        for i in range(chunk.shape[1]):
+            column = chunk.iloc[:, i]
+            columns.append(column.astype(object).where(column.notna(), None).tolist())
+        for values in zip(*columns):
+            row = list(values)
+            for i in numeric_cols:
+                if row[i] is not None:
+                    fill = None
+                    if i == delta_idx:
+                        fill = increase_fill if row[i] > 0 else decrease_fill if row[i] < 0 else None
+                    row[i] = cell(row[i], fill=fill, number_format=_MONEY_FORMAT)
+            ws.append(row)
+
+
+def export_reconciliation(result: Reconciliation, output_path, title: str = "对账结果") -> None:
+    """
+    写出对账工作簿：汇总、变动明细、新增人员、减少人员。差额为正的单元格标绿，为负的标红。
+    """
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    _write_sheet(wb, "汇总", result.summary, caption=title)
+    _write_sheet(wb, "变动明细", result.changes, delta_column="差额")
+    _write_sheet(wb, "新增人员", result.added)
+    _write_sheet(wb, "减少人员", result.removed)
+    wb.save(output_path)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="对比两次处理结果（报表 xlsx 或 Arrow 快照）")
+    parser.add_argument("previous", help="上期结果")
+    parser.add_argument("current", help="本期结果")
+    parser.add_argument("--key-columns", default="姓名", help="关键标识列，逗号分隔（默认: 姓名）")
+    parser.add_argument("--identity-column", help="汇总分组的身份列（默认依次尝试 人员身份、岗位类别）")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="数值差额容差")
+    parser.add_argument("-o", "--output", default="对账结果.xlsx", help="对账工作簿输出路径")
+    parser.add_argument("--log-level", help="日志级别（默认取 SALARY_LOG_LEVEL 或 INFO）")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    configure_logging(level=args.log_level, force=args.log_level is not None)
+    key_columns = [col.strip() for col in args.key_columns.split(",") if col.strip()]
+    try:
+        result = reconcile(args.previous, args.current, key_columns, identity_column=args.identity_column,
+                           tolerance=args.tolerance)
+    except (OSError, ValueError) as e:
+        logger.error("%s", e)
+        return 1
+    export_reconciliation(result, args.output,
+                          title=f"对账结果：{os.path.basename(args.previous)} → {os.path.basename(args.current)}")
+    logger.info("对账工作簿已写出: %s", args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+月度工资输入/输出的 Arrow 快照存储
+
+操作员修改映射规则后往往要对同一个月反复重跑，每次都重新解析 xlsx。
+SnapshotStore 把以下中间结果保存为 Arrow IPC (Feather v2, 不压缩) 文件：
+- source:    表头检测并过滤合计行后的源数据
+- mapped:    字段映射后、合并扣款前的源数据（只依赖源文件与规则，修正扣款表后重跑时复用）
+- deduction: 数值化后的扣款表
+- combined:  合并、按模板排列后的最终结果
+
+快照按 单位名称 / 工资月份 / 输入哈希 组织：
+
+    <根目录>/<单位名称>/<YYYYMM>/<类型>-<输入哈希前16位>.arrow
+
+读取时使用内存映射，后续重跑、审计和跨月对比无需再回到 Excel。
+pyarrow 未安装时 SnapshotStore.available 为 False，所有读写操作直接跳过。
+"""
+
+import json
+import os
+import re
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:  # pragma: no cover - 依赖缺失时快照功能关闭
+    pa = None
+    feather = None
+
+DEFAULT_SNAPSHOT_DIR = os.environ.get(
+    "SALARY_SNAPSHOT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshots")
+)
+SNAPSHOT_KINDS = ("source", "mapped", "deduction", "combined")
+_METADATA_KEY = b"salary_snapshot"
+
+
+def _safe_path_part(text) -> str:
+    """把单位名称等转换为可用作目录名的字符串。"""
+    text = re.sub(r'[\\/:*?"<>|\s]+', "_", str(text)).strip("._")
+    return text or "未命名"
+
+
+def _encode_column_name(name):
+    if isinstance(name, float) and np.isnan(name):
+        return None
+    if isinstance(name, (np.integer, np.floating)):
+        return name.item()
+    return name
+
+
+# 混合类型列逐值记录的类型标记，读取时据此还原原始值
+_KIND_NULL, _KIND_STR, _KIND_INT, _KIND_FLOAT, _KIND_BOOL, _KIND_DATETIME = range(6)
+
+
+def _value_kind(value) -> int:
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return _KIND_NULL
+    if isinstance(value, (bool, np.bool_)):
+        return _KIND_BOOL
+    if isinstance(value, (int, np.integer)):
+        return _KIND_INT
+    if isinstance(value, (float, np.floating)):
+        return _KIND_FLOAT
+    if isinstance(value, (datetime, pd.Timestamp)):
+        return _KIND_DATETIME
+    return _KIND_STR
+
+
+def _restore_value(text, kind):
+    if kind == _KIND_NULL:
+        return np.nan
+    if kind == _KIND_INT:
+        return int(text)
+    if kind == _KIND_FLOAT:
+        return float(text)
+    if kind == _KIND_BOOL:
+        return text == "True"
+    if kind == _KIND_DATETIME:
+        return pd.Timestamp(text).to_pydatetime()
+    return text
+
+
+def _to_arrow_table(df: pd.DataFrame):
+    """
+    转换为 Arrow 表。原始列名（可能为 NaN、重复或非字符串）保存在元数据中；
+    Excel 中常见的混合类型列（如数字与 "/" 混排）按字符串保存，并附带逐值类型标记列。
+    """
+    original_columns = [_encode_column_name(col) for col in df.columns]
+    storage_names = []
+    arrays = []
+    mixed = []
+    for i, col in enumerate(original_columns):
+        name = str(col) if isinstance(col, str) and original_columns.count(col) == 1 else f"__col_{i}"
+        column = df.iloc[:, i]
+        try:
+            arrays.append(pa.array(column, from_pandas=True))
+            storage_names.append(name)
+            continue
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass
+        values = column.tolist()
+        kinds = [_value_kind(value) for value in values]
+        texts = [None if kind == _KIND_NULL else (value.isoformat() if kind == _KIND_DATETIME else str(value))
+                 for value, kind in zip(values, kinds)]
+        arrays.extend([pa.array(texts, type=pa.string()), pa.array(kinds, type=pa.int8())])
+        storage_names.extend([name, f"__kind_{i}"])
+        mixed.append(i)
+    table = pa.Table.from_arrays(arrays, names=storage_names)
+    return table, {"columns": original_columns, "mixed": mixed}
+
+
+def _from_arrow_table(table) -> pd.DataFrame:
+    raw = (table.schema.metadata or {}).get(_METADATA_KEY)
+    info = json.loads(raw)["info"] if raw else {"columns": table.column_names, "mixed": []}
+    mixed = set(info["mixed"])
+    data = {}
+    position = 0
+    for i in range(len(info["columns"])):
+        if i in mixed:
+            texts = table.column(position).to_pylist()
+            kinds = table.column(position + 1).to_pylist()
+            data[i] = pd.Series([_restore_value(text, kind) for text, kind in zip(texts, kinds)], dtype=object)
+            position += 2
+        else:
+            data[i] = table.column(position).to_pandas()
+            position += 1
+    df = pd.DataFrame(data) if data else pd.DataFrame(index=range(table.num_rows))
+    df.columns = [np.nan if col is None else col for col in info["columns"]]
+    return df
+
+
+class SnapshotStore:
+    """
+    Arrow 快照的读写与检索。
+
+    Attributes:
+        root: 快照根目录。
+        available: pyarrow 可用时为 True。
+    """
+
+    def __init__(self, root: str = DEFAULT_SNAPSHOT_DIR):
+        self.root = root
+        self.available = pa is not None
+
+    def path_for(self, kind: str, unit_name: str, salary_month: str, input_hash: str) -> str:
+        if kind not in SNAPSHOT_KINDS:
+            raise ValueError(f"未知的快照类型: {kind}")
+        return os.path.join(
+            self.root, _safe_path_part(unit_name), _safe_path_part(salary_month), f"{kind}-{input_hash[:16]}.arrow"
+        )
+
+    def exists(self, kind: str, unit_name: str, salary_month: str, input_hash: str) -> bool:
+        return self.available and os.path.exists(self.path_for(kind, unit_name, salary_month, input_hash))
+
+    def save(self, df: pd.DataFrame, kind: str, unit_name: str, salary_month: str, input_hash: str, extra: dict = None) -> str:
+        """
+        保存快照，先写临时文件再原子替换，避免并发读到半个文件。
+
+        Returns:
+            快照文件路径；pyarrow 不可用时返回 None。
+        """
+        if not self.available:
+            return None
+        path = self.path_for(kind, unit_name, salary_month, input_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        table, info = _to_arrow_table(df)
+        meta = {
+            "kind": kind,
+            "unit_name": unit_name,
+            "salary_month": salary_month,
+            "input_hash": input_hash,
+            "rows": int(len(df)),
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "extra": extra or {},
+            "info": info,
+        }
+        table = table.replace_schema_metadata({_METADATA_KEY: json.dumps(meta, ensure_ascii=False, default=str)})
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        # 不压缩，读取时才能直接内存映射
+        feather.write_feather(table, tmp_path, compression="uncompressed")
+        os.replace(tmp_path, path)
+        return path
+
+    def load(self, kind: str, unit_name: str, salary_month: str, input_hash: str):
+        """读取快照（内存映射），不存在或 pyarrow 不可用时返回 None。"""
+        if not self.exists(kind, unit_name, salary_month, input_hash):
+            return None
+        return self.load_path(self.path_for(kind, unit_name, salary_month, input_hash))
+
+    def load_path(self, path: str) -> pd.DataFrame:
+        table = feather.read_table(path, memory_map=True)
+        return _from_arrow_table(table)
+
+    def read_metadata(self, path: str) -> dict:
+        with pa.memory_map(path) as source:
+            schema = pa.ipc.open_file(source).schema
+        meta = json.loads((schema.metadata or {}).get(_METADATA_KEY, b"{}"))
+        meta.pop("info", None)
+        meta["path"] = path
+        return meta
+
+    def list_snapshots(self, unit_name: str = None, salary_month: str = None, kind: str = None) -> pd.DataFrame:
+        """
+        列出已保存的快照，供审计与跨月对比选择。
+
+        Returns:
+            每行一个快照，含 kind/unit_name/salary_month/input_hash/rows/created/path 列，按创建时间倒序。
+        """
+        columns = ["kind", "unit_name", "salary_month", "input_hash", "rows", "created", "path"]
+        if not self.available or not os.path.isdir(self.root):
+            return pd.DataFrame(columns=columns)
+        unit_dirs = [_safe_path_part(unit_name)] if unit_name else os.listdir(self.root)
+        records = []
+        for unit_dir in unit_dirs:
+            unit_path = os.path.join(self.root, unit_dir)
+            if not os.path.isdir(unit_path):
+                continue
+            month_dirs = [_safe_path_part(salary_month)] if salary_month else os.listdir(unit_path)
+            for month_dir in month_dirs:
+                month_path = os.path.join(unit_path, month_dir)
+                if not os.path.isdir(month_path):
+                    continue
+                for file_name in os.listdir(month_path):
+                    if not file_name.endswith(".arrow") or (kind and not file_name.startswith(f"{kind}-")):
+                        continue
+                    try:
+                        records.append(self.read_metadata(os.path.join(month_path, file_name)))
+                    except (OSError, ValueError, pa.ArrowInvalid):
+                        continue
+        if not records:
+            return pd.DataFrame(columns=columns)
+        listing = pd.DataFrame(records)
+        return listing[columns].sort_values("created", ascending=False, ignore_index=True)
+
+    def load_latest(self, kind: str, unit_name: str, salary_month: str):
+        """读取某单位某月最近保存的一个快照（用于跨月对比），不存在时返回 None。"""
+        listing = self.list_snapshots(unit_name=unit_name, salary_month=salary_month, kind=kind)
+        if listing.empty:
+            return None
+        return self.load_path(listing.iloc[0]["path"])
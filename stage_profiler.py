@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+处理过程的分阶段性能记录
+
+记录一次处理中每个阶段（以及每个源文件的每个阶段）的耗时、CPU 时间、内存与行数，
+用于判断时间花在了读取 Excel、字段映射、合并扣款、计算还是写出报表上：
+
+- wall_seconds / cpu_seconds：墙钟时间与当前线程的 CPU 时间（后台任务线程之外的界面线程不计入）；
+- rss_mb / peak_rss_mb：阶段结束时的常驻内存与进程的历史峰值；
+- alloc_peak_mb：启用 tracemalloc 时该阶段内 Python 分配内存的峰值（含 numpy 数组）。
+
+阶段按完成的时刻切分：StageClock.mark(阶段, 行数) 记录自上一次 mark 以来的区间，
+可以直接作为 process_sheet 的 on_stage 回调。
+
+可选的深入分析（每次运行单独开关）：
+- "cprofile"：对处理线程做函数级性能分析，结果为按累计时间排序的前若干个函数；
+- "tracemalloc"：跟踪内存分配，记录每个阶段的分配峰值，以及占用内存最多的阶段结束时分配最多的代码行。
+并行处理时各源文件在工作进程中的阶段耗时同样记录（带回主进程），深入分析只覆盖主进程。
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+PROFILE_CPROFILE = "cprofile"
+PROFILE_TRACEMALLOC = "tracemalloc"
+PROFILE_CAPTURES = (PROFILE_CPROFILE, PROFILE_TRACEMALLOC)
+# 默认的深入分析方式（空为不启用），如 SALARY_PROFILE=tracemalloc
+DEFAULT_PROFILE_CAPTURE = os.environ.get("SALARY_PROFILE") or None
+# 阶段显示名称
+STAGE_LABELS = {
+    "prepare": "读取表头与扣款表",
+    "sources": "处理源文件（合计）",
+    "read": "读取",
+    "map": "字段映射",
+    "merge": "合并扣款",
+    "calculate": "计算",
+    "combine": "合并报表",
+    "export": "导出",
+}
+# cProfile 结果保留的函数数、tracemalloc 结果保留的代码行数
+PROFILE_TOP_FUNCTIONS = 40
+TRACEMALLOC_TOP_LINES = 20
+
+_MB = 1024 * 1024
+
+
+def current_rss_mb():
+    """当前进程的常驻内存 (MB)，无法获取时返回 None。"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / _MB
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss / _MB
+
+
+def peak_rss_mb():
+    """当前进程的常驻内存历史峰值 (MB)，Windows 上返回 None。"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 为单位，macOS 以字节为单位
+    return peak / _MB if sys.platform == "darwin" else peak / 1024
+
+
+def _round(value, digits: int = 4):
+    return None if value is None else round(value, digits)
+
+
+class StageRecord:
+    """一个阶段的一次记录；file 为 None 的是整次运行的阶段，否则为某个源文件内的阶段。"""
+
+    def __init__(self, stage: str, file: str = None, wall_seconds: float = 0.0, cpu_seconds: float = 0.0, rows=None,
+                 rss_mb=None, peak_rss_mb=None, alloc_peak_mb=None):
+        self.stage = stage
+        self.file = file
+        self.wall_seconds = wall_seconds
+        self.cpu_seconds = cpu_seconds
+        self.rows = rows
+        self.rss_mb = rss_mb
+        self.peak_rss_mb = peak_rss_mb
+        self.alloc_peak_mb = alloc_peak_mb
+
+    def to_dict(self) -> dict:
+        return {
+            "file": self.file,
+            "stage": self.stage,
+            "label": STAGE_LABELS.get(self.stage, self.stage),
+            "wall_seconds": _round(self.wall_seconds),
+            "cpu_seconds": _round(self.cpu_seconds),
+            "rows": self.rows,
+            "rss_mb": _round(self.rss_mb, 1),
+            "peak_rss_mb": _round(self.peak_rss_mb, 1),
+            "alloc_peak_mb": _round(self.alloc_peak_mb, 1),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "StageRecord":
+        return cls(data["stage"], file=data.get("file"), wall_seconds=data.get("wall_seconds") or 0.0,
+                   cpu_seconds=data.get("cpu_seconds") or 0.0, rows=data.get("rows"), rss_mb=data.get("rss_mb"),
+                   peak_rss_mb=data.get("peak_rss_mb"), alloc_peak_mb=data.get("alloc_peak_mb"))
+
+
+class StageClock:
+    """
+    按阶段完成的时刻切分耗时，每次 mark 把自上一次 mark（或创建时）以来的区间记为该阶段。
+
+    Args:
+        profiler: 记录写入的 RunProfiler。
+        file: 源文件名，整次运行的阶段为 None。
+        accumulate: 为 True 时同一阶段多次 mark（如分块处理的每一块）累计为一条记录：
+            耗时与行数相加，内存取最后一次，分配峰值取最大值。
+    """
+
+    def __init__(self, profiler, file: str = None, accumulate: bool = False):
+        self.profiler = profiler
+        self.file = file
+        self.accumulate = accumulate
+        self._records = {}
+        self._wall = time.perf_counter()
+        self._cpu = time.thread_time()
+        profiler.reset_alloc_peak()
+
+    def mark(self, stage: str, rows=None) -> StageRecord:
+        wall, cpu = time.perf_counter(), time.thread_time()
+        alloc_peak = self.profiler.alloc_peak_mb()
+        record = self._records.get(stage) if self.accumulate else None
+        if record is None:
+            record = StageRecord(stage, file=self.file, wall_seconds=wall - self._wall, cpu_seconds=cpu - self._cpu,
+                                 rows=rows, rss_mb=current_rss_mb(), peak_rss_mb=peak_rss_mb(), alloc_peak_mb=alloc_peak)
+            self._records[stage] = record
+            self.profiler.add(record)
+        else:
+            record.wall_seconds += wall - self._wall
+            record.cpu_seconds += cpu - self._cpu
+            record.rows = None if rows is None or record.rows is None else record.rows + rows
+            record.rss_mb, record.peak_rss_mb = current_rss_mb(), peak_rss_mb()
+            if alloc_peak is not None:
+                record.alloc_peak_mb = max(record.alloc_peak_mb or 0.0, alloc_peak)
+        self.profiler.snapshot_allocations()
+        self.profiler.reset_alloc_peak()
+        self._wall, self._cpu = wall, cpu
+        return record
+
+    __call__ = mark
+
+
+class RunProfiler:
+    """
+    一次运行的分阶段记录。
+
+    Args:
+        capture: 深入分析方式，None / "cprofile" / "tracemalloc"。
+
+    用法：
+        profiler = RunProfiler(capture="tracemalloc")
+        profiler.start()
+        clock = profiler.clock()
+        ...
+        clock.mark("prepare")
+        process_sheet(..., profiler=profiler)   # 各源文件的 read/map/merge/calculate
+        profiler.stop()
+        profiler.to_dict()
+    """
+
+    def __init__(self, capture: str = None):
+        if capture is not None and capture not in PROFILE_CAPTURES:
+            raise ValueError(f"未知的性能分析方式: {capture}（可选 {', '.join(PROFILE_CAPTURES)}）")
+        self.capture = capture
+        self.records = []
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self._lock = threading.Lock()
+        self._started = None
+        self._cprofile = None
+        self._owns_tracemalloc = False
+        self._cprofile_text = None
+        self._tracemalloc_top = None
+        self._tracemalloc_size = 0
+
+    @property
+    def tracing(self) -> bool:
+        return self.capture == PROFILE_TRACEMALLOC and tracemalloc.is_tracing()
+
+    def start(self) -> "RunProfiler":
+        self._started = (time.perf_counter(), time.thread_time())
+        if self.capture == PROFILE_TRACEMALLOC and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._owns_tracemalloc = True
+        elif self.capture == PROFILE_CPROFILE:
+            self._cprofile = cProfile.Profile()
+            try:
+                self._cprofile.enable()
+            except ValueError:
+                # 同一线程中已有其他分析器在运行
+                self._cprofile = None
+        return self
+
+    def stop(self) -> None:
+        if self._started is None:
+            return
+        self.wall_seconds = time.perf_counter() - self._started[0]
+        self.cpu_seconds = time.thread_time() - self._started[1]
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            text = io.StringIO()
+            pstats.Stats(self._cprofile, stream=text).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+            self._cprofile_text = text.getvalue()
+            self._cprofile = None
+        if self.tracing:
+            self.snapshot_allocations()
+            if self._owns_tracemalloc:
+                tracemalloc.stop()
+                self._owns_tracemalloc = False
+        self._started = None
+
+    def __enter__(self) -> "RunProfiler":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def clock(self, file: str = None, accumulate: bool = False) -> StageClock:
+        return StageClock(self, file=file, accumulate=accumulate)
+
+    def add(self, record: StageRecord) -> None:
+        with self._lock:
+            self.records.append(record)
+
+    def extend(self, records) -> None:
+        """加入工作进程带回的记录（StageRecord.to_dict 的结果）。"""
+        for data in records:
+            self.add(StageRecord.from_dict(data))
+
+    def alloc_peak_mb(self):
+        return tracemalloc.get_traced_memory()[1] / _MB if self.tracing else None
+
+    def snapshot_allocations(self) -> None:
+        """当前已分配的内存多于之前各次时，记录分配最多的代码行。"""
+        if not self.tracing:
+            return
+        size = tracemalloc.get_traced_memory()[0]
+        if size <= self._tracemalloc_size:
+            return
+        self._tracemalloc_size = size
+        top = tracemalloc.take_snapshot().statistics("lineno")[:TRACEMALLOC_TOP_LINES]
+        self._tracemalloc_top = [{"location": str(stat.traceback), "size_mb": _round(stat.size / _MB, 2),
+                                  "count": stat.count} for stat in top]
+
+    def reset_alloc_peak(self) -> None:
+        if self.tracing:
+            tracemalloc.reset_peak()
+
+    def summary(self) -> list:
+        """源文件内的阶段按阶段汇总（各文件相加），顺序为首次出现的顺序。"""
+        totals = {}
+        for record in self.records:
+            if record.file is None:
+                continue
+            item = totals.setdefault(record.stage, {"stage": record.stage, "label": STAGE_LABELS.get(record.stage, record.stage),
+                                                    "files": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "rows": 0})
+            item["files"] += 1
+            item["wall_seconds"] += record.wall_seconds
+            item["cpu_seconds"] += record.cpu_seconds
+            item["rows"] += record.rows or 0
+        for item in totals.values():
+            item["wall_seconds"] = _round(item["wall_seconds"])
+            item["cpu_seconds"] = _round(item["cpu_seconds"])
+        return list(totals.values())
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            records = list(self.records)
+        return {
+            "capture": self.capture,
+            "wall_seconds": _round(self.wall_seconds),
+            "cpu_seconds": _round(self.cpu_seconds),
+            "peak_rss_mb": _round(peak_rss_mb(), 1),
+            "stages": [record.to_dict() for record in records],
+            "summary": self.summary(),
+            "cprofile": self._cprofile_text,
+            "tracemalloc": self._tracemalloc_top,
+        }
+
+    def log_summary(self, logger) -> None:
+        """按阶段输出耗时（运行级阶段与各文件合计）。"""
+        for record in self.records:
+            if record.file is None:
+                logger.info("阶段 %s: %.2f 秒 (CPU %.2f 秒)%s", STAGE_LABELS.get(record.stage, record.stage),
+                            record.wall_seconds, record.cpu_seconds,
+                            "" if record.rss_mb is None else f"，内存 {record.rss_mb:.0f} MB")
+        for item in self.summary():
+            logger.info("  %s: %.2f 秒 (CPU %.2f 秒)，%s 个文件 %s 行", item["label"], item["wall_seconds"],
+                        item["cpu_seconds"], item["files"], item["rows"])
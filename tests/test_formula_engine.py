@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""formula_engine 公式白名单与按列计算的回归测试"""
+
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from formula_engine import CalculationPlan, FormulaError, compile_formula  # noqa: E402
+
+
+def legacy_row_eval(row: pd.Series, sources, calculation):
+    """原逐行计算：源字段 to_numeric(coerce) 后按 0 补空，再用 eval 计算；出错时为 NaN。"""
+    if any(source not in row.index for source in sources):
+        return np.nan
+    values = row[list(sources)].apply(pd.to_numeric, errors="coerce").fillna(0)
+    try:
+        if calculation == "sum":
+            return values.sum(skipna=False, min_count=0)
+        return eval(calculation, {"__builtins__": {}}, values.to_dict())
+    except Exception:
+        return np.nan
+
+
+@pytest.mark.parametrize("calculation, message", [
+    ("a.__class__", "Attribute"),
+    ("a.real + b", "Attribute"),
+    ("__import__('os')", "不支持的函数调用"),
+    ("abs(a)", "不支持的函数调用"),
+    ("(lambda: 1)()", "不支持的函数调用"),
+    ("round(a, ndigits=2)", "关键字参数"),
+    ("c + 1", "未在 source_fields 中声明"),
+    ("a[0]", "Subscript"),
+    ("[a, b]", "List"),
+    ("'1' + a", "不支持的常量"),
+    ("True + a", "不支持的常量"),
+    ("a @ b", "不支持的运算符"),
+    ("a = 1", "公式语法错误"),
+])
+def test_rejects_syntax_outside_whitelist(calculation, message):
+    with pytest.raises(FormulaError, match=message):
+        compile_formula(calculation, ("a", "b"))
+
+
+def test_division_by_zero_is_nan_per_row():
+    df = pd.DataFrame({"a": [10.0, 7.0, 9.0], "b": [2.0, 0.0, 4.0]})
+    for calculation in ("a / b", "a // b", "a % b"):
+        result = compile_formula(calculation, ("a", "b")).evaluate(df)
+        assert pd.isna(result.iloc[1])
+        assert result.notna().tolist() == [True, False, True]
+    assert compile_formula("a / b", ("a", "b")).evaluate(df).tolist()[::2] == [5.0, 2.25]
+
+
+def test_missing_source_gives_all_nan_column():
+    df = pd.DataFrame({"a": [1.0, 2.0]}, index=[5, 6])
+    for calculation in ("a - b", "sum"):
+        result = compile_formula(calculation, ("a", "b")).evaluate(df)
+        assert result.index.tolist() == [5, 6]
+        assert result.isna().all()
+
+
+def test_non_numeric_values_count_as_zero():
+    df = pd.DataFrame({"a": ["100", "", None, "abc", 5], "b": [1, 2, "x", 4, None]})
+    assert compile_formula("a - b", ("a", "b")).evaluate(df).tolist() == [99.0, -2.0, 0.0, -4.0, 5.0]
+    assert compile_formula("sum", ("a", "b")).evaluate(df).tolist() == [101.0, 2.0, 0.0, 4.0, 5.0]
+
+
+def test_constant_formula_fills_every_row():
+    df = pd.DataFrame({"a": [1, 2, 3]})
+    assert compile_formula("2 * 3", ("a",)).evaluate(df).tolist() == [6.0, 6.0, 6.0]
+
+
+def test_matches_legacy_eval_on_rule_set():
+    with open(os.path.join(ROOT, "config", "field_mapping", "公务员-参公-事业.json"), encoding="utf-8") as f:
+        rules = json.load(f)["field_mappings"]
+    definitions = CalculationPlan.from_rules(rules).definitions
+    # 额外的公式覆盖白名单内的其他运算
+    definitions.update({
+        "测试_混合": {"sources": ["应发工资", "扣发合计"], "calculation": "(应发工资 - 扣发合计) * 2 / 3 + 应发工资 ** 0"},
+        "测试_条件": {"sources": ["应发工资", "扣发合计"],
+                  "calculation": "应发工资 if 应发工资 > 扣发合计 and 扣发合计 >= 0 else -扣发合计"},
+        "测试_除法": {"sources": ["应发工资", "其他补扣"], "calculation": "应发工资 / 其他补扣 - 应发工资 // 其他补扣"},
+        "测试_布尔": {"sources": ["扣发合计", "其他补扣"], "calculation": "not 扣发合计 or 其他补扣 % 3"},
+    })
+    plan = CalculationPlan(definitions)
+    sources = sorted({source for details in plan.definitions.values() for source in details["sources"]
+                      if source not in plan.definitions})
+    rng = np.random.default_rng(0)
+    data = {source: rng.integers(-500, 5000, 40).astype(float) / 4 for source in sources}
+    df = pd.DataFrame(data).astype(object)
+    # 空值、文本与 0：覆盖非数值按 0 处理与除数为 0
+    df.iloc[::7, :] = None
+    df.iloc[3::9, :] = "无"
+    df.iloc[5::6, :] = 0
+
+    expected = df.copy()
+    for target in plan:
+        details = plan.definitions[target]
+        expected[target] = expected.apply(lambda row: legacy_row_eval(row, details["sources"], details["calculation"]),
+                                          axis=1).astype(float)
+    actual = df.copy()
+    plan.evaluate(actual)
+    for target in plan.definitions:
+        pd.testing.assert_series_equal(actual[target], expected[target], check_names=False)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""frame_schema 紧凑列类型的回归测试"""
+
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from frame_schema import FEN_COLUMNS_ATTR, compact_frame, concat_frames, expand_frame  # noqa: E402
+
+
+def test_concat_fen_with_float_column_keeps_yuan():
+    # 专项 的 基本工资 含不足一分的公式结果，保持浮点元；区聘 的同名列以分存储
+    fen = compact_frame(pd.DataFrame({"基本工资": [2240.0, 100.5], "岗位工资": [10.0, 20.0]}))
+    yuan = compact_frame(pd.DataFrame({"基本工资": [2240.3333, 2240.0], "岗位工资": [30.0, 40.0]}))
+    assert "基本工资" in fen.attrs[FEN_COLUMNS_ATTR]
+    assert "基本工资" not in yuan.attrs[FEN_COLUMNS_ATTR]
+
+    combined = concat_frames([fen, yuan])
+    assert "基本工资" not in combined.attrs[FEN_COLUMNS_ATTR]
+    expanded = expand_frame(combined)
+    assert expanded["基本工资"].tolist() == [2240.0, 100.5, 2240.3333, 2240.0]
+    assert expanded["岗位工资"].tolist() == [10.0, 20.0, 30.0, 40.0]
+
+
+def test_concat_fen_columns_round_trip():
+    frames = [compact_frame(pd.DataFrame({"基本工资": [1234.56, 0.01]})),
+              compact_frame(pd.DataFrame({"基本工资": [7.0, None]}))]
+    expanded = expand_frame(concat_frames(frames))
+    assert expanded["基本工资"].tolist()[:3] == [1234.56, 0.01, 7.0]
+    assert pd.isna(expanded["基本工资"].iloc[3])
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""key_matching 分级匹配的回归测试：匹配方式决定了扣款合并到谁的工资行"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from key_matching import (MATCH_EXACT, MATCH_FUZZY, MATCH_NORMALIZED, MATCH_PARTIAL,  # noqa: E402
+                          KeyMatcher)
+
+
+def match(reference: dict, query: dict, fuzzy_threshold: float = 1.0, claimed: set = None):
+    return KeyMatcher(pd.DataFrame(reference)).match(pd.DataFrame(query), fuzzy_threshold, claimed=claimed)
+
+
+def test_exact_ignores_width_and_whitespace():
+    positions, methods, confidence = match(
+        {"姓名": ["张三", "李四"], "身份证号": ["110101199001011234", "220202198502022345"]},
+        {"姓名": ["李 四", "张三"], "身份证号": ["２２０２０２１９８５０２０２２３４５", "110101199001011234"]},
+    )
+    assert positions.tolist() == [1, 0]
+    assert methods.tolist() == [MATCH_EXACT, MATCH_EXACT]
+    assert confidence.tolist() == [1.0, 1.0]
+
+
+def test_normalized_ignores_punctuation():
+    positions, methods, _ = match({"姓名": ["阿卜杜·热合曼", "王五"]}, {"姓名": ["阿卜杜热合曼", "王五"]})
+    assert positions.tolist() == [0, 1]
+    assert methods.tolist() == [MATCH_NORMALIZED, MATCH_EXACT]
+
+
+def test_partial_matches_on_non_blank_columns():
+    reference = {"姓名": ["张三", "李四", "李四"], "身份证号": ["110", "220", "330"]}
+    positions, methods, confidence = match(reference, {"姓名": ["张三", "李四"], "身份证号": [None, ""]})
+    # 张三 只有一条记录；李四 按姓名有两条，无法确定是哪一条
+    assert positions.tolist() == [0, -1]
+    assert methods.tolist() == [MATCH_PARTIAL, None]
+    assert confidence[0] == 0.9 and np.isnan(confidence[1])
+
+
+def test_partial_uses_reference_rows_with_blank_key_parts():
+    positions, methods, _ = match({"姓名": ["张三", "李四"], "身份证号": ["110", None]},
+                                  {"姓名": ["李四"], "身份证号": [None]})
+    assert positions.tolist() == [1]
+    assert methods.tolist() == [MATCH_PARTIAL]
+
+
+def test_fuzzy_is_off_unless_threshold_below_one():
+    reference = {"姓名": ["张三"], "身份证号": ["110101199001011234"]}
+    query = {"姓名": ["张三"], "身份证号": ["110101199001011235"]}
+    assert match(reference, query)[0].tolist() == [-1]
+    positions, methods, confidence = match(reference, query, fuzzy_threshold=0.9)
+    assert positions.tolist() == [0]
+    assert methods.tolist() == [MATCH_FUZZY]
+    assert 0.9 <= confidence[0] < 1
+
+
+def test_fuzzy_rejects_ties():
+    # 与两条记录的相似度相同，不确定是哪一条
+    reference = {"身份证号": ["110101199001011234", "110101199001011236"]}
+    positions, methods, _ = match(reference, {"身份证号": ["110101199001011235"]}, fuzzy_threshold=0.8)
+    assert positions.tolist() == [-1]
+    assert methods.tolist() == [None]
+
+
+def test_fuzzy_rejects_two_queries_claiming_one_record():
+    reference = {"身份证号": ["110101199001011234", "330303197703033456"]}
+    query = {"身份证号": ["110101199001011235", "110101199001011239"]}
+    positions, _, _ = match(reference, query, fuzzy_threshold=0.8)
+    assert positions.tolist() == [-1, -1]
+    # 同一个值出现在多行时仍可匹配
+    positions, methods, _ = match(reference, {"身份证号": ["110101199001011235"] * 2}, fuzzy_threshold=0.8)
+    assert positions.tolist() == [0, 0]
+    assert methods.tolist() == [MATCH_FUZZY, MATCH_FUZZY]
+
+
+def test_fuzzy_skips_records_already_claimed():
+    reference = {"身份证号": ["110101199001011234"]}
+    claimed = {0}
+    positions, _, _ = match(reference, {"身份证号": ["110101199001011235"]}, fuzzy_threshold=0.8, claimed=claimed)
+    assert positions.tolist() == [-1]
+
+
+def test_duplicate_reference_keys_are_not_matched():
+    reference = {"姓名": ["张三", "张三", "李四", "王·五", "王五"]}
+    positions, methods, _ = match(reference, {"姓名": ["张三", "李四", "王五", "张 三"]}, fuzzy_threshold=0.5)
+    # 张三 重复，不参与任何一级；王五 精确匹配唯一的一条，宽松规范化后重复的 王·五 不影响
+    assert positions.tolist() == [-1, 2, 4, -1]
+    assert methods.tolist() == [None, MATCH_EXACT, MATCH_EXACT, None]
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+单次解析的 Excel 工作簿读取层
+
+同一个上传的 xlsx 过去在一次处理中会被解析多次（界面预取表头、日志预览、
+process_sheet 预览、process_sheet 正式读取）。WorkbookSnapshot 以 openpyxl
+只读模式流式读取工作表一次，在读取过程中按与 detect_data_start_row 相同的
+关键字逻辑检测表头行，之后所有使用方都从内存中的快照取数据。
+
+单元格转换与 pandas.read_excel (openpyxl 引擎) 保持一致：
+- 空单元格、Excel 错误值视为缺失
+- 整数值的浮点数转换为 int
+- 去掉每行末尾的空单元格和工作表末尾的空行
+- 最终经 pandas 的 TextParser 做相同的类型推断与缺失值识别
+
+WorkbookStream 用于超大的源数据表：同样以只读模式读取，但不保留全部行，
+每 batch_rows 个数据行生成一个 DataFrame，内存占用与块大小成正比。
+"""
+
+import io
+import os
+
+import numpy as np
+import pandas as pd
+from pandas.io.parsers import TextParser
+
+# 与界面中默认用于检测表头的关键字一致
+DEFAULT_HEADER_KEYWORDS = ("姓名", "人员姓名")
+
+_EXCEL_ERROR_VALUES = {"#N/A", "#DIV/0!", "#VALUE!", "#REF!", "#NAME?", "#NUM!", "#NULL!"}
+
+
+def row_has_keyword(row, keywords) -> bool:
+    """判断一行中是否有单元格包含任一关键字（子串匹配）。"""
+    if isinstance(keywords, str):
+        keywords = (keywords,)
+    for cell in row:
+        if cell is None or cell == "":
+            continue
+        text = str(cell)
+        if any(keyword in text for keyword in keywords):
+            return True
+    return False
+
+
+def find_header_row(rows, keywords, max_scan_rows: int = 10):
+    """
+    在前 max_scan_rows 行中查找第一个包含关键字的行。
+
+    Returns:
+        行号（从 0 开始），未找到时返回 None。
+    """
+    for i, row in enumerate(rows):
+        if i >= max_scan_rows:
+            break
+        if row_has_keyword(row, keywords):
+            return i
+    return None
+
+
+def _convert_cell(value):
+    """与 pandas openpyxl 读取器的单元格转换保持一致。"""
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        if value.is_integer():
+            return int(value)
+        return value
+    if isinstance(value, str) and value in _EXCEL_ERROR_VALUES:
+        return np.nan
+    return value
+
+
+def _parse_rows(rows, header: bool) -> pd.DataFrame:
+    """用 pandas 的 TextParser 把原始行转换为 DataFrame（与 read_excel 一致的类型推断）。"""
+    if not rows:
+        return pd.DataFrame()
+    parser = TextParser(rows, header=0 if header else None, skip_blank_lines=False)
+    return parser.read()
+
+
+def _open_source(source, name: str = None):
+    """返回 (可交给 load_workbook 的对象, 用于日志的文件名)；bytes 包装为文件对象，文件对象回到开头。"""
+    if name is None:
+        name = os.path.basename(source) if isinstance(source, (str, os.PathLike)) else getattr(source, "name", "")
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    elif hasattr(source, "seek"):
+        source.seek(0)
+    return source, name
+
+
+def _first_sheet(wb, sheet_name):
+    # 与 read_excel 默认 sheet_name=0 一致：默认读取第一个工作表（而非活动工作表）
+    return wb[sheet_name] if isinstance(sheet_name, str) else wb.worksheets[sheet_name or 0]
+
+
+class WorkbookSnapshot:
+    """
+    单个工作表的内存快照。
+
+    Attributes:
+        name: 文件名（用于日志）。
+        rows: 已按 pandas 规则转换并补齐宽度的全部行。
+        detected_header_row: 读取时按 header_keywords 检测到的表头行号，未找到为 None。
+    """
+
+    def __init__(self, rows: list, name: str = "", header_keywords=(), detected_header_row=None, max_scan_rows: int = 20):
+        self.rows = rows
+        self.name = name
+        self.header_keywords = tuple(header_keywords)
+        self.detected_header_row = detected_header_row
+        self._header_cache = {}
+        if self.header_keywords:
+            self._header_cache[(self.header_keywords, max_scan_rows)] = detected_header_row
+
+    @classmethod
+    def load(cls, source, name: str = None, sheet_name=0,
+             header_keywords=DEFAULT_HEADER_KEYWORDS, max_scan_rows: int = 20, max_rows: int = None) -> "WorkbookSnapshot":
+        """
+        流式读取工作表一次并生成快照。
+
+        Args:
+            source: 文件路径、bytes 或文件对象（如 Streamlit 的 UploadedFile）。
+            name: 用于日志的文件名，默认取自 source。
+            sheet_name: 工作表名或序号，默认第一个工作表。
+            header_keywords: 读取时用于检测表头行的关键字。
+            max_scan_rows: 表头检测扫描的最大行数。
+            max_rows: 只读取前 max_rows 行（如只需表头时），默认读取全部行。
+        """
+        source, name = _open_source(source, name)
+        if isinstance(header_keywords, str):
+            header_keywords = (header_keywords,)
+        from openpyxl import load_workbook  # 只在实际读取时导入，不拖慢界面启动
+
+        wb = load_workbook(source, read_only=True, data_only=True)
+        try:
+            ws = _first_sheet(wb, sheet_name)
+            # 部分导出工具写入的 dimension 不准确，只读模式下需重置后按实际内容读取
+            ws.reset_dimensions()
+            rows = []
+            last_row_with_data = -1
+            detected_header_row = None
+            for row_number, values in enumerate(ws.iter_rows(values_only=True)):
+                if max_rows is not None and row_number >= max_rows:
+                    break
+                converted = [_convert_cell(value) for value in values]
+                while converted and converted[-1] == "":
+                    converted.pop()
+                if converted:
+                    last_row_with_data = row_number
+                    # 边读边检测表头行
+                    if (detected_header_row is None and header_keywords
+                            and row_number < max_scan_rows and row_has_keyword(converted, header_keywords)):
+                        detected_header_row = row_number
+                rows.append(converted)
+        finally:
+            wb.close()
+
+        rows = rows[: last_row_with_data + 1]
+        if rows:
+            max_width = max(len(row) for row in rows)
+            rows = [row + [""] * (max_width - len(row)) for row in rows]
+        return cls(rows, name=name, header_keywords=header_keywords or (),
+                   detected_header_row=detected_header_row, max_scan_rows=max_scan_rows)
+
+    @classmethod
+    def ensure(cls, source, **kwargs) -> "WorkbookSnapshot":
+        """已是快照则原样返回；带 snapshot 属性的输入（如 pipeline.InputFile）取其快照；否则读取 source。"""
+        if isinstance(source, cls):
+            return source
+        snapshot = getattr(source, "snapshot", None)
+        if isinstance(snapshot, cls):
+            return snapshot
+        return cls.load(source, **kwargs)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def find_header_row(self, keywords, max_scan_rows: int = 10):
+        """按关键字查找表头行，未找到返回 None。结果按 (关键字, 扫描行数) 缓存。"""
+        if isinstance(keywords, str):
+            keywords = (keywords,)
+        cache_key = (tuple(keywords), max_scan_rows)
+        if cache_key not in self._header_cache:
+            self._header_cache[cache_key] = find_header_row(self.rows, keywords, max_scan_rows)
+        return self._header_cache[cache_key]
+
+    def detect_header_row(self, keywords, max_scan_rows: int = 10) -> int:
+        """与 detect_data_start_row 相同：未找到时抛出 ValueError。"""
+        header_row = self.find_header_row(keywords, max_scan_rows)
+        if header_row is None:
+            keyword_text = keywords if isinstance(keywords, str) else "/".join(keywords)
+            raise ValueError(f"未找到字段 '{keyword_text}' 所在行")
+        return header_row
+
+    def header_values(self, header_row: int) -> list:
+        """返回表头行的原始值，空单元格为 NaN（与 preview.iloc[header_row].tolist() 一致）。"""
+        return [np.nan if value == "" else value for value in self.rows[header_row]]
+
+    def preview(self, nrows: int = 10) -> pd.DataFrame:
+        """等价于 pd.read_excel(..., header=None, nrows=nrows)。"""
+        return _parse_rows(self.rows[:nrows], header=False)
+
+    def data_frame(self, header_row: int) -> pd.DataFrame:
+        """
+        返回表头行之后的数据，列名直接取表头行原始值（不去重、空表头为 NaN），
+        与 process_sheet 原先的 read_excel(skiprows=header_row + 1) + 手动设置列名一致。
+        """
+        header = self.header_values(header_row)
+        data_rows = self.rows[header_row + 1:]
+        if not data_rows:
+            return pd.DataFrame(columns=header)
+        df = _parse_rows(data_rows, header=False)
+        df.columns = header
+        return df
+
+    def read(self, header: int = 0, nrows: int = None) -> pd.DataFrame:
+        """
+        等价于 pd.read_excel(..., header=header, nrows=nrows)：重复列名加 .1 后缀，
+        空表头命名为 "Unnamed: n"。
+        """
+        rows = self.rows[header:] if nrows is None else self.rows[header: header + 1 + nrows]
+        return _parse_rows(rows, header=True)
+
+    def columns(self, header: int) -> list:
+        """只取表头列名，等价于 pd.read_excel(..., header=header, nrows=0).columns.tolist()。"""
+        return self.read(header=header, nrows=0).columns.tolist()
+
+    def frame_for_keywords(self, keywords, max_scan_rows: int = 20):
+        """按关键字检测表头并返回 (表头行号, 数据)，未检测到表头时返回 (None, None)。"""
+        header_row = self.find_header_row(keywords, max_scan_rows)
+        if header_row is None:
+            return None, None
+        return header_row, self.read(header=header_row)
+
+
+class WorkbookStream:
+    """
+    分块读取单个工作表：在前 max_scan_rows 行中检测表头行，之后每 batch_rows 个非空数据行生成一个 DataFrame。
+
+    列名为表头行的原始值（空表头为 NaN，超出表头宽度的单元格不读取），与 WorkbookSnapshot.data_frame 一致；
+    空行不生成数据行（字段映射时本就会丢弃）。类型推断按块进行，同一列在不同块中的类型可能不同。
+
+    Args:
+        source: 文件路径、bytes 或文件对象。
+        name: 用于日志的文件名，默认取自 source。
+        sheet_name: 工作表名或序号，默认第一个工作表。
+        header_keywords: 检测表头行的关键字。
+        max_scan_rows: 表头检测扫描的最大行数。
+        batch_rows: 每块的数据行数。
+
+    Attributes:
+        header_row: 检测到的表头行号（开始迭代后可用）。
+        header: 表头行的原始值。
+        declared_rows: 文件中声明的工作表行数，只用于估计进度（可能不准确，未声明时为 None）。
+        rows: 已生成的数据行数。
+    """
+
+    def __init__(self, source, name: str = None, sheet_name=0, header_keywords=DEFAULT_HEADER_KEYWORDS,
+                 max_scan_rows: int = 10, batch_rows: int = 5000):
+        self.source, self.name = _open_source(source, name)
+        self.sheet_name = sheet_name
+        self.header_keywords = (header_keywords,) if isinstance(header_keywords, str) else tuple(header_keywords)
+        self.max_scan_rows = max_scan_rows
+        self.batch_rows = max(int(batch_rows), 1)
+        self.header_row = None
+        self.header = None
+        self.declared_rows = None
+        self.rows = 0
+
+    def _frame(self, rows: list) -> pd.DataFrame:
+        df = _parse_rows(rows, header=False)
+        df.columns = self.header
+        self.rows += len(df)
+        return df
+
+    def __iter__(self):
+        """
+        Yields:
+            各块数据 (DataFrame)。
+
+        Raises:
+            ValueError: 前 max_scan_rows 行中没有包含关键字的行。
+        """
+        from openpyxl import load_workbook
+
+        wb = load_workbook(self.source, read_only=True, data_only=True)
+        try:
+            ws = _first_sheet(wb, self.sheet_name)
+            self.declared_rows = ws.max_row
+            ws.reset_dimensions()
+            width, batch = 0, []
+            for row_number, values in enumerate(ws.iter_rows(values_only=True)):
+                converted = [_convert_cell(value) for value in values]
+                while converted and converted[-1] == "":
+                    converted.pop()
+                if self.header is None:
+                    if row_number >= self.max_scan_rows:
+                        break
+                    if converted and row_has_keyword(converted, self.header_keywords):
+                        self.header_row = row_number
+                        self.header = [np.nan if value == "" else value for value in converted]
+                        width = len(converted)
+                    continue
+                if not converted:
+                    continue
+                batch.append(converted[:width] + [""] * (width - len(converted)))
+                if len(batch) >= self.batch_rows:
+                    yield self._frame(batch)
+                    batch = []
+            if self.header is None:
+                raise ValueError(f"未找到字段 '{'/'.join(map(str, self.header_keywords))}' 所在行")
+            if batch:
+                yield self._frame(batch)
+        finally:
+            wb.close()